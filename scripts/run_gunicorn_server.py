@@ -22,6 +22,9 @@ def build_parser():
             'gunicorn',
             'tca.log'),
         'virtualenv': 'tca-dev',
+        # Long-polling requests tie up a sync worker for their whole
+        # duration; use an async worker class (e.g. gevent) to serve them
+        'worker_class': 'sync',
     }
 
 
@@ -29,6 +32,8 @@ def build_parser():
 
     parser.add_argument('-w', '--workers', type=int,
                         default=DEFAULTS['workers'])
+    parser.add_argument('-k', '--worker-class', type=str,
+                        default=DEFAULTS['worker_class'])
     parser.add_argument('--user', type=str,
                         default=DEFAULTS['user'])
     parser.add_argument('--group', type=str,
@@ -72,6 +77,7 @@ def start_server(args):
         'tca.wsgi:application',
         '-b', bind_address,
         '-w', str(args.workers),
+        '-k', args.worker_class,
         '--user', args.user,
         '--group', args.group,
         '--log-file', args.log_file,
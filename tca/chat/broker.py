@@ -0,0 +1,279 @@
+"""
+Module contains a minimal publish/subscribe broker used to wake up
+requests which are waiting for new events in a chat room (such as new
+messages) without polling the database.
+
+The broker implementation is chosen by the ``TCA_MESSAGE_BROKER`` setting
+and obtained by :func:`get_broker`.
+"""
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_by_path
+
+from collections import defaultdict
+
+import Queue
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def get_chat_room_channel(chat_room_id):
+    """
+    Returns the name of the channel to which the events of the chat room
+    with the given ID are published.
+    """
+    return 'chat-room-{id}'.format(id=chat_room_id)
+
+
+def get_chat_room_stream_channel(chat_room_id):
+    """
+    Returns the name of the channel to which the serialized messages of the
+    chat room with the given ID are published for streaming to clients.
+    """
+    return 'chat-room-stream-{id}'.format(id=chat_room_id)
+
+
+class Subscription(object):
+    """
+    A subscription to a single channel of a broker.
+
+    Events published to the channel are put into a bounded queue from
+    which they are obtained by :meth:`get`. When a subscriber does not
+    keep up with the events and the queue fills up, any further events
+    are dropped and the :attr:`overflowed` flag is set so that the
+    subscriber can resynchronize by other means.
+
+    Subscriptions can be used as context managers which make sure that
+    they are cancelled when they are no longer needed.
+    """
+    def __init__(self, broker, channel, max_size):
+        self.broker = broker
+        self.channel = channel
+        self.overflowed = False
+        self._queue = Queue.Queue(max_size)
+
+    def deliver(self, data):
+        """
+        Puts the given event into the subscription's queue without ever
+        blocking the publisher.
+        """
+        try:
+            self._queue.put_nowait(data)
+        except Queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        """
+        Returns the next event of the subscription, waiting at most
+        ``timeout`` seconds for it. Returns ``None`` if there was no event
+        in that time.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        """
+        Cancels the subscription.
+        """
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LocalBroker(object):
+    """
+    A broker which delivers events only to subscribers found in the same
+    process as the publisher.
+
+    It is suitable when the web server and the Celery workers run in a
+    single process (e.g. in development).
+    """
+    #: The default maximum number of undelivered events of a subscription
+    default_max_size = 100
+
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, max_size=None):
+        """
+        Returns a new :class:`Subscription` to the given channel.
+        """
+        if max_size is None:
+            max_size = self.default_max_size
+        subscription = Subscription(self, channel, max_size)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Cancels the given subscription.
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.channel]
+
+    def publish(self, channel, data):
+        """
+        Publishes the given event to all subscribers of the given channel.
+
+        :param data: A JSON serializable object representing the event
+        """
+        self.deliver(channel, data)
+
+    def deliver(self, channel, data):
+        """
+        Delivers the given event to the subscribers of the channel found in
+        this process.
+        """
+        with self._lock:
+            subscriptions = tuple(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(data)
+
+
+class PostgresBroker(LocalBroker):
+    """
+    A broker based on PostgreSQL's ``LISTEN``/``NOTIFY`` which delivers the
+    events to subscribers found in any process connected to the same
+    database.
+
+    Events are published by issuing a ``NOTIFY`` using the default database
+    connection. Since notifications are only sent once the transaction
+    is committed, subscribers are never woken up before the changes which
+    caused the event are visible.
+
+    Each process which has subscribers runs a single background thread
+    listening for the notifications on a dedicated connection and
+    delivering them to the process' subscribers.
+
+    When running under gevent, ``psycogreen`` should be used to make the
+    ``psycopg2`` driver cooperative.
+    """
+    #: The PostgreSQL channel used for all events
+    notify_channel = 'tca_chat'
+    #: The maximum size of a notification payload supported by PostgreSQL
+    max_payload_size = 8000
+    #: The number of seconds to wait before reconnecting after an error
+    reconnect_delay = 5
+
+    def __init__(self):
+        super(PostgresBroker, self).__init__()
+        self._listener = None
+
+    def publish(self, channel, data):
+        payload = json.dumps({
+            'channel': channel,
+            'data': data,
+        })
+        if len(payload) > self.max_payload_size:
+            raise ValueError("The event is too large to be published")
+
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT pg_notify(%s, %s)',
+            [self.notify_channel, payload])
+
+    def subscribe(self, channel, max_size=None):
+        self._ensure_listener()
+        return super(PostgresBroker, self).subscribe(channel, max_size)
+
+    def _ensure_listener(self):
+        """
+        Starts the background thread listening for notifications, unless
+        it is already running.
+        """
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(target=self._listen)
+            self._listener.daemon = True
+            self._listener.start()
+
+    def _connect(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        database = settings.DATABASES['default']
+        listen_connection = psycopg2.connect(
+            database=database['NAME'],
+            user=database.get('USER') or None,
+            password=database.get('PASSWORD') or None,
+            host=database.get('HOST') or None,
+            port=database.get('PORT') or None)
+        listen_connection.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        listen_connection.cursor().execute(
+            'LISTEN {channel}'.format(channel=self.notify_channel))
+
+        return listen_connection
+
+    def _listen(self):
+        """
+        The main loop of the listener thread.
+        """
+        while True:
+            try:
+                listen_connection = self._connect()
+                try:
+                    while True:
+                        select.select([listen_connection], [], [], 60)
+                        listen_connection.poll()
+                        while listen_connection.notifies:
+                            notification = listen_connection.notifies.pop(0)
+                            self._dispatch(notification.payload)
+                finally:
+                    listen_connection.close()
+            except Exception:
+                logger.exception("Listening for notifications failed")
+                time.sleep(self.reconnect_delay)
+
+    def _dispatch(self, payload):
+        try:
+            payload = json.loads(payload)
+            self.deliver(payload['channel'], payload['data'])
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Invalid notification payload: %r", payload)
+
+
+_broker = None
+_broker_pid = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """
+    Returns the broker instance of the current process, as configured by
+    the ``TCA_MESSAGE_BROKER`` setting.
+
+    A new instance is created after the process is forked, since neither
+    the subscriptions nor the listener threads survive a fork.
+    """
+    global _broker, _broker_pid
+
+    with _broker_lock:
+        if _broker is None or _broker_pid != os.getpid():
+            broker_class = import_by_path(settings.TCA_MESSAGE_BROKER)
+            _broker = broker_class()
+            _broker_pid = os.getpid()
+
+        return _broker
@@ -2,7 +2,112 @@ from Crypto.Signature import PKCS1_v1_5
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA
 
+from django.conf import settings
+
+from collections import OrderedDict
+
 import base64
+import hashlib
+import threading
+
+
+class PublicKeyCache(object):
+    """
+    A process-local LRU cache of parsed public keys.
+
+    Parsing a public key (decoding its base64 representation and importing
+    the DER structure) is considerably more expensive than the actual
+    signature verification, so the parsed verifier objects are kept around
+    for keys which have already been seen.
+
+    Entries are keyed by a digest of the key text, which means that the
+    cached value is always a function of the text it was created from.
+    Invalidation is therefore only necessary in order to drop keys which
+    should no longer be kept in memory (e.g. deactivated keys).
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_cache_key(key_text):
+        """
+        Returns the key under which the parsed representation of the given
+        key text is cached.
+        """
+        if isinstance(key_text, unicode):
+            key_text = key_text.encode('utf-8')
+        return hashlib.sha1(key_text).digest()
+
+    def get(self, key_text):
+        """
+        Returns a ``PKCS1_v1_5`` verifier for the given base64 encoded
+        public key.
+
+        :raises ValueError: If the key cannot be parsed
+        """
+        cache_key = self.get_cache_key(key_text)
+        with self._lock:
+            verifier = self._entries.pop(cache_key, None)
+            if verifier is not None:
+                # Re-insert it to mark it as the most recently used entry
+                self._entries[cache_key] = verifier
+                self.hits += 1
+                return verifier
+            self.misses += 1
+
+        # The parsing itself is performed outside of the lock so that
+        # other threads are not blocked by it.
+        verifier = _parse_verifier(key_text)
+
+        with self._lock:
+            self._entries[cache_key] = verifier
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return verifier
+
+    def invalidate(self, key_text):
+        """
+        Removes the parsed representation of the given key from the cache.
+        """
+        with self._lock:
+            self._entries.pop(self.get_cache_key(key_text), None)
+
+    def clear(self):
+        """
+        Removes all entries from the cache and resets the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _parse_verifier(public_key):
+    """
+    Parses the given base64 encoded public key and returns a ``PKCS1_v1_5``
+    verifier based on it.
+
+    :raises ValueError: If the key cannot be parsed
+    """
+    try:
+        public_key = base64.decodestring(public_key)
+        public_key = RSA.importKey(public_key)
+    except:
+        raise ValueError("Invalid public key")
+
+    return PKCS1_v1_5.new(public_key)
+
+
+#: The cache of parsed keys used by :func:`verify`
+key_cache = PublicKeyCache(max_size=settings.TCA_PUBLIC_KEY_CACHE_SIZE)
 
 
 def verify(message, signature, public_key):
@@ -17,22 +122,20 @@ def verify(message, signature, public_key):
     :param public_key: The public key to validate against, represented as
         a base64 encoded bytearray
     """
-    if message is None:
+    if message is None or public_key is None:
         return False
 
     message = message.encode('utf-8')
 
     try:
         signature = base64.decodestring(signature)
-        public_key = base64.decodestring(public_key)
     except:
-        # If either the signature or the public key cannot be converted
-        # to bytes (i.e. the base64 representation is invalid), indicate
-        # that the verification failed
+        # If the signature cannot be converted to bytes (i.e. the base64
+        # representation is invalid), indicate that the verification failed
         return False
     try:
-        public_key = RSA.importKey(public_key)
-    except:
+        verifier = key_cache.get(public_key)
+    except ValueError:
         # Invalid key => signature does not match it
         return False
 
@@ -40,8 +143,42 @@ def verify(message, signature, public_key):
     message_hash.update(message)
 
     try:
-        verifier = PKCS1_v1_5.new(public_key)
         return verifier.verify(message_hash, signature)
     except:
         # Error while verifying => invalid signature
         return False
+
+
+def _verify_any(item):
+    """
+    Checks whether the signature of a message matches any of the given
+    public keys.
+
+    :param item: A tuple ``(message, signature, public_keys)``
+    """
+    message, signature, public_keys = item
+    return any(
+        verify(message, signature, public_key)
+        for public_key in public_keys
+    )
+
+
+def verify_many(items, pool=None):
+    """
+    Verifies the signatures of multiple messages at once.
+
+    :param items: An iterable of ``(message, signature, public_keys)``
+        tuples. A message is considered valid if its signature matches any
+        of the public keys associated to it.
+    :param pool: A :class:`multiprocessing.Pool` across which the
+        verification is spread. Without a pool the verification is
+        performed in the current process.
+
+    :returns: A list of booleans indicating the validity of each item, in
+        the same order as the given items.
+    """
+    items = list(items)
+    if pool is None or len(items) <= 1:
+        return [_verify_any(item) for item in items]
+
+    return pool.map(_verify_any, items)
@@ -0,0 +1,158 @@
+"""
+Module contains a local stand-in for the Google Cloud Messaging HTTP
+service, meant for measuring the throughput of the notifiers without
+depending on (and sending requests to) the real service.
+
+The server answers GCM JSON requests with a configurable latency and can be
+made to fail some of the requests, as well as to report canonical and no
+longer registered registration IDs. Notifiers are pointed to it by the
+``TCA_GCM_URL`` setting.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+
+import itertools
+import json
+import random
+import threading
+import time
+
+
+class FakeGcmRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles a single request to the :class:`FakeGcmServer`.
+    """
+    # Support persistent connections
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.record_connection()
+
+    def send_json(self, status, body, headers=None):
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        server = self.server
+        server.record_request()
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('key=') or authorization == 'key=':
+            return self.send_json(401, {})
+        if random.random() < server.error_rate:
+            return self.send_json(503, {}, {
+                'Retry-After': str(server.retry_after),
+            })
+        try:
+            payload = json.loads(body)
+            registration_ids = payload['registration_ids']
+        except (ValueError, KeyError, TypeError):
+            return self.send_json(400, {})
+
+        self.send_json(200, server.build_response(registration_ids))
+
+
+class FakeGcmServer(ThreadingMixIn, HTTPServer):
+    """
+    A threaded HTTP server imitating the GCM service.
+
+    :param latency: The number of seconds it takes to answer a request
+    :param error_rate: The fraction of requests answered by
+        ``503 Service Unavailable``
+    :param retry_after: The value of the ``Retry-After`` header sent with
+        unavailable responses
+    :param canonical_rate: The fraction of registration IDs for which a
+        canonical ID is returned
+    :param not_registered_rate: The fraction of registration IDs reported
+        as no longer registered
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, error_rate=0,
+                 retry_after=1, canonical_rate=0, not_registered_rate=0,
+                 verbose=False):
+        HTTPServer.__init__(self, address, FakeGcmRequestHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.canonical_rate = canonical_rate
+        self.not_registered_rate = not_registered_rate
+        self.verbose = verbose
+        self.request_count = 0
+        self.connection_count = 0
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return 'http://{host}:{port}/gcm/send'.format(host=host, port=port)
+
+    def record_request(self):
+        with self._lock:
+            self.request_count += 1
+
+    def record_connection(self):
+        with self._lock:
+            self.connection_count += 1
+
+    def build_response(self, registration_ids):
+        """
+        Returns the GCM response for a request sent to the given
+        registration IDs.
+        """
+        results = []
+        for registration_id in registration_ids:
+            if random.random() < self.not_registered_rate:
+                results.append({'error': 'NotRegistered'})
+                continue
+            with self._lock:
+                result = {'message_id': '0:{id}'.format(
+                    id=next(self._message_ids))}
+            if random.random() < self.canonical_rate:
+                result['registration_id'] = registration_id + '-canonical'
+            results.append(result)
+
+        failure = sum(1 for result in results if 'error' in result)
+        return {
+            'multicast_id': random.randint(1, 2 ** 62),
+            'success': len(results) - failure,
+            'failure': failure,
+            'canonical_ids': sum(
+                1 for result in results if 'registration_id' in result),
+            'results': results,
+        }
+
+    def start(self):
+        """
+        Starts serving requests in a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Stops serving requests.
+        """
+        self.shutdown()
+        self.server_close()
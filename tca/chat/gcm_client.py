@@ -0,0 +1,242 @@
+"""
+Module contains the client used to send requests to Google Cloud Messaging.
+
+It extends the client provided by the ``python-gcm`` package so that it
+fits sending notifications from Celery tasks: requests are sent over
+persistent connections and time out, a single attempt is made
+(retries are scheduled by the caller instead of sleeping in the worker) and
+the delay requested by GCM before retrying a request is reported.
+"""
+from __future__ import absolute_import
+
+from django.conf import settings
+
+from gcm import gcm
+
+import errno
+import httplib
+import json
+import socket
+import threading
+import urlparse
+
+
+class GCMUnavailableException(gcm.GCMUnavailableException):
+    """
+    Raised when GCM is (temporarily) unable to process a request.
+
+    :attr:`retry_after` holds the number of seconds after which the request
+    may be retried according to the ``Retry-After`` header of the response,
+    or ``None`` if there was no such header.
+    """
+    def __init__(self, message, retry_after=None):
+        super(GCMUnavailableException, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    Returns the number of seconds given by the value of a ``Retry-After``
+    header, or ``None`` if it cannot be parsed.
+
+    Only the delta-seconds form of the header is supported, as it is the
+    one used by GCM.
+    """
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class ConnectionPool(object):
+    """
+    A pool of persistent HTTP connections to the host of a single URL.
+
+    Connections are kept open after a request so that further requests do
+    not need to establish a new connection (and go through a new TLS
+    handshake). At most ``max_size`` idle connections are kept.
+
+    The pool can be used by multiple threads at the same time.
+    """
+    def __init__(self, url, max_size, timeout):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.host = parts.netloc
+        self.path = urlparse.urlunsplit(('', '', parts.path, parts.query, ''))
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    #: The status line reported by ``httplib.BadStatusLine`` when the
+    #: connection was closed before any part of the response was received
+    closed_status_line = httplib.BadStatusLine(
+        "No status line received - the server has closed the connection"
+    ).line
+
+    def _get_connection(self):
+        """
+        Returns a ``(connection, reused)`` tuple of an idle connection or
+        a new one.
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+
+        return self.connection_class(self.host, timeout=self.timeout), False
+
+    def _release_connection(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def _is_stale(self, error):
+        """
+        Checks whether the given error, raised while sending a request,
+        means that the server closed the idle connection.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        return getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
+    def request(self, method, body, headers):
+        """
+        Sends a request over a pooled connection.
+
+        A request is retried once on a new connection if it fails on
+        a reused connection before any part of the response arrives, since
+        the server may have closed the idle connection in the mean time.
+        Requests which time out are never retried.
+
+        :returns: A ``(status, headers, body)`` tuple of the response
+        :raises: ``httplib.HTTPException`` or ``socket.error`` when the
+            request fails
+        """
+        while True:
+            connection, reused = self._get_connection()
+            try:
+                connection.request(method, self.path, body, headers)
+            except socket.error as e:
+                connection.close()
+                if reused and self._is_stale(e):
+                    continue
+                raise
+            except httplib.HTTPException:
+                connection.close()
+                raise
+
+            try:
+                response = connection.getresponse()
+                response_body = response.read()
+            except httplib.BadStatusLine as e:
+                connection.close()
+                # Raised without a status line only when no response
+                # arrived before the connection was closed
+                if reused and e.line == self.closed_status_line:
+                    continue
+                raise
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._release_connection(connection)
+
+            return response.status, response.msg, response_body
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class GCM(gcm.GCM):
+    """
+    A GCM client which sends requests over a :class:`ConnectionPool`, times
+    them out after ``TCA_GCM_TIMEOUT`` seconds and raises
+    a :class:`GCMUnavailableException` carrying the value of the
+    ``Retry-After`` header for server errors.
+
+    Requests are sent to the URL given by the ``TCA_GCM_URL`` setting,
+    unless a different one is given. Proxies are not supported.
+    """
+    def __init__(self, api_key, url=None):
+        super(GCM, self).__init__(api_key, url=url or settings.TCA_GCM_URL)
+        self._pool = ConnectionPool(
+            self.url,
+            max_size=settings.TCA_GCM_MAX_CONCURRENT_REQUESTS,
+            timeout=settings.TCA_GCM_TIMEOUT)
+
+    def make_request(self, data, is_json=True):
+        headers = {
+            'Authorization': 'key=%s' % self.api_key,
+        }
+        if is_json:
+            headers['Content-Type'] = 'application/json'
+        else:
+            headers['Content-Type'] = (
+                'application/x-www-form-urlencoded;charset=UTF-8')
+            data = gcm.urlencode_utf8(data)
+
+        try:
+            status, response_headers, response = self._pool.request(
+                'POST', data, headers)
+        except (socket.error, httplib.HTTPException):
+            raise gcm.GCMConnectionException(
+                "The connection to the GCM server failed")
+
+        if status == 400:
+            raise gcm.GCMMalformedJsonException(
+                "The request could not be parsed as JSON")
+        elif status == 401:
+            raise gcm.GCMAuthenticationException(
+                "There was an error authenticating the sender account")
+        elif status != 200:
+            raise GCMUnavailableException(
+                "GCM service error: %d" % status,
+                retry_after=parse_retry_after(
+                    response_headers.get('Retry-After')))
+
+        if is_json:
+            response = json.loads(response)
+        return response
+
+    def json_request(self, registration_ids, data=None, collapse_key=None,
+                     delay_while_idle=False, time_to_live=None):
+        """
+        Makes a single JSON request to GCM servers.
+
+        Unlike the client of ``python-gcm``, it neither retries the
+        registration IDs for which GCM was unavailable nor sleeps before
+        returning them in the response info; retrying them is left to the
+        caller.
+        """
+        if not registration_ids:
+            raise gcm.GCMMissingRegistrationException(
+                "Missing registration_ids")
+        if len(registration_ids) > 1000:
+            raise gcm.GCMTooManyRegIdsException(
+                "Exceded number of registration_ids")
+
+        payload = self.construct_payload(
+            registration_ids, data, collapse_key,
+            delay_while_idle, time_to_live)
+        response = self.make_request(payload, is_json=True)
+        return self.handle_json_response(response, registration_ids)
+
+    def close(self):
+        """
+        Closes the connections kept open by the client.
+        """
+        self._pool.close()
@@ -6,14 +6,22 @@ from django.conf import settings
 
 from chat.tasks import send_message_notifications
 from chat.tasks import send_confirmation_email
+from chat.tasks import validate_message
 
 
 def validate_message_signature(message):
     """
     A hook function which triggers the validation of the given
     :class:`chat.models.Message` instance.
+
+    Depending on the ``TCA_ASYNC_SIGNATURE_VALIDATION`` setting, the
+    validation is either performed right away or deferred to the
+    :func:`chat.tasks.validate_message` task, leaving the message invalid
+    until the task runs.
     """
-    if message.validate_signature():
+    if settings.TCA_ASYNC_SIGNATURE_VALIDATION:
+        validate_message.delay(message.pk)
+    elif message.validate_signature():
         send_message_notifications.delay(message.pk)
 
 
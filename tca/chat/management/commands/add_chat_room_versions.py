@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+from django.utils import six
+from django.utils import timezone
+
+from chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = (
+        'Adds the version and last_modified columns to the chat rooms table '
+        'of databases created by earlier versions, since syncdb does not '
+        'alter existing tables. Run it before serving requests with the new '
+        'version.'
+    )
+
+    columns = ('version', 'last_modified')
+
+    def log(self, text):
+        """
+        Log the given text to the console output.
+        """
+        self.stdout.write(text)
+
+    def get_default(self, field):
+        """
+        Returns the SQL literal filling the given field's new column for
+        the existing chat rooms: version 0, modified now.
+        """
+        if field.name == 'version':
+            return '0'
+        now = timezone.now().replace(microsecond=0)
+        return "'{value}'".format(
+            value=six.text_type(connection.ops.value_to_db_datetime(now)))
+
+    def handle(self, *args, **kwargs):
+        qn = connection.ops.quote_name
+        table = ChatRoom._meta.db_table
+        cursor = connection.cursor()
+        existing = [
+            column[0]
+            for column in connection.introspection.get_table_description(
+                cursor, table)
+        ]
+        fields = [
+            ChatRoom._meta.get_field(name)
+            for name in self.columns
+            if ChatRoom._meta.get_field(name).column not in existing
+        ]
+        if not fields:
+            self.log("The chat rooms table is up to date")
+            return
+
+        with transaction.atomic():
+            for field in fields:
+                cursor.execute(
+                    'ALTER TABLE {table} ADD COLUMN {column} {type} '
+                    'NOT NULL DEFAULT {default}'.format(
+                        table=qn(table),
+                        column=qn(field.column),
+                        type=field.db_type(connection),
+                        default=self.get_default(field)))
+
+        self.log("Added the columns {columns}".format(
+            columns=', '.join(field.column for field in fields)))
@@ -0,0 +1,266 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.test.utils import override_settings
+
+from chat.fake_gcm import FakeGcmServer
+from chat.metrics import get_counters
+from chat.models import ChatRoom
+from chat.models import Device
+from chat.models import Member
+from chat.models import Message
+from chat.tasks import send_message_notifications
+
+from tca.celery import app
+
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+import math
+import random
+import string
+import time
+
+
+def percentile(values, fraction):
+    """
+    Returns the given percentile of the values (nearest-rank method).
+
+    :param fraction: The percentile as a fraction between 0 and 1
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(fraction * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures the throughput and latency of sending GCM notifications '
+        'by running the send_message_notifications task at a fixed rate '
+        'against a local GCM stand-in server.'
+    )
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--rate',
+            type='float',
+            dest='rate',
+            default=10,
+            help='The number of messages notified per second'),
+        make_option(
+            '--duration',
+            type='float',
+            dest='duration',
+            default=10,
+            help='The number of seconds to run the benchmark for'),
+        make_option(
+            '--room-size',
+            type='int',
+            dest='room_size',
+            default=100,
+            help='The number of members of the chat room'),
+        make_option(
+            '--workers',
+            type='int',
+            dest='workers',
+            default=4,
+            help='The number of tasks run concurrently, as by Celery workers'),
+        make_option(
+            '--url',
+            dest='url',
+            default=None,
+            help='The URL of an already running GCM stand-in server'),
+        make_option(
+            '--latency',
+            type='float',
+            dest='latency',
+            default=0.05,
+            help='The latency of the started GCM stand-in server'),
+        make_option(
+            '--error-rate',
+            type='float',
+            dest='error_rate',
+            default=0,
+            help='The error rate of the started GCM stand-in server'),
+        make_option(
+            '--canonical-rate',
+            type='float',
+            dest='canonical_rate',
+            default=0,
+            help='The canonical ID rate of the started GCM stand-in server'),
+    )
+
+    def log(self, text):
+        """
+        Log the given text to the console output.
+        """
+        self.stdout.write(text)
+
+    #: LRZ IDs consist of letters and digits only, so members whose LRZ ID
+    #: starts with this prefix can only have been created by the benchmark
+    lrz_id_prefix = '_'
+
+    def get_tag(self):
+        """
+        Returns a prefix of LRZ IDs which no existing member uses.
+        """
+        tags = [
+            self.lrz_id_prefix + character
+            for character in string.ascii_lowercase + string.digits
+        ]
+        random.shuffle(tags)
+        for tag in tags:
+            if not Member.objects.filter(lrz_id__startswith=tag).exists():
+                return tag
+
+        raise CommandError(
+            "Delete the members left behind by earlier benchmarks first")
+
+    def set_up_chat_room(self, room_size, message_count):
+        """
+        Creates a chat room with the given number of members, each with
+        a registration ID, and the given number of messages posted to it.
+
+        :returns: A tuple of the chat room, the IDs of the created members
+            and the IDs of its messages
+        """
+        tag = self.get_tag()
+        lrz_ids = [
+            '{tag}{index:05d}'.format(tag=tag, index=index)
+            for index in range(room_size + 1)
+        ]
+        Member.objects.bulk_create([
+            Member(lrz_id=lrz_id)
+            for lrz_id in lrz_ids
+        ])
+        members = list(
+            Member.objects.filter(lrz_id__in=lrz_ids).order_by('pk'))
+        member_ids = [member.pk for member in members]
+        Device.objects.bulk_create([
+            Device(
+                member=member,
+                registration_id='benchmark-{lrz_id}'.format(
+                    lrz_id=member.lrz_id))
+            for member in members
+        ])
+
+        chat_room = ChatRoom.objects.create(
+            name='benchmark-{tag}-{time}'.format(tag=tag, time=time.time()))
+        chat_room.members.add(*members)
+
+        # The messages are posted by a member who does not get notified
+        sender = members[0]
+        Message.objects.bulk_create([
+            Message(
+                text='Benchmark message {index}'.format(index=index),
+                member=sender,
+                chat_room=chat_room,
+                valid=True)
+            for index in range(message_count)
+        ])
+        message_ids = list(
+            chat_room.messages.order_by('pk').values_list('pk', flat=True))
+
+        return chat_room, member_ids, message_ids
+
+    def tear_down_chat_room(self, chat_room, member_ids):
+        """
+        Deletes the chat room created for the benchmark, along with its
+        messages and the members with the given IDs created for it.
+        """
+        chat_room.messages.all().delete()
+        chat_room.delete()
+        Member.objects.filter(pk__in=member_ids).delete()
+
+    def notify(self, message_id, scheduled):
+        """
+        Runs the notification task for the given message and returns the
+        number of seconds since the task was scheduled to run.
+        """
+        send_message_notifications(message_id)
+        return time.time() - scheduled
+
+    def run_benchmark(self, message_ids, rate, workers):
+        """
+        Runs the notification task for each of the given messages at the
+        given rate on a pool of workers.
+
+        :returns: A tuple of the latencies of the tasks and the number of
+            seconds it took to run all of them
+        """
+        pool = ThreadPool(workers)
+        interval = 1.0 / rate
+        start = time.time()
+        results = []
+        for index, message_id in enumerate(message_ids):
+            scheduled = start + index * interval
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            results.append(
+                pool.apply_async(self.notify, (message_id, scheduled)))
+        pool.close()
+        pool.join()
+
+        return [result.get() for result in results], time.time() - start
+
+    def get_settings(self, url):
+        """
+        Returns the settings the benchmark runs with: GCM notifications
+        sent to the given URL and no other notifier, so that the synthetic
+        messages reach neither connected clients nor webhook endpoints.
+        """
+        return {
+            'TCA_GCM_URL': url,
+            'TCA_GCM_API_KEY': 'benchmark',
+            'TCA_ENABLE_GCM_NOTIFICATIONS': True,
+            'TCA_ENABLE_STREAMING_NOTIFICATIONS': False,
+            'TCA_WEBHOOK_ENDPOINTS': (),
+        }
+
+    def handle(self, *args, **kwargs):
+        server = None
+        url = kwargs['url']
+        if url is None:
+            server = FakeGcmServer(
+                latency=kwargs['latency'],
+                error_rate=kwargs['error_rate'],
+                canonical_rate=kwargs['canonical_rate'])
+            server.start()
+            url = server.url
+
+        # Run the retries and the registration ID updates right away
+        # instead of queueing them
+        app.conf.CELERY_ALWAYS_EAGER = True
+
+        message_count = max(int(kwargs['rate'] * kwargs['duration']), 1)
+        chat_room, member_ids, message_ids = self.set_up_chat_room(
+            kwargs['room_size'], message_count)
+        counters = {
+            counter.name: counter.get()
+            for counter in get_counters()
+        }
+        try:
+            with override_settings(**self.get_settings(url)):
+                latencies, elapsed = self.run_benchmark(
+                    message_ids, kwargs['rate'], kwargs['workers'])
+        finally:
+            self.tear_down_chat_room(chat_room, member_ids)
+            if server is not None:
+                server.stop()
+
+        self.log("Notified {count} messages to {size} members in {elapsed:.2f}s"
+                 .format(count=len(latencies), size=kwargs['room_size'],
+                         elapsed=elapsed))
+        self.log("Throughput: {throughput:.2f} messages/s".format(
+            throughput=len(latencies) / elapsed))
+        for name, fraction in (('p50', .5), ('p90', .9), ('p99', .99)):
+            self.log("Latency {name}: {latency:.1f}ms".format(
+                name=name, latency=percentile(latencies, fraction) * 1000))
+        self.log("Latency max: {latency:.1f}ms".format(
+            latency=max(latencies) * 1000))
+        for counter in get_counters():
+            self.log("{name}: {value}".format(
+                name=counter.name,
+                value=counter.get() - counters[counter.name]))
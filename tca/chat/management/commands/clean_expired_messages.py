@@ -4,6 +4,7 @@ from django.core.management.base import (
 )
 
 from chat.models import Message
+from chat.models import ChatRoom
 
 from django.utils import timezone
 from django.conf import settings
@@ -27,8 +28,10 @@ class Command(BaseCommand):
         # Keep the count of the messages in order to display a status
         # message later on
         count = qs.count()
+        chat_room_ids = set(qs.values_list('chat_room', flat=True))
 
         qs.delete()
+        ChatRoom.objects.mark_modified(*chat_room_ids)
 
         self.log("Deleted {count} expired messages".format(
             count=count))
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection
+from django.db import DatabaseError
+from django.db import transaction
+
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates the multi-column indexes of the messages table on databases '
+        'created by earlier versions, since syncdb does not alter existing '
+        'tables. Indexes which already exist are left alone.'
+    )
+
+    def log(self, text):
+        """
+        Log the given text to the console output.
+        """
+        self.stdout.write(text)
+
+    def get_indexes(self):
+        """
+        Returns a list of ``(field_names, statements)`` tuples giving the
+        statements creating each index of ``Meta.index_together`` of the
+        :class:`chat.models.Message` model.
+        """
+        return [
+            (field_names, connection.creation.sql_indexes_for_fields(
+                Message,
+                [Message._meta.get_field(name) for name in field_names],
+                no_style()))
+            for field_names in Message._meta.index_together
+        ]
+
+    def handle(self, *args, **kwargs):
+        cursor = connection.cursor()
+        for field_names, statements in self.get_indexes():
+            # There is no portable way of looking up indexes by their name,
+            # so an index whose creation fails is taken to exist already
+            try:
+                with transaction.atomic():
+                    for statement in statements:
+                        cursor.execute(statement)
+            except DatabaseError as exc:
+                self.log("Skipped the index on {fields}: {error}".format(
+                    fields=', '.join(field_names), error=exc))
+            else:
+                self.log("Created the index on {fields}".format(
+                    fields=', '.join(field_names)))
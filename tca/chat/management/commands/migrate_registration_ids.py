@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+
+from optparse import make_option
+
+from chat.models import Device
+from chat.models import Member
+
+import json
+
+
+def copy_registration_ids(rows):
+    """
+    Creates a :class:`chat.models.Device` for each registration ID found in
+    the given rows, unless the member already has such a device.
+
+    :param rows: An iterable of ``(member_id, registration_ids)`` tuples,
+        where ``registration_ids`` is the JSON encoded list of the member's
+        registration IDs.
+
+    :returns: The number of created devices
+    """
+    existing = set(Device.objects.values_list('member', 'registration_id'))
+    devices = []
+    for member_id, registration_ids in rows:
+        for registration_id in json.loads(registration_ids or '[]'):
+            if (member_id, registration_id) in existing:
+                continue
+            existing.add((member_id, registration_id))
+            devices.append(Device(
+                member_id=member_id,
+                registration_id=registration_id))
+
+    Device.objects.bulk_create(devices, batch_size=1000)
+    return len(devices)
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves the registration IDs found in the registration_ids column of '
+        'the members table, used by earlier versions, to the devices table '
+        'and drops the column. Run it after syncdb created the devices table.'
+    )
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--keep-column',
+            action='store_true',
+            dest='keep_column',
+            default=False,
+            help='Do not drop the registration_ids column'),
+    )
+
+    column = 'registration_ids'
+
+    def log(self, text):
+        """
+        Log the given text to the console output.
+        """
+        self.stdout.write(text)
+
+    def handle(self, *args, **kwargs):
+        table = connection.ops.quote_name(Member._meta.db_table)
+        cursor = connection.cursor()
+        columns = [
+            column[0]
+            for column in connection.introspection.get_table_description(
+                cursor, Member._meta.db_table)
+        ]
+        if self.column not in columns:
+            self.log("There are no registration IDs to migrate")
+            return
+
+        with transaction.atomic():
+            cursor.execute('SELECT id, {column} FROM {table}'.format(
+                column=self.column, table=table))
+            count = copy_registration_ids(cursor.fetchall())
+            if not kwargs['keep_column']:
+                cursor.execute('ALTER TABLE {table} DROP COLUMN {column}'.format(
+                    table=table, column=self.column))
+
+        self.log("Migrated {count} registration IDs".format(count=count))
@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand
+
+from chat.fake_gcm import FakeGcmServer
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs a local stand-in for the GCM service. Point the TCA_GCM_URL '
+        'setting to it in order to send notifications to it.'
+    )
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--host',
+            dest='host',
+            default='127.0.0.1',
+            help='The address the server listens on'),
+        make_option(
+            '--port',
+            type='int',
+            dest='port',
+            default=8765,
+            help='The port the server listens on'),
+        make_option(
+            '--latency',
+            type='float',
+            dest='latency',
+            default=0,
+            help='The number of seconds it takes to answer a request'),
+        make_option(
+            '--error-rate',
+            type='float',
+            dest='error_rate',
+            default=0,
+            help='The fraction of requests answered by an error'),
+        make_option(
+            '--canonical-rate',
+            type='float',
+            dest='canonical_rate',
+            default=0,
+            help='The fraction of registration IDs given a canonical ID'),
+        make_option(
+            '--not-registered-rate',
+            type='float',
+            dest='not_registered_rate',
+            default=0,
+            help='The fraction of registration IDs reported unregistered'),
+    )
+
+    def log(self, text):
+        """
+        Log the given text to the console output.
+        """
+        self.stdout.write(text)
+
+    def handle(self, *args, **kwargs):
+        server = FakeGcmServer(
+            (kwargs['host'], kwargs['port']),
+            latency=kwargs['latency'],
+            error_rate=kwargs['error_rate'],
+            canonical_rate=kwargs['canonical_rate'],
+            not_registered_rate=kwargs['not_registered_rate'],
+            verbose=int(kwargs['verbosity']) > 1)
+
+        self.log("Serving GCM requests at {url}".format(url=server.url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from optparse import make_option
+
+from chat.metrics import get_counters
+from chat.metrics import get_timers
+
+# Make sure the modules defining metrics are loaded
+import chat.notifiers
+import chat.tasks
+
+
+class Command(BaseCommand):
+    help = 'Displays the current values of the metrics collected by the app'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--reset',
+            action='store_true',
+            dest='reset',
+            default=False,
+            help='Reset the metrics after displaying them'),
+    )
+
+    def log(self, text):
+        """
+        Log the given text to the console output.
+        """
+        self.stdout.write(text)
+
+    def handle(self, *args, **kwargs):
+        for counter in get_counters():
+            self.log("{name}: {value}".format(
+                name=counter.name,
+                value=counter.get()))
+            if kwargs['reset']:
+                counter.reset()
+        for timer in get_timers():
+            count, total = timer.get()
+            self.log("{name}: {count} in {total} ms".format(
+                name=timer.name,
+                count=count,
+                total=total))
+            if kwargs['reset']:
+                timer.reset()
@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.tasks import validate_backlog
+
+from optparse import make_option
+
+import multiprocessing
+
+
+class Command(BaseCommand):
+    help = 'Validates the signatures of all messages which are not yet valid'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--chunk-size',
+            type='int',
+            dest='chunk_size',
+            default=None,
+            help='The number of messages to validate at once'),
+        make_option(
+            '--processes',
+            type='int',
+            dest='processes',
+            default=None,
+            help='The number of processes used to validate signatures'),
+    )
+
+    def log(self, text):
+        """
+        Log the given text to the console output.
+        """
+        self.stdout.write(text)
+
+    def handle(self, *args, **kwargs):
+        processes = kwargs['processes']
+        if processes is None:
+            processes = settings.TCA_SIGNATURE_VALIDATION_PROCESSES
+
+        # A single pool is used for all chunks of messages
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        try:
+            count = validate_backlog(
+                chunk_size=kwargs['chunk_size'], pool=pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.log("Validated {count} messages".format(count=count))
@@ -0,0 +1,122 @@
+"""
+Module contains simple counters and timers which can be used to expose
+operational metrics of the app (e.g. the number of retried GCM requests).
+
+The metrics are kept in Django's cache, so that they are shared by all
+processes using the same cache backend. They can be displayed by the
+``show_metrics`` management command.
+"""
+
+from django.core.cache import cache
+
+from collections import OrderedDict
+
+_counters = OrderedDict()
+_timers = OrderedDict()
+
+
+def _increment(key, value):
+    """
+    Increments the value cached under the given key, initializing it if
+    it does not exist yet.
+    """
+    try:
+        cache.incr(key, value)
+    except ValueError:
+        # The value does not exist yet
+        if not cache.add(key, value, timeout=None):
+            cache.incr(key, value)
+
+
+class Counter(object):
+    """
+    A counter identified by its name.
+
+    Counters are registered when they are created, so they should be
+    created at the module level of the modules using them.
+    """
+    def __init__(self, name, description=''):
+        self.name = name
+        self.description = description
+        _counters[name] = self
+
+    @property
+    def key(self):
+        return 'tca-metric-{name}'.format(name=self.name)
+
+    def increment(self, value=1):
+        """
+        Increments the counter by the given value.
+        """
+        _increment(self.key, value)
+
+    def get(self):
+        """
+        Returns the current value of the counter.
+        """
+        return cache.get(self.key, 0)
+
+    def reset(self):
+        """
+        Resets the counter to zero.
+        """
+        cache.delete(self.key)
+
+
+class Timer(object):
+    """
+    A timer identified by its name, which records the number of timed
+    operations and their total duration.
+
+    Timers are registered when they are created, just like counters.
+    """
+    def __init__(self, name, description=''):
+        self.name = name
+        self.description = description
+        _timers[name] = self
+
+    @property
+    def count_key(self):
+        return 'tca-metric-{name}-count'.format(name=self.name)
+
+    @property
+    def total_key(self):
+        return 'tca-metric-{name}-total-ms'.format(name=self.name)
+
+    def record(self, duration):
+        """
+        Records a single operation which took the given number of seconds.
+        """
+        _increment(self.count_key, 1)
+        _increment(self.total_key, int(duration * 1000))
+
+    def get(self):
+        """
+        Returns a ``(count, total)`` tuple of the number of recorded
+        operations and their total duration in milliseconds.
+        """
+        values = cache.get_many([self.count_key, self.total_key])
+        return (
+            values.get(self.count_key, 0),
+            values.get(self.total_key, 0),
+        )
+
+    def reset(self):
+        """
+        Resets the timer.
+        """
+        cache.delete_many([self.count_key, self.total_key])
+
+
+def get_counters():
+    """
+    Returns a list of all registered counters.
+    """
+    return list(_counters.values())
+
+
+def get_timers():
+    """
+    Returns a list of all registered timers.
+    """
+    return list(_timers.values())
@@ -1,27 +1,38 @@
 from __future__ import unicode_literals
 
+from django.db import connection
 from django.db import models
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_syncdb
+from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils import timezone
 from django.utils.functional import cached_property
 
 from django.core.urlresolvers import reverse
+from django.core.cache import cache
 from django.conf import settings
 
 from jsonfield import JSONField
 
 from chat import crypto
+from chat.broker import get_broker
+from chat.broker import get_chat_room_channel
+
+from collections import OrderedDict
+from collections import defaultdict
 
 import random
 import string
 import datetime
+import time
 
 
 @python_2_unicode_compatible
 class Member(models.Model):
     lrz_id = models.CharField(max_length=7, unique=True)
     display_name = models.CharField(max_length=150, blank=True)
-    registration_ids = JSONField(default=())
 
     def __str__(self):
         if self.display_name.strip():
@@ -43,6 +54,105 @@ class Member(models.Model):
 
         return TEMPLATE.format(lrz_id=self.lrz_id)
 
+    @property
+    def registration_ids(self):
+        """
+        Returns a list of the GCM registration IDs of the member's devices,
+        in the order in which they were registered.
+        """
+        return list(
+            self.devices.order_by('pk').values_list(
+                'registration_id', flat=True))
+
+    def invalidate_registration_ids(self):
+        """
+        Removes the cached registration IDs of the member's chat rooms.
+
+        This needs to be done whenever the member's devices change.
+        """
+        ChatRoom.objects.invalidate_registration_ids(
+            *self.chat_rooms.values_list('pk', flat=True))
+
+
+class DeviceManager(models.Manager):
+    """
+    A custom manager for the :class:`Device` model.
+
+    Registering and unregistering devices are idempotent operations which
+    lock the member's row, so that concurrent changes of the same member's
+    devices are applied one after another.
+    """
+    def _lock_member(self, member):
+        list(Member.objects.select_for_update().filter(
+            pk=member.pk).values_list('pk', flat=True))
+
+    def register(self, member, registration_ids):
+        """
+        Makes sure that the given member has a device for each of the given
+        registration IDs.
+
+        :returns: The number of newly registered devices
+        """
+        with transaction.atomic():
+            self._lock_member(member)
+            existing = set(self.filter(
+                member=member,
+                registration_id__in=registration_ids).values_list(
+                    'registration_id', flat=True))
+            new_ids = [
+                registration_id
+                for registration_id in OrderedDict.fromkeys(registration_ids)
+                if registration_id not in existing
+            ]
+            self.bulk_create([
+                Device(member=member, registration_id=registration_id)
+                for registration_id in new_ids
+            ])
+
+        if new_ids:
+            member.invalidate_registration_ids()
+        return len(new_ids)
+
+    def unregister(self, member, registration_ids):
+        """
+        Removes the devices of the given member with the given registration
+        IDs, if there are any.
+
+        :returns: The number of removed devices
+        """
+        with transaction.atomic():
+            self._lock_member(member)
+            devices = self.filter(
+                member=member, registration_id__in=registration_ids)
+            count = devices.count()
+            if count:
+                devices.delete()
+
+        if count:
+            member.invalidate_registration_ids()
+        return count
+
+
+@python_2_unicode_compatible
+class Device(models.Model):
+    """
+    Model representing an Android device of a member, identified by its
+    GCM registration ID.
+    """
+    member = models.ForeignKey(Member, related_name='devices')
+    registration_id = models.CharField(max_length=255, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = DeviceManager()
+
+    class Meta:
+        unique_together = (
+            ('member', 'registration_id'),
+        )
+
+    def __str__(self):
+        return self.registration_id
+
 
 @python_2_unicode_compatible
 class PublicKey(models.Model):
@@ -64,6 +174,15 @@ class PublicKey(models.Model):
             'pk': self.pk,
         })
 
+    def save(self, *args, **kwargs):
+        """
+        A custom implementation of the ``save`` method which makes sure
+        that a stale parsed representation of the key is not kept in the
+        cache of parsed keys (e.g. when the key is deactivated).
+        """
+        crypto.key_cache.invalidate(self.key_text)
+        super(PublicKey, self).save(*args, **kwargs)
+
 
 def _random_string(length=30):
     """
@@ -118,10 +237,200 @@ class PublicKeyConfirmation(models.Model):
         self.delete()
 
 
+class ChatRoomManager(models.Manager):
+    """
+    A custom manager for the :class:`ChatRoom` model.
+    """
+    def mark_modified(self, *chat_room_ids):
+        """
+        Marks the chat rooms with the given IDs as modified by incrementing
+        their version and updating their modification time.
+
+        This needs to be done whenever the messages or the members of a
+        chat room change, since clients rely on the version to find out
+        whether the resources they already have are stale.
+        """
+        if not chat_room_ids:
+            return
+
+        self.filter(pk__in=chat_room_ids).update(
+            version=models.F('version') + 1,
+            last_modified=timezone.now())
+
+    def _get_registration_ids_generation_key(self, chat_room_id):
+        return 'tca-chat-room-registration-ids-generation-{id}'.format(
+            id=chat_room_id)
+
+    def _get_registration_ids_generation(self, chat_room_id):
+        """
+        Returns the generation of the cached registration IDs of the chat
+        room with the given ID, which is incremented whenever they are
+        invalidated.
+        """
+        key = self._get_registration_ids_generation_key(chat_room_id)
+        generation = cache.get(key)
+        if generation is None:
+            # Start from a value which an evicted generation never had, so
+            # that mappings cached by earlier generations are never used
+            generation = int(time.time() * 1000000)
+            if not cache.add(key, generation, None):
+                generation = cache.get(key, generation)
+
+        return generation
+
+    def _get_registration_ids_cache_key(self, chat_room_id):
+        return 'tca-chat-room-registration-ids-{id}-{generation}'.format(
+            id=chat_room_id,
+            generation=self._get_registration_ids_generation(chat_room_id))
+
+    def get_registration_ids(self, chat_room_id):
+        """
+        Returns a dict mapping the IDs of the members of the chat room with
+        the given ID to their GCM registration IDs. Members without any
+        registration IDs are left out.
+
+        The mapping is kept in Django's cache so that notifying the members
+        of a chat room does not normally need to query the database.
+        The cache key includes the generation of the mapping, so a mapping
+        read before it was invalidated is never used afterwards, even if it
+        is cached after the invalidation.
+        """
+        key = self._get_registration_ids_cache_key(chat_room_id)
+        registration_ids = cache.get(key)
+        if registration_ids is None:
+            # A single query joining the devices with the memberships
+            devices = Device.objects.filter(
+                member__chat_rooms=chat_room_id).order_by('pk')
+            registration_ids = defaultdict(list)
+            for member_id, registration_id in devices.values_list(
+                    'member', 'registration_id'):
+                registration_ids[member_id].append(registration_id)
+            registration_ids = dict(registration_ids)
+            cache.set(
+                key, registration_ids,
+                settings.TCA_REGISTRATION_IDS_CACHE_TIMEOUT)
+
+        return registration_ids
+
+    def invalidate_registration_ids(self, *chat_room_ids):
+        """
+        Invalidates the cached registration IDs of the chat rooms with the
+        given IDs, by moving them to a new generation.
+
+        This needs to be done whenever the members of a chat room or their
+        registration IDs change.
+        """
+        for chat_room_id in chat_room_ids:
+            try:
+                cache.incr(
+                    self._get_registration_ids_generation_key(chat_room_id))
+            except ValueError:
+                # Without a generation, no mapping is used anyway
+                pass
+
+    def for_member(self, member_id, since_id=None):
+        """
+        Returns a queryset of the chat rooms of the member with the given ID.
+
+        Each chat room is annotated with the ``latest_message_id``, the ID
+        of the newest message in the chat room (``None`` if there are no
+        messages), and the ``unread_count``, the number of messages posted
+        by other members after the message with the given ``since_id``.
+        Both are computed by the same query that selects the chat rooms.
+        """
+        quote_name = connection.ops.quote_name
+        names = {
+            'message': quote_name(Message._meta.db_table),
+            'chat_room': quote_name(self.model._meta.db_table),
+        }
+        latest_message_id = (
+            'SELECT MAX({message}.id) FROM {message} '
+            'WHERE {message}.chat_room_id = {chat_room}.id'
+        ).format(**names)
+        unread_count = (
+            'SELECT COUNT(*) FROM {message} '
+            'WHERE {message}.chat_room_id = {chat_room}.id '
+            'AND {message}.id > %s AND {message}.member_id <> %s'
+        ).format(**names)
+
+        return self.filter(members=member_id).extra(
+            select=OrderedDict((
+                ('latest_message_id', latest_message_id),
+                ('unread_count', unread_count),
+            )),
+            select_params=(since_id or 0, member_id),
+        ).order_by('pk')
+
+    def _lock(self, chat_room):
+        list(self.select_for_update().filter(
+            pk=chat_room.pk).values_list('pk', flat=True))
+
+    def add_members(self, chat_room, members):
+        """
+        Adds the given members to the chat room, inserting all of their
+        memberships by a single query.
+
+        The chat room's row is locked meanwhile, so that concurrent changes
+        of its members are applied one after another.
+
+        :returns: A list of the given members which were not members of the
+            chat room before
+        """
+        through = self.model.members.through
+        with transaction.atomic():
+            self._lock(chat_room)
+            existing = set(through.objects.filter(
+                chatroom=chat_room,
+                member__in=members).values_list('member', flat=True))
+            added = list(OrderedDict(
+                (member.pk, member)
+                for member in members
+                if member.pk not in existing
+            ).values())
+            through.objects.bulk_create([
+                through(chatroom=chat_room, member=member)
+                for member in added
+            ])
+
+        if added:
+            self.invalidate_registration_ids(chat_room.pk)
+        return added
+
+    def remove_members(self, chat_room, members):
+        """
+        Removes the given members from the chat room by a single query.
+
+        :returns: A list of the given members which were members of the
+            chat room before
+        """
+        through = self.model.members.through
+        with transaction.atomic():
+            self._lock(chat_room)
+            memberships = through.objects.filter(
+                chatroom=chat_room, member__in=members)
+            existing = set(memberships.values_list('member', flat=True))
+            memberships.delete()
+
+        if existing:
+            self.invalidate_registration_ids(chat_room.pk)
+        return list(OrderedDict(
+            (member.pk, member)
+            for member in members
+            if member.pk in existing
+        ).values())
+
+
 @python_2_unicode_compatible
 class ChatRoom(models.Model):
     name = models.CharField(max_length=100, unique=True)
     members = models.ManyToManyField(Member, related_name='chat_rooms')
+    #: A counter incremented whenever the messages or the members of the
+    #: chat room change
+    version = models.PositiveIntegerField(default=0, editable=False)
+    #: The time of the last change of the chat room's messages or members
+    last_modified = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = ChatRoomManager()
 
     def __str__(self):
         return self.name
@@ -143,7 +452,14 @@ class Message(models.Model):
 
     class Meta:
         # Make the default order display the newest messages first
-        ordering = ['-timestamp']
+        ordering = ['-timestamp', '-id']
+        # Support paging through the history of a chat room by the
+        # messages' timestamps
+        index_together = [
+            ['chat_room', 'timestamp', 'id'],
+            # Find the newest and count the unread messages of chat rooms
+            ['chat_room', 'id'],
+        ]
 
     def __str__(self):
         return '{text} ({member})'.format(
@@ -153,10 +469,31 @@ class Message(models.Model):
 
     def get_absolute_url(self):
         return reverse('message-detail', kwargs={
-            'chat_room': self.chat_room.pk,
+            'chat_room': self.chat_room_id,
             'pk': self.pk,
         })
 
+    def save(self, *args, **kwargs):
+        """
+        A custom implementation of the ``save`` method which marks the
+        chat room of the message as modified and lets anyone waiting for
+        changes in the chat room know about it.
+        """
+        super(Message, self).save(*args, **kwargs)
+        ChatRoom.objects.mark_modified(self.chat_room_id)
+        get_broker().publish(get_chat_room_channel(self.chat_room_id), {
+            'id': self.pk,
+        })
+
+    def delete(self, *args, **kwargs):
+        """
+        A custom implementation of the ``delete`` method which marks the
+        chat room of the message as modified.
+        """
+        chat_room_id = self.chat_room_id
+        super(Message, self).delete(*args, **kwargs)
+        ChatRoom.objects.mark_modified(chat_room_id)
+
     @property
     def valid_signature(self):
         """
@@ -227,6 +564,66 @@ class SystemMessageManager(models.Manager):
         text = "{member} has left the chat room.".format(member=member)
         return self.create(text=text, chat_room=chat_room)
 
+    def _bulk_create_member_messages(self, members, chat_room, summarize,
+                                     template, summary_template):
+        if not members:
+            return []
+        if summarize and len(members) > 1:
+            texts = [summary_template.format(count=len(members))]
+        else:
+            texts = [template.format(member=member) for member in members]
+
+        # Proxy models cannot be bulk created, hence the plain messages
+        SystemMessage.check_bot_cache()
+        bot_id = SystemMessage.get_bot_id()
+        messages = [
+            Message(
+                text=text, chat_room=chat_room, member_id=bot_id, valid=True)
+            for text in texts
+        ]
+        Message.objects.bulk_create(messages)
+        # Saving the messages one by one would have done this for each
+        ChatRoom.objects.mark_modified(chat_room.pk)
+        newest_id = chat_room.messages.order_by('-pk').values_list(
+            'pk', flat=True)[:1]
+        get_broker().publish(get_chat_room_channel(chat_room.pk), {
+            'id': newest_id[0] if newest_id else None,
+        })
+
+        return messages
+
+    def bulk_create_members_joined(self, members, chat_room,
+                                   summarize=False):
+        """
+        A method which creates the system messages indicating that the
+        given members have joined a chat room, by a single query.
+
+        :param members: a list of :class:`Member` instances of the members
+            that have joined the chat room
+        :param chat_room: a :class:`ChatRoom` instance to which the members
+            have joined
+        :param summarize: whether a single message telling the number of
+            members that have joined should be created instead of one
+            message for each member
+        """
+        return self._bulk_create_member_messages(
+            members, chat_room, summarize,
+            "{member} has joined the chat room.",
+            "{count} members have joined the chat room.")
+
+    def bulk_create_members_left(self, members, chat_room, summarize=False):
+        """
+        A method which creates the system messages indicating that the
+        given members have left a chat room, by a single query.
+
+        The parameters are the same as those of
+        :meth:`bulk_create_members_joined`.
+        """
+        return self._bulk_create_member_messages(
+            members, chat_room, summarize,
+            "{member} has left the chat room.",
+            "{count} members have left the chat room.")
+
 
 class SystemMessage(Message):
     """
@@ -239,6 +636,8 @@ class SystemMessage(Message):
         "display_name": "Bot",
         "lrz_id": "bot",
     }
+    #: The primary key of the bot user, cached by :meth:`get_bot_id`
+    _bot_id = None
 
     def __init__(self, *args, **kwargs):
         """
@@ -249,7 +648,10 @@ class SystemMessage(Message):
         an associated signature.
         """
         super(SystemMessage, self).__init__(*args, **kwargs)
-        self.set_default_values()
+        # Instances built from database rows are given the values of their
+        # fields as positional arguments and already have the defaults
+        if not args:
+            self.set_default_values()
 
     #: Override the default manager
     objects = SystemMessageManager()
@@ -266,7 +668,10 @@ class SystemMessage(Message):
         the linked member be the system's "Bot".
         """
         self.valid = True
-        self.member = self.bot_user
+        bot_id = self.get_bot_id()
+        if self.member_id != bot_id:
+            # The fields of the bot are known, so it need not be queried
+            self.member = Member(pk=bot_id, **self._bot_description)
 
     @cached_property
     def bot_user(self):
@@ -290,12 +695,81 @@ class SystemMessage(Message):
         bot, _ = Member.objects.get_or_create(**cls._bot_description)
         return bot
 
+    @classmethod
+    def get_bot_id(cls):
+        """
+        Method returns the primary key of the bot user.
+
+        The bot user is looked up (and created, if necessary) only once per
+        process. Since the cached value is a plain integer, it remains valid
+        in processes forked after it was obtained. Saving system messages
+        looks the bot user up again if the cached one no longer exists.
+        """
+        if cls._bot_id is None:
+            cls._bot_id = cls.get_bot_user().pk
+
+        return cls._bot_id
+
+    @classmethod
+    def clear_bot_cache(cls):
+        """
+        Method discards the cached primary key of the bot user, making sure
+        it is looked up again when it is needed next.
+        """
+        cls._bot_id = None
+
+    @classmethod
+    def check_bot_cache(cls):
+        """
+        Method discards the cached primary key of the bot user if the bot
+        user no longer exists, for instance because another process
+        deleted it.
+
+        Foreign keys may only be checked when the transaction commits, so
+        the bot user needs to be checked before it is referenced.
+        """
+        if cls._bot_id is None:
+            return
+        if not Member.objects.filter(pk=cls._bot_id).exists():
+            cls.clear_bot_cache()
+
     def save(self, *args, **kwargs):
         """
         A custom implementation of the ``save`` method which overrides the
         member field to signify that the message was emitted by the system.
         """
         # The member and valid field cannot deviate from their defaults!
+        self.check_bot_cache()
         self.set_default_values()
         # Now let the super save method handle saving the model
         super(SystemMessage, self).save(*args, **kwargs)
+
+
+@receiver(post_delete, sender=Member)
+def _clear_bot_cache(sender, instance, **kwargs):
+    if instance.pk == SystemMessage._bot_id:
+        SystemMessage.clear_bot_cache()
+
+
+@receiver(post_syncdb)
+def _clear_bot_cache_on_flush(sender, **kwargs):
+    # Sent when the database is flushed as well
+    SystemMessage.clear_bot_cache()
+
+
+@python_2_unicode_compatible
+class WebhookEvent(models.Model):
+    """
+    Model storing an event destined for a webhook endpoint, which could not
+    be kept in the endpoint's in-memory queue (see
+    :class:`chat.webhooks.WebhookQueue`) or could not be posted to it.
+
+    The stored events are posted once the endpoint catches up and are
+    deleted afterwards.
+    """
+    endpoint = models.CharField(max_length=255, db_index=True)
+    data = JSONField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{endpoint} #{id}'.format(endpoint=self.endpoint, id=self.pk)
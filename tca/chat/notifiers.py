@@ -4,13 +4,45 @@ notifying users of newly sent messages.
 """
 
 from django.conf import settings
+from django.core.cache import cache
+from django.utils.text import Truncator
 
-from gcm import GCM
+from celery.signals import worker_process_init
+from celery.signals import worker_process_shutdown
+
+from gcm import gcm
+from multiprocessing.pool import ThreadPool
 import json
+import logging
+import os
+import random
+import threading
 
-from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
 
+from chat.models import ChatRoom
 from chat.serializers import ListMessageSerializer
+from chat.broker import get_broker
+from chat.broker import get_chat_room_stream_channel
+from chat.gcm_client import GCM
+from chat.metrics import Counter
+from chat.metrics import Timer
+from chat.webhooks import WebhookQueue
+
+logger = logging.getLogger(__name__)
+
+gcm_requests = Counter(
+    'gcm.requests', "Requests sent to GCM")
+gcm_failed_requests = Counter(
+    'gcm.failed_requests', "Requests to GCM which failed")
+gcm_retries = Counter(
+    'gcm.retries', "Retries of failed GCM notifications scheduled")
+gcm_retried_registration_ids = Counter(
+    'gcm.retried_registration_ids',
+    "Registration IDs for which a retry was scheduled")
+gcm_dropped_registration_ids = Counter(
+    'gcm.dropped_registration_ids',
+    "Registration IDs given up on after the maximum number of attempts")
 
 
 class NotifierMeta(type):
@@ -25,6 +57,9 @@ class NotifierMeta(type):
             cls.notifiers = []
         else:
             cls.notifiers.append(cls)
+            cls.timer = Timer(
+                'notifiers.{name}'.format(name=name),
+                "Notifications sent by the {name}".format(name=name))
 
         cls.unregister_notifier = classmethod(
             lambda cls: cls.notifiers.remove(cls)
@@ -42,9 +77,27 @@ class BaseNotifier(object):
     All subclasses are automatically registered as notifier classes, so to
     provide an additional notification method, it is enough simply to subclass
     this base class.
+
+    Each notifier is run in a separate Celery task, so that the notifiers
+    are run concurrently and a slow or failing notifier does not affect
+    the others. A notifier which does not finish within ``timeout``
+    seconds (or ``TCA_NOTIFIER_TIMEOUT`` seconds, if it is not set) is
+    interrupted.
+
+    Notifiers which set ``coalesce`` are not notified of each message posted
+    in a quick succession, when the ``TCA_NOTIFICATION_COALESCE_MS`` setting
+    is enabled. Instead, their ``notify_coalesced`` method is called once
+    for the newest of the messages posted to a chat room within the window.
     """
     __metaclass__ = NotifierMeta
 
+    #: Whether notifications of messages posted in quick succession to a
+    #: chat room should be merged into a single one
+    coalesce = False
+    #: The number of seconds after which a notification is interrupted,
+    #: overriding the ``TCA_NOTIFIER_TIMEOUT`` setting
+    timeout = None
+
     @classmethod
     def get_instance(cls):
         """
@@ -65,12 +118,140 @@ class BaseNotifier(object):
         """
         raise NotImplementedError
 
+    @classmethod
+    def get_timeout(cls):
+        """
+        Returns the number of seconds after which a notification sent by
+        the notifier is interrupted.
+        """
+        if cls.timeout is not None:
+            return cls.timeout
+        return settings.TCA_NOTIFIER_TIMEOUT
+
     def notify(self, message):
         """
         All concrete notifiers need to implement this method
         """
         raise NotImplementedError
 
+    def notify_coalesced(self, message, count, notify_sender=False):
+        """
+        Sends a single notification of ``count`` messages posted to a chat
+        room, the newest of which is ``message``.
+
+        When ``notify_sender`` is set, some of the messages were posted by
+        members other than the sender of ``message``, who should therefore
+        be notified as well.
+
+        By default, only the newest message is notified.
+        """
+        self.notify(message)
+
+    def close(self):
+        """
+        Releases the resources held by the notifier once it is no longer
+        used.
+        """
+        pass
+
+
+_encoder = JSONEncoder()
+
+
+def to_primitive(value):
+    """
+    Converts the given serialized data to an equivalent structure of
+    primitive types (dicts, lists, strings, numbers, booleans and ``None``),
+    the same way as :class:`rest_framework.renderers.JSONRenderer` would
+    represent it, without rendering it to JSON.
+    """
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return value
+    if isinstance(value, dict):
+        return {
+            key: to_primitive(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [to_primitive(item) for item in value]
+
+    return to_primitive(_encoder.default(value))
+
+
+def _get_message_data_cache_key(message):
+    # The validity of a message is the only part of it which may change
+    return 'tca-message-data-{id}-{valid}'.format(
+        id=message.pk, valid=int(message.valid))
+
+
+def message_to_data(message):
+    """
+    Converts the given :class:`chat.models.Message` instance to a Python
+    dict representing the message in the same way as it is represented
+    when listing messages.
+
+    The representation is cached for ``TCA_MESSAGE_DATA_CACHE_TIMEOUT``
+    seconds, so that all notifiers of a message share it.
+    """
+    key = _get_message_data_cache_key(message)
+    data = cache.get(key)
+    if data is None:
+        # Leverage the MessageSerializer to get the serialized
+        # representation of a Message
+        data = to_primitive(ListMessageSerializer(message).data)
+        cache.set(key, data, settings.TCA_MESSAGE_DATA_CACHE_TIMEOUT)
+
+    return data
+
+
+def get_notifier_class(name):
+    """
+    Function returns the registered notifier class with the given name, or
+    ``None`` if there is no such class.
+    """
+    for notifier_class in BaseNotifier.notifiers:
+        if notifier_class.__name__ == name:
+            return notifier_class
+
+
+_instances = {}
+_instances_pid = None
+_instances_lock = threading.Lock()
+
+
+def get_notifier(notifier_class):
+    """
+    Function returns the instance of the given notifier class shared by
+    the current process.
+
+    Instances are created only once per process, so that the resources
+    they hold (such as open connections) are reused by all notifications.
+    New instances are created after the process is forked, since the
+    resources cannot be shared with the parent process.
+    """
+    global _instances_pid
+
+    with _instances_lock:
+        if _instances_pid != os.getpid():
+            _instances.clear()
+            _instances_pid = os.getpid()
+        if notifier_class not in _instances:
+            _instances[notifier_class] = notifier_class.get_instance()
+
+        return _instances[notifier_class]
+
+
+def reset_notifiers(**kwargs):
+    """
+    Function discards the notifier instances shared by the current process,
+    making sure that new ones are created when they are needed next.
+    """
+    with _instances_lock:
+        instances = list(_instances.values())
+        _instances.clear()
+    for instance in instances:
+        instance.close()
+
 
 def get_notifiers():
     """
@@ -78,16 +259,40 @@ def get_notifiers():
     implementations.
     """
     return tuple(
-        notifier_class.get_instance()
+        get_notifier(notifier_class)
         for notifier_class in BaseNotifier.notifiers
         if notifier_class.is_enabled()
     )
 
 
+# Each Celery worker process starts with its own notifiers and closes them
+# before it exits
+worker_process_init.connect(reset_notifiers)
+worker_process_shutdown.connect(reset_notifiers)
+
+
 class GcmNotifier(BaseNotifier):
     """
     Google Cloud Messaging notifications for new messages.
     """
+    coalesce = True
+    #: The maximum number of registration IDs GCM accepts in a single
+    #: request
+    max_registration_ids = 1000
+    #: The maximum size of the data GCM accepts in a single notification
+    max_payload_size = 4096
+    #: The errors signifying that a registration ID should no longer be
+    #: used
+    removed_registration_id_errors = ('NotRegistered', 'InvalidRegistration')
+    #: The errors signifying that sending to a registration ID should be
+    #: retried later
+    retryable_registration_id_errors = ('Unavailable', 'InternalServerError')
+    #: The exceptions signifying that a failed request should be retried
+    #: later
+    retryable_exceptions = (
+        gcm.GCMUnavailableException,
+        gcm.GCMConnectionException,
+    )
 
     def __init__(self, api_key):
         self._gcm = GCM(api_key)
@@ -105,8 +310,9 @@ class GcmNotifier(BaseNotifier):
         Sends a notification to all members of the chat group to which
         the given message was posted.
 
-        It makes sure to send only a single request off to the GCM servers
-        by batching all ``registration_id`` together in the request.
+        It makes sure to send as few requests as possible off to the GCM
+        servers by batching the ``registration_id`` together in the
+        requests.
         """
         # Batch the registraion IDs to which a notification is to be sent
         registration_ids = self._get_registration_ids(message)
@@ -118,48 +324,334 @@ class GcmNotifier(BaseNotifier):
         data = self._message_to_data(message)
 
         # Finally perform the send request
-        self._send_request(registration_ids, data)
+        self.send(message.chat_room_id, registration_ids, data)
+
+    def notify_coalesced(self, message, count, notify_sender=False):
+        """
+        Sends a single notification of the given number of new messages to
+        the members of the chat room, carrying the newest of the messages.
+        """
+        registration_ids = self._get_registration_ids(message, notify_sender)
+        if len(registration_ids) == 0:
+            return
+        data = self._message_to_data(message, count)
+
+        self.send(message.chat_room_id, registration_ids, data)
+
+    def send(self, chat_room_id, registration_ids, data, attempt=1):
+        """
+        Sends the notification with the given data to the given
+        registration IDs of the members of a chat room.
+
+        Sending to the registration IDs which failed due to a temporary
+        error is retried by the :func:`chat.tasks.send_gcm_notification`
+        task, until ``TCA_GCM_MAX_ATTEMPTS`` attempts are made.
 
-    def _get_registration_ids(self, message):
-        # Get all members apart from the sender themselves
-        members = message.chat_room.members.exclude(pk=message.member.pk)
+        :param attempt: The number of the attempt to send the notification
+        """
+        results = self._send_request(
+            registration_ids, data, self._get_request_options(chat_room_id))
+
+        self._process_results(chat_room_id, results)
+        self._retry_failed(chat_room_id, data, results, attempt)
+
+    def close(self):
+        self._gcm.close()
+
+    def _get_registration_ids(self, message, notify_sender=False):
+        member_registration_ids = ChatRoom.objects.get_registration_ids(
+            message.chat_room_id)
 
-        # Batch all of their registration_ids
+        # Batch the registration_ids of all members apart from the sender
+        # themselves, unless they should be notified too
         registration_ids = set()
-        for member in members:
-            registration_ids.update(member.registration_ids)
+        for member_id, ids in member_registration_ids.items():
+            if notify_sender or member_id != message.member_id:
+                registration_ids.update(ids)
 
         return list(registration_ids)
 
-    def _message_to_data(self, message):
+    def _process_results(self, chat_room_id, results):
+        """
+        Finds the registration IDs which GCM reported as replaced by a
+        canonical ID or no longer valid and schedules the update of the
+        members who own them.
+
+        :param results: The results returned by :meth:`_send_request`
+        """
+        canonical_ids = {}
+        removed_ids = set()
+        for _, response, _ in results:
+            if not response:
+                continue
+            canonical_ids.update(response.get('canonical', {}))
+            errors = response.get('errors', {})
+            for error in self.removed_registration_id_errors:
+                removed_ids.update(errors.get(error, ()))
+
+        if not canonical_ids and not removed_ids:
+            return
+
+        changes = []
+        member_registration_ids = ChatRoom.objects.get_registration_ids(
+            chat_room_id)
+        for member_id, ids in member_registration_ids.items():
+            member_canonical_ids = {
+                registration_id: canonical_ids[registration_id]
+                for registration_id in ids
+                if registration_id in canonical_ids
+            }
+            member_removed_ids = removed_ids.intersection(ids)
+            if member_canonical_ids or member_removed_ids:
+                changes.append(
+                    (member_id, member_canonical_ids, list(member_removed_ids)))
+
+        if changes:
+            # Imported here since the tasks module depends on this one
+            from chat.tasks import update_registration_ids
+            update_registration_ids.delay(changes)
+
+    def _retry_failed(self, chat_room_id, data, results, attempt):
+        """
+        Schedules another attempt to send the notification to the
+        registration IDs which failed due to a temporary error.
+
+        Only the registration IDs which failed are retried. The delay
+        before the next attempt grows exponentially with the number of
+        attempts made, is randomized so that retries of many notifications
+        do not all hit GCM at the same time and is never shorter than the
+        delay requested by GCM.
+
+        :param results: The results returned by :meth:`_send_request`
+        """
+        retry_ids = []
+        retry_after = 0
+        for chunk, response, error in results:
+            if error is not None:
+                if isinstance(error, self.retryable_exceptions):
+                    retry_ids.extend(chunk)
+                    retry_after = max(
+                        retry_after, getattr(error, 'retry_after', None) or 0)
+                continue
+            errors = response.get('errors', {})
+            for error_name in self.retryable_registration_id_errors:
+                retry_ids.extend(errors.get(error_name, ()))
+
+        if not retry_ids:
+            return
+
+        if attempt >= settings.TCA_GCM_MAX_ATTEMPTS:
+            logger.warning(
+                "Giving up sending a GCM notification to %d devices "
+                "after %d attempts", len(retry_ids), attempt)
+            gcm_dropped_registration_ids.increment(len(retry_ids))
+            return
+
+        gcm_retries.increment()
+        gcm_retried_registration_ids.increment(len(retry_ids))
+        # Imported here since the tasks module depends on this one
+        from chat.tasks import send_gcm_notification
+        send_gcm_notification.apply_async(
+            args=(chat_room_id, retry_ids, data, attempt + 1),
+            countdown=retry_after + self._get_retry_delay(attempt))
+
+    def _get_retry_delay(self, attempt):
+        """
+        Returns the randomized number of seconds to wait before retrying
+        after the given number of failed attempts ("full jitter").
+        """
+        return random.uniform(0, min(
+            settings.TCA_GCM_RETRY_MAX_DELAY,
+            settings.TCA_GCM_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+    def _message_to_data(self, message, count=None):
         """
         Converts the given :class:`chat.models.Message` instance to a Python
         dict suitable to be transferred in the GCM notification.
-        """
-        # Leverage the MessageSerializer to get the serialized representation
-        # of a Message
-        serializer = ListMessageSerializer(message)
 
-        json_message = JSONRenderer().render(serializer.data)
+        The notification carries only a preview of the message's text,
+        which clients can show right away, and the URL from which the
+        complete message can be fetched. Should it still not fit into a GCM
+        notification, the clients are only told which message to fetch.
 
-        # Convert the JSON back to a dict so that the GCM package can
-        # correctly handle the request
-        return json.loads(json_message)
+        :param count: The number of new messages the notification stands
+            for, if it is a coalesced one
+        """
+        data = {
+            'type': 'message',
+            'id': message.pk,
+            'chat_room': message.chat_room_id,
+            'member': unicode(message.member),
+            'text': Truncator(message.text).chars(
+                settings.TCA_GCM_PREVIEW_LENGTH),
+            'url': message.get_absolute_url(),
+        }
+        if count is not None:
+            data['new_message_count'] = count
+
+        if len(json.dumps(data)) > self.max_payload_size:
+            data = {
+                'type': 'fetch',
+                'id': message.pk,
+                'chat_room': message.chat_room_id,
+            }
+
+        return data
+
+    def _get_request_options(self, chat_room_id):
+        """
+        Returns the options of the GCM requests notifying the members of the
+        chat room with the given ID.
+
+        Notifications of the same chat room share a collapse key, so that
+        a device which is offline receives only the newest one once it
+        comes back.
+        """
+        return {
+            'collapse_key': 'chat-room-{id}'.format(id=chat_room_id),
+            'time_to_live': settings.TCA_GCM_TIME_TO_LIVE,
+            'delay_while_idle': settings.TCA_GCM_DELAY_WHILE_IDLE,
+        }
 
-    def _send_request(self, registration_ids, data):
+    def _send_request(self, registration_ids, data, options=None):
         """
         Sends the notification to GCM servers where the registration ids
         are set to the ones given as the parameter.
 
+        Since a single GCM request can contain only a limited number of
+        registration IDs, they are split into chunks which are sent
+        concurrently, using at most ``TCA_GCM_MAX_CONCURRENT_REQUESTS``
+        threads.
+
         :param registration_ids: A list of registration IDs which are to
             receive the notification
         :param data: The data which is to be included in the notification
             as a Python dict
+        :param options: A dict of additional options of the GCM requests
+            (see :meth:`_get_request_options`)
+        :returns: A list of ``(chunk, response, error)`` tuples, one for
+            each chunk of registration IDs, where ``response`` is the
+            response returned by GCM for the chunk and ``error`` is the
+            exception raised if sending it failed (in which case
+            ``response`` is ``None``).
+        """
+        chunks = [
+            registration_ids[index:index + self.max_registration_ids]
+            for index in range(
+                0, len(registration_ids), self.max_registration_ids)
+        ]
+
+        def send_chunk(chunk):
+            response, error = self._send_chunk(chunk, data, options)
+            return chunk, response, error
+
+        if len(chunks) <= 1:
+            return [send_chunk(chunk) for chunk in chunks]
+
+        pool = ThreadPool(
+            min(len(chunks), settings.TCA_GCM_MAX_CONCURRENT_REQUESTS))
+        try:
+            return pool.map(send_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _send_chunk(self, registration_ids, data, options=None):
+        """
+        Sends a single GCM request for the given registration IDs.
+
+        :returns: A ``(response, error)`` tuple of the response returned by
+            GCM and the exception raised if the request failed.
         """
+        gcm_requests.increment()
         try:
             response = self._gcm.json_request(
                 registration_ids=registration_ids,
-                data=data)
-        except:
-            # Gotta catch 'em all!
-            pass
+                data=data,
+                **(options or {}))
+        except self.retryable_exceptions as error:
+            gcm_failed_requests.increment()
+            logger.warning(
+                "Sending a GCM notification to %d devices failed: %s",
+                len(registration_ids), error)
+            return None, error
+        except Exception as error:
+            gcm_failed_requests.increment()
+            logger.exception(
+                "Sending a GCM notification to %d devices failed",
+                len(registration_ids))
+            return None, error
+
+        return response, None
+
+
+class StreamingNotifier(BaseNotifier):
+    """
+    Pushes new messages to the clients connected to the streaming endpoint
+    of the message's chat room (:class:`chat.views.MessageStreamView`).
+
+    The messages are handed to the streaming connections by publishing
+    them to the chat room's stream channel of the broker returned by
+    :func:`chat.broker.get_broker`.
+    """
+    @classmethod
+    def get_instance(cls):
+        return cls()
+
+    @classmethod
+    def is_enabled(cls):
+        return settings.TCA_ENABLE_STREAMING_NOTIFICATIONS
+
+    def notify(self, message):
+        """
+        Publishes the serialized representation of the message to the
+        connected clients.
+
+        When the representation is too large to be published by the
+        broker, the clients are only told to fetch the message instead.
+        """
+        broker = get_broker()
+        channel = get_chat_room_stream_channel(message.chat_room_id)
+        try:
+            broker.publish(channel, {
+                'type': 'message',
+                'message': message_to_data(message),
+            })
+        except ValueError:
+            broker.publish(channel, {
+                'type': 'fetch',
+                'id': message.pk,
+            })
+
+
+class WebhookNotifier(BaseNotifier):
+    """
+    Posts new messages to the HTTP endpoints given by the
+    ``TCA_WEBHOOK_ENDPOINTS`` setting.
+
+    The messages are posted in batches by a
+    :class:`chat.webhooks.WebhookQueue` of each endpoint, so that the
+    endpoints are not sent a request per message.
+    """
+    def __init__(self, endpoints):
+        self.queues = [WebhookQueue(url) for url in endpoints]
+
+    @classmethod
+    def get_instance(cls):
+        return cls(settings.TCA_WEBHOOK_ENDPOINTS)
+
+    @classmethod
+    def is_enabled(cls):
+        return bool(settings.TCA_WEBHOOK_ENDPOINTS)
+
+    def notify(self, message):
+        event = {
+            'type': 'message',
+            'message': message_to_data(message),
+        }
+        for queue in self.queues:
+            queue.put(event)
+
+    def close(self):
+        for queue in self.queues:
+            queue.close()
@@ -0,0 +1,196 @@
+"""
+Module contains paginators which can be used as the ``paginator_class``
+of the :class:`chat.views.PaginatedListModelMixin`.
+"""
+
+from django.db.models import Q
+
+import base64
+import json
+
+
+class InvalidCursor(Exception):
+    """
+    Raised when a cursor cannot be decoded.
+    """
+    pass
+
+
+class CursorPage(object):
+    """
+    A single page of objects returned by the :class:`CursorPaginator`.
+
+    It provides the same interface as Django's ``Page`` class which is used
+    by the :class:`chat.views.PaginatedListModelMixin` to build pagination
+    links, but the "page numbers" it returns are opaque cursors.
+    """
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next and len(self.object_list) > 0
+
+    def has_previous(self):
+        return self._has_previous and len(self.object_list) > 0
+
+    def next_page_number(self):
+        """
+        Returns the cursor pointing to the page following this one.
+        """
+        return self.paginator.encode_cursor(
+            CursorPaginator.NEXT, self.object_list[-1])
+
+    def previous_page_number(self):
+        """
+        Returns the cursor pointing to the page preceding this one.
+        """
+        return self.paginator.encode_cursor(
+            CursorPaginator.PREVIOUS, self.object_list[0])
+
+
+class CursorPaginator(object):
+    """
+    A paginator which pages through a queryset based on the values of the
+    fields it is ordered by (keyset pagination), instead of using offsets.
+
+    Obtaining any page therefore costs the same as obtaining the first
+    one, given that there is an index covering the ordering fields.
+    Neither does the paginator need to count the objects.
+
+    The ordering needs to be unique for the pagination to be correct,
+    therefore the last ordering field should normally be the primary key.
+    All ordering fields need to be ordered in the same direction.
+
+    Pages are identified by opaque cursors which encode the direction
+    of the page relative to the object the cursor was created from and the
+    values of that object's ordering fields.
+    """
+    NEXT = 'n'
+    PREVIOUS = 'p'
+
+    def __init__(self, object_list, per_page, ordering=('-pk',)):
+        self.object_list = object_list
+        self.per_page = max(int(per_page), 1)
+        self.ordering = tuple(ordering)
+        self.descending = self.ordering[0].startswith('-')
+        self.fields = tuple(field.lstrip('-') for field in self.ordering)
+
+    def _get_model_field(self, field_name):
+        meta = self.object_list.model._meta
+        if field_name == 'pk':
+            return meta.pk
+        return meta.get_field(field_name)
+
+    def encode_cursor(self, direction, obj):
+        """
+        Returns a cursor pointing to the page in the given direction
+        relative to the given object.
+        """
+        values = [
+            self._get_model_field(field_name).value_to_string(obj)
+            for field_name in self.fields
+        ]
+        cursor = json.dumps([direction, values])
+        return base64.urlsafe_b64encode(cursor.encode('utf-8'))
+
+    def decode_cursor(self, cursor):
+        """
+        Returns a ``(direction, values)`` tuple represented by the given
+        cursor where the values are converted to the Python representation
+        of the corresponding ordering fields.
+
+        :raises InvalidCursor: If the cursor cannot be decoded
+        """
+        try:
+            direction, values = json.loads(
+                base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+            if direction not in (self.NEXT, self.PREVIOUS):
+                raise ValueError("Invalid cursor direction")
+            if len(values) != len(self.fields):
+                raise ValueError("Invalid number of cursor values")
+
+            values = [
+                self._get_model_field(field_name).to_python(value)
+                for field_name, value in zip(self.fields, values)
+            ]
+        except Exception:
+            raise InvalidCursor(cursor)
+
+        if any(value is None for value in values):
+            raise InvalidCursor(cursor)
+
+        return direction, values
+
+    def _build_filter(self, values, lookup):
+        """
+        Builds a ``Q`` object selecting the objects whose ordering fields
+        are (lexicographically) less than or greater than the given values,
+        depending on the given lookup (``lt`` or ``gt``).
+        """
+        q = Q()
+        for index, field_name in enumerate(self.fields):
+            condition = Q(**{
+                '{field}__{lookup}'.format(field=field_name, lookup=lookup):
+                    values[index],
+            })
+            for equal_field, equal_value in zip(self.fields, values[:index]):
+                condition &= Q(**{equal_field: equal_value})
+            q |= condition
+
+        return q
+
+    def page(self, cursor=None):
+        """
+        Returns the :class:`CursorPage` identified by the given cursor.
+
+        When no cursor is given or it is invalid, the first page is
+        returned.
+        """
+        direction, values = self.NEXT, None
+        if cursor is not None:
+            try:
+                direction, values = self.decode_cursor(cursor)
+            except InvalidCursor:
+                pass
+
+        # Objects following the cursor in the ordering are the ones which
+        # are "less than" the cursor when the ordering is descending.
+        following, preceding = 'gt', 'lt'
+        if self.descending:
+            following, preceding = preceding, following
+
+        if direction == self.NEXT:
+            qs = self.object_list.order_by(*self.ordering)
+            if values is not None:
+                qs = qs.filter(self._build_filter(values, following))
+        else:
+            reverse_ordering = [
+                field_name if self.descending else '-' + field_name
+                for field_name in self.fields
+            ]
+            qs = self.object_list.order_by(*reverse_ordering)
+            qs = qs.filter(self._build_filter(values, preceding))
+
+        # Fetch a single additional object to find out whether there are
+        # any more objects beyond this page.
+        object_list = list(qs[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+
+        if direction == self.NEXT:
+            return CursorPage(
+                object_list, self,
+                has_next=has_more,
+                has_previous=values is not None)
+        else:
+            object_list.reverse()
+            return CursorPage(
+                object_list, self,
+                has_next=True,
+                has_previous=has_more)
@@ -9,10 +9,10 @@ from chat.models import PublicKey
 
 class MemberSerializer(serializers.HyperlinkedModelSerializer):
     public_keys = serializers.SerializerMethodField('get_public_keys_url')
+    chat_rooms = serializers.SerializerMethodField('get_chat_rooms_url')
 
     class Meta:
         model = Member
-        exclude = ('registration_ids',)
 
     def get_public_keys_url(self, member):
         return reverse(
@@ -20,6 +20,12 @@ class MemberSerializer(serializers.HyperlinkedModelSerializer):
             kwargs={'member': member.pk},
             request=self.context.get('request', None))
 
+    def get_chat_rooms_url(self, member):
+        return reverse(
+            'member-chatroom-list',
+            kwargs={'member': member.pk},
+            request=self.context.get('request', None))
+
 
 class PublicKeySerializer(serializers.HyperlinkedModelSerializer):
     url = serializers.SerializerMethodField('get_url')
@@ -67,6 +73,35 @@ class ChatRoomSerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = ChatRoom
+        exclude = (
+            'version',
+            'last_modified',
+        )
+
+
+class MemberChatRoomSerializer(ChatRoomSerializer):
+    """
+    A serializer for the chat rooms of a member, which includes the ID of
+    the newest message and the number of unread messages of each chat
+    room.
+
+    Expects the chat rooms to be obtained by
+    :meth:`chat.models.ChatRoomManager.for_member`.
+    """
+    latest_message_id = serializers.Field()
+    unread_count = serializers.Field()
+
+    class Meta(ChatRoomSerializer.Meta):
+        # The members are left out, since listing them would take a query
+        # per chat room
+        exclude = None
+        fields = (
+            'url',
+            'name',
+            'messages',
+            'latest_message_id',
+            'unread_count',
+        )
 
 
 class PartialChatRoomSerializer(serializers.ModelSerializer):
@@ -103,7 +138,7 @@ class MessageSerializerMixin(object):
         """
         return reverse(
             'message-detail', kwargs={
-                'chat_room': message.chat_room.pk,
+                'chat_room': message.chat_room_id,
                 'pk': message.pk,
             },
             request=self.context.get('request', None)
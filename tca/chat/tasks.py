@@ -5,25 +5,80 @@ from __future__ import absolute_import
 
 from django.template.loader import render_to_string
 from django.core import mail
+from django.core.cache import cache
 from django.conf import settings
+from django.db import connection
+from django.db import DatabaseError
+from django.db import transaction
 
+from celery import group
 from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import worker_init
 
+from chat.models import Device
+from chat.models import Member
 from chat.models import Message
+from chat.models import ChatRoom
 from chat.models import PublicKey
 from chat.models import PublicKeyConfirmation
+from chat.models import SystemMessage
 
 from chat.notifiers import get_notifiers
+from chat.notifiers import get_notifier
+from chat.notifiers import get_notifier_class
+from chat.notifiers import GcmNotifier
+from chat.metrics import Counter
+from chat import crypto
 
+from collections import defaultdict
 from urlparse import urlunsplit
 
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+#: The number of seconds a notifier has to clean up after its soft time
+#: limit is exceeded
+NOTIFIER_TIME_LIMIT_GRACE = 5
+
+#: The number of times the coalesced notifications of a chat room are
+#: postponed while waiting for a numbered message to be stored
+COALESCING_GAP_RETRIES = 3
+
+notifier_failures = Counter(
+    'notifiers.failures', "Notifications which failed with an error")
+notifier_timeouts = Counter(
+    'notifiers.timeouts', "Notifications interrupted by their timeout")
+
+
+@worker_init.connect
+def warm_caches(**kwargs):
+    """
+    Fills the process-wide caches of the app.
+
+    It is meant to be called when a server process starts, before it forks
+    its worker processes, so that they inherit the caches. Celery workers
+    call it automatically.
+    """
+    try:
+        SystemMessage.get_bot_id()
+    except DatabaseError:
+        # The caches are filled once they are needed instead
+        logger.warning("Warming the caches failed", exc_info=True)
+    finally:
+        # Forked processes must not share the connection
+        connection.close()
+
 
 @shared_task
 def send_message_notifications(message_id):
     """
     Celery task which sends a notification that a new message has been
-    posted. It simply notifies all notifiers defined in :mod:`chat.notifiers`
-    and passes them the corresponding :class:`chat.models.Message` instance.
+    posted. It notifies all notifiers defined in :mod:`chat.notifiers` of
+    the corresponding :class:`chat.models.Message` instance, running each
+    notifier in a separate :func:`run_notifier` task.
 
     :param message_id: The ID of the message for which the notifications
         should be sent. The task takes an ID, not a full
@@ -36,9 +91,374 @@ def send_message_notifications(message_id):
         # The message somehow disappeared in the mean time
         return
 
+    coalesce = settings.TCA_NOTIFICATION_COALESCE_MS > 0
+    notifiers = []
+    coalesced = False
     # Alert all notifiers (observers)
     for notifier in get_notifiers():
-        notifier.notify(message)
+        if coalesce and notifier.coalesce:
+            coalesced = True
+            continue
+        notifiers.append(notifier)
+
+    _dispatch_notifications(notifiers, message.pk)
+    if coalesced:
+        _coalesce_notifications(message)
+
+
+def _dispatch_notifications(notifiers, message_id, count=None,
+                            notify_sender=False):
+    """
+    Runs the given notifiers concurrently, each in a separate
+    :func:`run_notifier` task limited to the notifier's timeout.
+    """
+    subtasks = []
+    for notifier in notifiers:
+        timeout = notifier.get_timeout()
+        subtasks.append(run_notifier.subtask(
+            args=(
+                notifier.__class__.__name__, message_id, count,
+                notify_sender),
+            soft_time_limit=timeout,
+            # Let the notifier clean up before its worker is killed
+            time_limit=timeout + NOTIFIER_TIME_LIMIT_GRACE))
+    if subtasks:
+        group(subtasks).apply_async()
+
+
+@shared_task
+def run_notifier(notifier_name, message_id, count=None, notify_sender=False):
+    """
+    Celery task which notifies a single notifier of a new message and
+    records how long the notification took.
+
+    Errors of the notifier are logged, so that they never affect the other
+    notifiers.
+
+    :param notifier_name: The name of the notifier's class
+    :param count: The number of messages coalesced into the notification
+        or ``None`` if the notification is not coalesced.
+    :param notify_sender: Whether the sender of the message should be
+        notified of a coalesced notification as well, since other members
+        posted some of its messages.
+    """
+    notifier_class = get_notifier_class(notifier_name)
+    if notifier_class is None:
+        logger.error("Unknown notifier %s", notifier_name)
+        return
+    try:
+        message = Message.objects.select_related('member').get(pk=message_id)
+    except Message.DoesNotExist:
+        return
+
+    notifier = get_notifier(notifier_class)
+    start = time.time()
+    try:
+        if count is None:
+            notifier.notify(message)
+        else:
+            notifier.notify_coalesced(message, count, notify_sender)
+    except SoftTimeLimitExceeded:
+        notifier_timeouts.increment()
+        logger.warning(
+            "The %s timed out notifying message %s",
+            notifier_name, message_id)
+    except Exception:
+        notifier_failures.increment()
+        logger.exception(
+            "The %s failed notifying message %s", notifier_name, message_id)
+    finally:
+        notifier_class.timer.record(time.time() - start)
+
+
+def _get_coalescing_keys(chat_room_id):
+    """
+    Returns the cache keys of the pending coalesced notifications of the
+    chat room with the given ID: the key marking the open coalescing
+    window, the key of the number given to the latest message and the key
+    of the number of the latest message already notified.
+    """
+    return tuple(
+        'tca-coalesced-notifications-{name}-{id}'.format(
+            name=name, id=chat_room_id)
+        for name in ('window', 'sequence', 'notified')
+    )
+
+
+def _get_coalesced_message_key(chat_room_id, number):
+    """
+    Returns the cache key of the message with the given number among the
+    pending coalesced notifications of the chat room with the given ID.
+    """
+    return 'tca-coalesced-notifications-message-{id}-{number}'.format(
+        id=chat_room_id, number=number)
+
+
+def _coalesce_notifications(message):
+    """
+    Adds the given message to the pending coalesced notifications of its
+    chat room.
+
+    Each message is numbered and stored under its own key, so that
+    concurrently posted messages never overwrite each other.
+
+    The first message after a window has closed opens a new one, by
+    scheduling the :func:`send_coalesced_notifications` task to run once
+    the window closes.
+    """
+    window = settings.TCA_NOTIFICATION_COALESCE_MS / 1000.
+    # The pending notifications need to outlive the window, even if the
+    # task is delayed
+    timeout = max(int(window * 10), 60)
+    window_key, sequence_key, _ = _get_coalescing_keys(message.chat_room_id)
+
+    # The numbers keep increasing across windows
+    try:
+        number = cache.incr(sequence_key)
+    except ValueError:
+        if cache.add(sequence_key, 1, None):
+            number = 1
+        else:
+            number = cache.incr(sequence_key)
+    cache.set(
+        _get_coalesced_message_key(message.chat_room_id, number),
+        (message.pk, message.member_id),
+        timeout)
+
+    if cache.add(window_key, True, timeout):
+        send_coalesced_notifications.apply_async(
+            (message.chat_room_id,), countdown=window)
+
+
+@shared_task
+def send_coalesced_notifications(chat_room_id, retries=0):
+    """
+    Celery task which sends a single notification of all messages posted
+    to the chat room with the given ID during a coalescing window, to the
+    notifiers which coalesce notifications.
+
+    The notification carries the newest of the messages and their count.
+    The sender of the messages is notified as well, unless all of them
+    were posted by the same member.
+
+    A message is numbered before it is stored, so a number may not have
+    its message yet. Only the messages before the first such gap are
+    notified and the task is run again for the rest, until it gives up
+    on the missing message after :data:`COALESCING_GAP_RETRIES` retries.
+
+    :param retries: The number of times the task was postponed already
+    """
+    window_key, sequence_key, notified_key = _get_coalescing_keys(
+        chat_room_id)
+    # Let the messages posted from now on open a new window
+    cache.delete(window_key)
+    last = cache.get(sequence_key) or 0
+    first = (cache.get(notified_key) or 0) + 1
+    if first > last + 1:
+        # The numbering started over after it was evicted from the cache
+        first = 1
+    if first > last:
+        return
+
+    keys = [
+        _get_coalesced_message_key(chat_room_id, number)
+        for number in range(first, last + 1)
+    ]
+    found = cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing and retries < COALESCING_GAP_RETRIES:
+        keys = keys[:keys.index(missing[0])]
+        send_coalesced_notifications.apply_async(
+            (chat_room_id, retries + 1),
+            countdown=settings.TCA_NOTIFICATION_COALESCE_MS / 1000.)
+    # Messages numbered in the mean time are left for the next window
+    cache.set(notified_key, first + len(keys) - 1, None)
+    cache.delete_many(keys)
+    messages = [found[key] for key in keys if key in found]
+    if not messages:
+        return
+
+    message_id = max(message_id for message_id, _ in messages)
+    senders = set(member_id for _, member_id in messages)
+    if not Message.objects.filter(pk=message_id).exists():
+        return
+
+    notifiers = [
+        notifier
+        for notifier in get_notifiers()
+        if notifier.coalesce
+    ]
+    _dispatch_notifications(
+        notifiers, message_id, len(messages),
+        notify_sender=len(senders) > 1)
+
+
+@shared_task
+def send_gcm_notification(chat_room_id, registration_ids, data, attempt):
+    """
+    Celery task which retries sending a GCM notification to the given
+    registration IDs of the members of a chat room, after the previous
+    attempt failed for them.
+
+    :param attempt: The number of this attempt
+    """
+    notifier = get_notifier(GcmNotifier)
+    notifier.send(chat_room_id, registration_ids, data, attempt)
+
+
+@shared_task
+def validate_message(message_id):
+    """
+    Celery task which validates the signature of a message and, if it is
+    found to be valid, initiates the sending of notifications for it.
+
+    :param message_id: The ID of the :class:`chat.models.Message` whose
+        signature should be validated.
+    """
+    try:
+        message = Message.objects.get(pk=message_id)
+    except Message.DoesNotExist:
+        return
+
+    if message.validate_signature():
+        send_message_notifications.delay(message.pk)
+
+
+def _get_active_keys(member_ids):
+    """
+    Returns a dict mapping each of the given member IDs to a list of the
+    texts of the member's active public keys.
+    """
+    keys = defaultdict(list)
+    public_keys = PublicKey.objects.filter(
+        member__in=member_ids,
+        active=True).values_list('member', 'key_text')
+    for member_id, key_text in public_keys:
+        keys[member_id].append(key_text)
+
+    return keys
+
+
+@shared_task
+def validate_pending_signatures(chunk_size=None):
+    """
+    Celery task which validates the signatures of all messages which are
+    not yet valid, as done by :func:`validate_backlog`.
+
+    The signatures are verified in the worker process itself, since the
+    processes of a Celery worker pool cannot reliably start processes of
+    their own. Use the ``validate_pending_signatures`` management command
+    to spread the verification across multiple processes.
+    """
+    return validate_backlog(chunk_size)
+
+
+def validate_backlog(chunk_size=None, pool=None):
+    """
+    Validates the signatures of all messages which are not yet valid. It is
+    meant for working through a backlog of messages which have not been
+    validated, e.g. after an outage of the workers.
+
+    The messages are processed in chunks: the active public keys of all
+    members found in a chunk are fetched by a single query, the signatures
+    are verified, optionally across a pool of processes, and all messages
+    of the chunk found to be valid are updated by a single query.
+
+    :param chunk_size: The number of messages processed at once.  Defaults
+        to the ``TCA_SIGNATURE_VALIDATION_CHUNK_SIZE`` setting.
+    :param pool: The :class:`multiprocessing.Pool` used to verify the
+        signatures of all chunks, or ``None`` to verify them in the current
+        process.
+
+    :returns: The number of messages which were found to be valid.
+    """
+    if chunk_size is None:
+        chunk_size = settings.TCA_SIGNATURE_VALIDATION_CHUNK_SIZE
+
+    validated_count = 0
+    last_pk = 0
+    while True:
+        # Walk the messages by their primary key so that messages which
+        # stay invalid are not processed again in the same run
+        chunk = list(
+            Message.objects
+                   .filter(valid=False, pk__gt=last_pk)
+                   .order_by('pk')
+                   .values_list(
+                       'pk', 'member', 'chat_room', 'text', 'signature')
+                   [:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1][0]
+
+        keys = _get_active_keys(set(
+            member_id for _, member_id, _, _, _ in chunk))
+        results = crypto.verify_many((
+            (text, signature, keys[member_id])
+            for _, member_id, _, text, signature in chunk
+        ), pool=pool)
+
+        valid_messages = [
+            (message_id, chat_room_id)
+            for (message_id, _, chat_room_id, _, _), valid in zip(
+                chunk, results)
+            if valid
+        ]
+        valid_ids = [message_id for message_id, _ in valid_messages]
+        if valid_ids:
+            Message.objects.filter(pk__in=valid_ids).update(valid=True)
+            ChatRoom.objects.mark_modified(*set(
+                chat_room_id for _, chat_room_id in valid_messages))
+            for message_id in valid_ids:
+                send_message_notifications.delay(message_id)
+        validated_count += len(valid_ids)
+
+    return validated_count
+
+
+@shared_task
+def update_registration_ids(changes):
+    """
+    Celery task which applies the changes of members' registration IDs
+    reported by GCM: canonical IDs replace the ones they were reported for,
+    while IDs which are no longer registered are removed.
+
+    The changes are applied within a single transaction which locks the
+    members' rows, so that they do not interfere with devices being
+    registered concurrently.
+
+    :param changes: A list of ``(member_id, canonical_ids, removed_ids)``
+        tuples, where ``canonical_ids`` is a dict mapping registration IDs of
+        the member to the canonical IDs which should replace them and
+        ``removed_ids`` a list of registration IDs which should be removed.
+    """
+    if not changes:
+        return
+
+    member_ids = [member_id for member_id, _, _ in changes]
+    with transaction.atomic():
+        list(Member.objects.select_for_update().filter(
+            pk__in=member_ids).values_list('pk', flat=True))
+        for member_id, canonical_ids, removed_ids in changes:
+            devices = Device.objects.filter(member=member_id)
+            if removed_ids:
+                devices.filter(registration_id__in=removed_ids).delete()
+            if not canonical_ids:
+                continue
+
+            # Only the devices which are still registered are replaced
+            replaced_ids = list(devices.filter(
+                registration_id__in=canonical_ids.keys()).values_list(
+                    'registration_id', flat=True))
+            devices.filter(registration_id__in=replaced_ids).delete()
+            for registration_id in replaced_ids:
+                Device.objects.get_or_create(
+                    member_id=member_id,
+                    registration_id=canonical_ids[registration_id])
+
+        ChatRoom.objects.invalidate_registration_ids(*set(
+            ChatRoom.objects.filter(
+                members__in=member_ids).values_list('pk', flat=True)))
 
 
 def _build_url(url_path):
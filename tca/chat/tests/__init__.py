@@ -0,0 +1,12 @@
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+from chat.notifiers import reset_notifiers
+
+
+@receiver(setting_changed)
+def _reset_notifiers_on_setting_change(setting, **kwargs):
+    # The notifier instances shared by the process are configured by the
+    # settings of the app, so tests overriding them need new instances
+    if setting.startswith('TCA_'):
+        reset_notifiers()
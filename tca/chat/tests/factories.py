@@ -2,6 +2,7 @@
 Module containing factory_boy factories for the models of the
 :mod:`chat` app.
 """
+from chat.models import Device
 from chat.models import Member
 from chat.models import Message
 from chat.models import ChatRoom
@@ -61,6 +62,19 @@ class PublicKeyFactory(factory.DjangoModelFactory):
     member = FuzzyForeignKeyChoice(Member)
 
 
+class DeviceFactory(factory.DjangoModelFactory):
+    """
+    A factory of :class:`chat.models.Device` objects.
+
+    By default it returns a device with a random registration ID of
+    a random existing member.
+    """
+    FACTORY_FOR = Device
+
+    registration_id = factory.fuzzy.FuzzyText(length=64)
+    member = FuzzyForeignKeyChoice(Member)
+
+
 class ChatRoomFactory(factory.DjangoModelFactory):
     """
     A factory of :class:`chat.models.ChatRoom` objects.
@@ -0,0 +1,31 @@
+"""
+Module contains the test runner of the project.
+"""
+from django.test.runner import DiscoverRunner
+
+from chat.models import SystemMessage
+
+import unittest
+
+
+class TestResult(unittest.TextTestResult):
+    """
+    A test result which discards the state cached by the process before
+    each test, since the database rows it refers to are rolled back after
+    the test which created them.
+    """
+    def startTest(self, test):
+        SystemMessage.clear_bot_cache()
+        super(TestResult, self).startTest(test)
+
+
+class TestRunner(DiscoverRunner):
+    """
+    A test runner which runs the tests with the :class:`TestResult`.
+    """
+    def run_suite(self, suite, **kwargs):
+        return unittest.TextTestRunner(
+            verbosity=self.verbosity,
+            failfast=self.failfast,
+            resultclass=TestResult,
+        ).run(suite)
@@ -0,0 +1,108 @@
+"""
+Tests for the :mod:`chat.broker` module.
+"""
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from chat.broker import LocalBroker
+from chat.broker import get_broker
+from chat.broker import get_chat_room_channel
+
+from .factories import MemberFactory
+from .factories import MessageFactory
+from .factories import ChatRoomFactory
+
+import mock
+import threading
+
+
+class LocalBrokerTestCase(TestCase):
+    """
+    Tests for the :class:`chat.broker.LocalBroker`.
+    """
+    def setUp(self):
+        self.broker = LocalBroker()
+
+    def test_publish(self):
+        """
+        Tests that an event is delivered to all subscribers of the channel.
+        """
+        subscriptions = [
+            self.broker.subscribe('channel'),
+            self.broker.subscribe('channel'),
+        ]
+        other_subscription = self.broker.subscribe('other-channel')
+
+        self.broker.publish('channel', {'id': 1})
+
+        for subscription in subscriptions:
+            self.assertEquals({'id': 1}, subscription.get(timeout=0))
+        self.assertIsNone(other_subscription.get(timeout=0))
+
+    def test_unsubscribe(self):
+        """
+        Tests that no events are delivered to a cancelled subscription.
+        """
+        with self.broker.subscribe('channel') as subscription:
+            pass
+
+        self.broker.publish('channel', {'id': 1})
+
+        self.assertIsNone(subscription.get(timeout=0))
+
+    def test_wake_up_waiting_subscriber(self):
+        """
+        Tests that a subscriber waiting for an event is woken up once it is
+        published from a different thread.
+        """
+        subscription = self.broker.subscribe('channel')
+        publisher = threading.Timer(
+            0.05, self.broker.publish, args=('channel', {'id': 1}))
+
+        publisher.start()
+
+        self.assertEquals({'id': 1}, subscription.get(timeout=5))
+        publisher.join()
+
+    def test_overflow(self):
+        """
+        Tests that events are dropped instead of blocking the publisher
+        when a subscriber does not keep up.
+        """
+        subscription = self.broker.subscribe('channel', max_size=1)
+
+        self.broker.publish('channel', {'id': 1})
+        self.broker.publish('channel', {'id': 2})
+
+        self.assertTrue(subscription.overflowed)
+        self.assertEquals({'id': 1}, subscription.get(timeout=0))
+        self.assertIsNone(subscription.get(timeout=0))
+
+
+class MessagePublishedTestCase(TestCase):
+    """
+    Tests that saving a message publishes an event to its chat room.
+    """
+    def test_message_saved(self):
+        MemberFactory.create()
+        chat_room = ChatRoomFactory.create()
+        subscription = get_broker().subscribe(
+            get_chat_room_channel(chat_room.pk))
+
+        message = MessageFactory.create(chat_room=chat_room)
+
+        self.assertEquals({'id': message.pk}, subscription.get(timeout=0))
+        subscription.close()
+
+    @mock.patch('chat.broker.os.getpid')
+    def test_new_broker_after_fork(self, mock_getpid):
+        """
+        Tests that a new broker instance is used in a forked process.
+        """
+        mock_getpid.return_value = -1
+        broker = get_broker()
+
+        mock_getpid.return_value = -2
+
+        self.assertIsNot(broker, get_broker())
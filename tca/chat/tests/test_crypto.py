@@ -8,6 +8,7 @@ from django.test import TestCase
 from chat import crypto
 
 import json
+import mock
 import os
 
 
@@ -164,3 +165,88 @@ class VerifySignatureTestCase(TestCase):
                 None)
 
         self.assertFalse(result)
+
+
+class PublicKeyCacheTestCase(TestCase):
+    """
+    Tests for the :class:`chat.crypto.PublicKeyCache` which keeps parsed
+    public keys around.
+    """
+    def setUp(self):
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        fixture_dir = os.path.join(base_dir, 'fixtures')
+        with open(os.path.join(fixture_dir, 'message_fixtures.json')) as f:
+            self.message_fixtures = json.load(f)
+        with open(os.path.join(fixture_dir, 'pubkey.pub'), 'rb') as f:
+            self.public_key = f.read().decode('utf-8')
+
+        self.cache = crypto.PublicKeyCache(max_size=2)
+
+    def test_parsed_key_reused(self):
+        """
+        Tests that a key is parsed only once when it is requested multiple
+        times.
+        """
+        verifier = self.cache.get(self.public_key)
+
+        self.assertIs(verifier, self.cache.get(self.public_key))
+        self.assertEquals(1, self.cache.misses)
+        self.assertEquals(1, self.cache.hits)
+
+    def test_invalid_key(self):
+        """
+        Tests that an invalid key raises a ``ValueError`` and is not cached.
+        """
+        self.assertRaises(ValueError, self.cache.get, 'asd')
+        self.assertEquals(0, len(self.cache))
+
+    @mock.patch('chat.crypto._parse_verifier')
+    def test_least_recently_used_evicted(self, mock_parse):
+        """
+        Tests that the cache never grows past its maximum size by evicting
+        the least recently used key.
+        """
+        self.cache.get('key-1')
+        self.cache.get('key-2')
+        # Use the first key again so that the second one becomes the least
+        # recently used one
+        self.cache.get('key-1')
+
+        self.cache.get('key-3')
+
+        self.assertEquals(2, len(self.cache))
+        # The first key is still cached, the second one needs to be parsed
+        # again
+        mock_parse.reset_mock()
+        self.cache.get('key-1')
+        self.assertFalse(mock_parse.called)
+        self.cache.get('key-2')
+        mock_parse.assert_called_once_with('key-2')
+
+    def test_invalidate(self):
+        """
+        Tests that an invalidated key is parsed again.
+        """
+        self.cache.get(self.public_key)
+
+        self.cache.invalidate(self.public_key)
+
+        self.assertEquals(0, len(self.cache))
+        self.cache.get(self.public_key)
+        self.assertEquals(2, self.cache.misses)
+
+    def test_verify_uses_cache(self):
+        """
+        Tests that :func:`chat.crypto.verify` gives correct results when
+        the parsed key is served from the cache.
+        """
+        message = self.message_fixtures['simple-message']
+
+        with mock.patch('chat.crypto.key_cache', self.cache):
+            for _ in range(2):
+                self.assertTrue(crypto.verify(
+                    message['text'],
+                    message['signature'],
+                    self.public_key))
+
+        self.assertEquals(1, self.cache.hits)
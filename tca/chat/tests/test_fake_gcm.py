@@ -0,0 +1,63 @@
+"""
+Tests for the :mod:`chat.fake_gcm` module.
+"""
+from django.test import TestCase
+
+from gcm.gcm import GCMAuthenticationException
+
+from chat.fake_gcm import FakeGcmServer
+from chat.gcm_client import GCM
+from chat.gcm_client import GCMUnavailableException
+
+
+class FakeGcmServerTestCase(TestCase):
+    """
+    Tests that the :class:`chat.fake_gcm.FakeGcmServer` answers the requests
+    of the GCM client the way GCM would.
+    """
+    def start_server(self, **kwargs):
+        server = FakeGcmServer(**kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def test_success(self):
+        server = self.start_server()
+        gcm = GCM('dummy-api-key', url=server.url)
+
+        info = gcm.json_request(registration_ids=['id1', 'id2'], data={})
+
+        self.assertEquals({}, info)
+        self.assertEquals(1, server.request_count)
+
+    def test_canonical_ids(self):
+        server = self.start_server(canonical_rate=1)
+        gcm = GCM('dummy-api-key', url=server.url)
+
+        info = gcm.json_request(registration_ids=['id1'], data={})
+
+        self.assertEquals({'id1': 'id1-canonical'}, info['canonical'])
+
+    def test_not_registered(self):
+        server = self.start_server(not_registered_rate=1)
+        gcm = GCM('dummy-api-key', url=server.url)
+
+        info = gcm.json_request(registration_ids=['id1', 'id2'], data={})
+
+        self.assertEquals(['id1', 'id2'], info['errors']['NotRegistered'])
+
+    def test_unavailable(self):
+        server = self.start_server(error_rate=1, retry_after=30)
+        gcm = GCM('dummy-api-key', url=server.url)
+
+        with self.assertRaises(GCMUnavailableException) as context:
+            gcm.json_request(registration_ids=['id1'], data={})
+
+        self.assertEquals(30, context.exception.retry_after)
+
+    def test_authentication(self):
+        server = self.start_server()
+        gcm = GCM('', url=server.url)
+
+        with self.assertRaises(GCMAuthenticationException):
+            gcm.make_request('{}')
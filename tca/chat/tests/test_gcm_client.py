@@ -0,0 +1,184 @@
+"""
+Tests for the :mod:`chat.gcm_client` module.
+"""
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from gcm.gcm import GCMAuthenticationException
+from gcm.gcm import GCMConnectionException
+
+from chat.fake_gcm import FakeGcmServer
+from chat.gcm_client import ConnectionPool
+from chat.gcm_client import GCM
+from chat.gcm_client import GCMUnavailableException
+
+import errno
+import httplib
+import mock
+import socket
+
+
+@mock.patch('chat.gcm_client.ConnectionPool.request')
+class GcmClientTestCase(TestCase):
+    """
+    Tests for the :class:`chat.gcm_client.GCM` client.
+    """
+    def setUp(self):
+        self.gcm = GCM('dummy-api-key')
+
+    def set_response(self, mock_request, status, body='', headers=None):
+        """
+        Helper method setting the response to the request.
+        """
+        mock_request.return_value = (status, headers or {}, body)
+
+    def test_request_sent(self, mock_request):
+        self.set_response(mock_request, 200, '{"results": []}')
+
+        response = self.gcm.make_request('{}')
+
+        self.assertEquals({'results': []}, response)
+        mock_request.assert_called_once_with('POST', '{}', {
+            'Authorization': 'key=dummy-api-key',
+            'Content-Type': 'application/json',
+        })
+
+    def test_retry_after(self, mock_request):
+        """
+        Tests that the Retry-After header of an unavailable response is
+        reported.
+        """
+        self.set_response(mock_request, 503, headers={'Retry-After': '120'})
+
+        with self.assertRaises(GCMUnavailableException) as context:
+            self.gcm.make_request('{}')
+
+        self.assertEquals(120, context.exception.retry_after)
+
+    def test_server_error(self, mock_request):
+        self.set_response(mock_request, 500)
+
+        with self.assertRaises(GCMUnavailableException) as context:
+            self.gcm.make_request('{}')
+
+        self.assertIsNone(context.exception.retry_after)
+
+    def test_authentication_error(self, mock_request):
+        self.set_response(mock_request, 401)
+
+        with self.assertRaises(GCMAuthenticationException):
+            self.gcm.make_request('{}')
+
+    def test_timeout(self, mock_request):
+        mock_request.side_effect = socket.timeout()
+
+        with self.assertRaises(GCMConnectionException):
+            self.gcm.make_request('{}')
+
+    @mock.patch('gcm.gcm.time.sleep')
+    def test_single_attempt(self, mock_sleep, mock_request):
+        """
+        Tests that registration IDs for which GCM is unavailable are neither
+        retried nor waited for by the client itself.
+        """
+        self.set_response(
+            mock_request, 200, '{"results": [{"error": "Unavailable"}]}')
+
+        info = self.gcm.json_request(registration_ids=['id1'], data={})
+
+        self.assertEquals({'Unavailable': ['id1']}, info['errors'])
+        self.assertEquals(1, mock_request.call_count)
+        self.assertFalse(mock_sleep.called)
+
+
+class ConnectionPoolTestCase(TestCase):
+    """
+    Tests for the :class:`chat.gcm_client.ConnectionPool` class.
+    """
+    def setUp(self):
+        self.server = FakeGcmServer()
+        self.server.start()
+        self.pool = ConnectionPool(self.server.url, max_size=2, timeout=5)
+        self.headers = {
+            'Authorization': 'key=dummy-api-key',
+            'Content-Type': 'application/json',
+        }
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def test_connection_reused(self):
+        for i in range(3):
+            status, _, _ = self.pool.request(
+                'POST', '{"registration_ids": ["id1"]}', self.headers)
+            self.assertEquals(200, status)
+
+        self.assertEquals(3, self.server.request_count)
+        self.assertEquals(1, self.server.connection_count)
+
+    def add_idle_connection(self, error):
+        """
+        Puts an idle connection into the pool which fails with the given
+        error.
+        """
+        connection = mock.MagicMock()
+        if isinstance(error, httplib.BadStatusLine):
+            connection.getresponse.side_effect = error
+        else:
+            connection.request.side_effect = error
+        self.pool._idle.append(connection)
+        return connection
+
+    def test_closed_connection_replaced(self):
+        """
+        Tests that a request is retried on a new connection when the server
+        closed an idle connection before responding.
+        """
+        connection = self.add_idle_connection(httplib.BadStatusLine(
+            ConnectionPool.closed_status_line))
+
+        status, _, _ = self.pool.request(
+            'POST', '{"registration_ids": []}', self.headers)
+
+        self.assertEquals(200, status)
+        connection.close.assert_called_once_with()
+
+    def test_reset_connection_replaced(self):
+        self.add_idle_connection(socket.error(errno.ECONNRESET, 'reset'))
+
+        status, _, _ = self.pool.request(
+            'POST', '{"registration_ids": []}', self.headers)
+
+        self.assertEquals(200, status)
+
+    def test_timeout_not_retried(self):
+        """
+        Tests that a request which timed out is not sent again.
+        """
+        self.add_idle_connection(socket.timeout('timed out'))
+
+        with self.assertRaises(socket.timeout):
+            self.pool.request('POST', '{}', self.headers)
+
+        self.assertEquals(0, self.server.request_count)
+
+    def test_invalid_response_not_retried(self):
+        """
+        Tests that a request is not sent again once the server started
+        responding to it.
+        """
+        self.add_idle_connection(httplib.BadStatusLine('garbage'))
+
+        with self.assertRaises(httplib.BadStatusLine):
+            self.pool.request('POST', '{}', self.headers)
+
+        self.assertEquals(0, self.server.request_count)
+
+    def test_connection_error(self):
+        self.pool.close()
+        self.server.stop()
+        pool = ConnectionPool(self.server.url, max_size=2, timeout=5)
+
+        with self.assertRaises((socket.error, httplib.HTTPException)):
+            pool.request('POST', '{}', self.headers)
@@ -5,12 +5,27 @@ from django.test import TestCase
 from django.test.utils import override_settings
 
 from django.core.management import call_command
+from django.core.management.color import no_style
+from django.core.cache import cache
+from django.db import connection
 from django.utils import timezone
 
 import datetime
+import json
+import time
 
+from chat.models import ChatRoom
+from chat.models import Device
+from chat.models import Member
 from chat.models import Message
+from chat.notifiers import gcm_retries
+from chat.notifiers import GcmNotifier
+from chat.notifiers import StreamingNotifier
+from chat.management.commands.benchmark_notifications import percentile
+from chat.management.commands.benchmark_notifications import (
+    Command as BenchmarkCommand)
 
+from .factories import DeviceFactory
 from .factories import MemberFactory
 from .factories import MessageFactory
 from .factories import ChatRoomFactory
@@ -61,3 +76,284 @@ class DeleteStaleMessagesTestCase(TestCase):
         mock_stdout.assert_called_once_with(
             "Deleted {count} expired messages".format(
                 count=len(older_messages)))
+
+
+class ValidatePendingSignaturesTestCase(TestCase):
+    """
+    Tests for the ``validate_pending_signatures`` management command.
+    """
+    @mock.patch(
+        'chat.management.commands.validate_pending_signatures.Command.log')
+    @mock.patch(
+        'chat.management.commands.validate_pending_signatures.'
+        'validate_backlog')
+    @mock.patch(
+        'chat.management.commands.validate_pending_signatures.'
+        'multiprocessing.Pool')
+    def test_command_runs_validation(self, mock_pool, mock_validate, mock_log):
+        """
+        Tests that the command runs the validation on a single pool of the
+        given size and reports the number of validated messages.
+        """
+        mock_validate.return_value = 3
+
+        call_command(
+            'validate_pending_signatures', chunk_size=10, processes=2)
+
+        mock_pool.assert_called_once_with(2)
+        mock_validate.assert_called_once_with(
+            chunk_size=10, pool=mock_pool.return_value)
+        mock_pool.return_value.close.assert_called_once_with()
+        mock_pool.return_value.join.assert_called_once_with()
+        mock_log.assert_called_once_with("Validated 3 messages")
+
+    @mock.patch(
+        'chat.management.commands.validate_pending_signatures.Command.log')
+    @mock.patch(
+        'chat.management.commands.validate_pending_signatures.'
+        'validate_backlog')
+    @mock.patch(
+        'chat.management.commands.validate_pending_signatures.'
+        'multiprocessing.Pool')
+    def test_single_process(self, mock_pool, mock_validate, mock_log):
+        mock_validate.return_value = 0
+
+        call_command('validate_pending_signatures', processes=1)
+
+        self.assertFalse(mock_pool.called)
+        mock_validate.assert_called_once_with(chunk_size=None, pool=None)
+
+
+class ShowMetricsTestCase(TestCase):
+    """
+    Tests for the ``show_metrics`` management command.
+    """
+    def setUp(self):
+        cache.clear()
+        gcm_retries.increment(3)
+        StreamingNotifier.timer.record(0.25)
+
+    @mock.patch('chat.management.commands.show_metrics.Command.log')
+    def test_metrics_shown(self, mock_log):
+        call_command('show_metrics')
+
+        mock_log.assert_any_call('gcm.retries: 3')
+        mock_log.assert_any_call('notifiers.StreamingNotifier: 1 in 250 ms')
+        self.assertEquals(3, gcm_retries.get())
+
+    @mock.patch('chat.management.commands.show_metrics.Command.log')
+    def test_metrics_reset(self, mock_log):
+        call_command('show_metrics', reset=True)
+
+        mock_log.assert_any_call('gcm.retries: 3')
+        self.assertEquals(0, gcm_retries.get())
+
+
+class PercentileTestCase(TestCase):
+    """
+    Tests for the percentiles reported by the ``benchmark_notifications``
+    management command.
+    """
+    def test_percentile(self):
+        values = range(100, 0, -1)
+
+        self.assertEquals(50, percentile(values, .5))
+        self.assertEquals(99, percentile(values, .99))
+        self.assertEquals(100, percentile(values, 1))
+        self.assertEquals(1, percentile(values, 0))
+
+    def test_no_values(self):
+        self.assertIsNone(percentile([], .5))
+
+
+class BenchmarkChatRoomTestCase(TestCase):
+    """
+    Tests for the chat room set up by the ``benchmark_notifications``
+    management command.
+    """
+    def setUp(self):
+        self.command = BenchmarkCommand()
+        self.member = MemberFactory.create(lrz_id='ab00001')
+        DeviceFactory.create(member=self.member)
+
+    def test_existing_members_kept(self):
+        """
+        Tests that existing members are neither added to the benchmark's
+        chat room nor deleted along with it.
+        """
+        chat_room, member_ids, message_ids = self.command.set_up_chat_room(
+            room_size=3, message_count=2)
+
+        self.assertEquals(4, len(member_ids))
+        self.assertNotIn(self.member.pk, member_ids)
+        self.assertEquals(
+            sorted(member_ids),
+            sorted(chat_room.members.values_list('pk', flat=True)))
+        self.assertEquals(2, len(message_ids))
+
+        self.command.tear_down_chat_room(chat_room, member_ids)
+
+        self.assertEquals([self.member], list(Member.objects.all()))
+        self.assertEquals(1, Device.objects.count())
+
+    @override_settings(
+        TCA_ENABLE_STREAMING_NOTIFICATIONS=True,
+        TCA_WEBHOOK_ENDPOINTS=('http://bus.example.com/events',))
+    @mock.patch('chat.tasks._dispatch_notifications')
+    def test_only_gcm_notified(self, mock_dispatch):
+        """
+        Tests that the benchmark's messages are only sent to the GCM
+        notifier, even when other notifiers are configured.
+        """
+        chat_room, member_ids, message_ids = self.command.set_up_chat_room(
+            room_size=1, message_count=1)
+
+        with override_settings(
+                **self.command.get_settings('http://localhost:1/send')):
+            self.command.notify(message_ids[0], time.time())
+
+        notifiers = mock_dispatch.call_args[0][0]
+        self.assertEquals(
+            [GcmNotifier], [notifier.__class__ for notifier in notifiers])
+
+
+class MigrateRegistrationIdsTestCase(TestCase):
+    """
+    Tests for the ``migrate_registration_ids`` management command.
+    """
+    def setUp(self):
+        self.members = MemberFactory.create_batch(2)
+        DeviceFactory.create(member=self.members[0], registration_id='id1')
+
+    def add_column(self):
+        """
+        Helper method adding the registration IDs column used by earlier
+        versions to the members table.
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "ALTER TABLE chat_member "
+            "ADD COLUMN registration_ids text NOT NULL DEFAULT '[]'")
+        cursor.execute(
+            "UPDATE chat_member SET registration_ids = %s WHERE id = %s",
+            [json.dumps(['id1', 'id2']), self.members[0].pk])
+        cursor.execute(
+            "UPDATE chat_member SET registration_ids = %s WHERE id = %s",
+            [json.dumps(['id1']), self.members[1].pk])
+
+    def get_columns(self):
+        cursor = connection.cursor()
+        return [
+            column[0]
+            for column in connection.introspection.get_table_description(
+                cursor, 'chat_member')
+        ]
+
+    @mock.patch(
+        'chat.management.commands.migrate_registration_ids.Command.log')
+    def test_registration_ids_migrated(self, mock_log):
+        self.add_column()
+
+        call_command('migrate_registration_ids')
+
+        self.assertEquals(['id1', 'id2'], self.members[0].registration_ids)
+        self.assertEquals(['id1'], self.members[1].registration_ids)
+        self.assertNotIn('registration_ids', self.get_columns())
+        mock_log.assert_called_once_with("Migrated 2 registration IDs")
+
+    @mock.patch(
+        'chat.management.commands.migrate_registration_ids.Command.log')
+    def test_keep_column(self, mock_log):
+        self.add_column()
+
+        call_command('migrate_registration_ids', keep_column=True)
+
+        self.assertEquals(3, Device.objects.count())
+        self.assertIn('registration_ids', self.get_columns())
+
+    @mock.patch(
+        'chat.management.commands.migrate_registration_ids.Command.log')
+    def test_nothing_to_migrate(self, mock_log):
+        call_command('migrate_registration_ids')
+
+        self.assertEquals(1, Device.objects.count())
+        mock_log.assert_called_once_with(
+            "There are no registration IDs to migrate")
+
+
+class AddChatRoomVersionsTestCase(TestCase):
+    """
+    Tests for the ``add_chat_room_versions`` management command.
+    """
+    def setUp(self):
+        self.chat_room = ChatRoomFactory.create()
+
+    def drop_columns(self):
+        """
+        Helper method dropping the version columns from the chat rooms
+        table, as in databases created by earlier versions.
+        """
+        cursor = connection.cursor()
+        cursor.execute("ALTER TABLE chat_chatroom DROP COLUMN version")
+        cursor.execute("ALTER TABLE chat_chatroom DROP COLUMN last_modified")
+
+    @mock.patch('chat.management.commands.add_chat_room_versions.Command.log')
+    def test_columns_added(self, mock_log):
+        self.drop_columns()
+
+        call_command('add_chat_room_versions')
+
+        chat_room = ChatRoom.objects.get(pk=self.chat_room.pk)
+        self.assertEquals(0, chat_room.version)
+        self.assertIsNotNone(chat_room.last_modified)
+        ChatRoom.objects.mark_modified(chat_room.pk)
+        self.assertEquals(1, ChatRoom.objects.get(pk=chat_room.pk).version)
+        mock_log.assert_called_once_with(
+            "Added the columns version, last_modified")
+
+    @mock.patch('chat.management.commands.add_chat_room_versions.Command.log')
+    def test_up_to_date(self, mock_log):
+        call_command('add_chat_room_versions')
+
+        mock_log.assert_called_once_with(
+            "The chat rooms table is up to date")
+
+
+class CreateMessageIndexesTestCase(TestCase):
+    """
+    Tests for the ``create_message_indexes`` management command.
+    """
+    def drop_index(self, field_names):
+        """
+        Helper method dropping the index on the given fields of the
+        messages table, as in databases created by earlier versions.
+        """
+        fields = [Message._meta.get_field(name) for name in field_names]
+        cursor = connection.cursor()
+        for statement in connection.creation.sql_destroy_indexes_for_fields(
+                Message, fields, no_style()):
+            cursor.execute(statement)
+
+    @mock.patch('chat.management.commands.create_message_indexes.Command.log')
+    def test_missing_index_created(self, mock_log):
+        self.drop_index(['chat_room', 'timestamp', 'id'])
+
+        call_command('create_message_indexes')
+
+        mock_log.assert_any_call(
+            "Created the index on chat_room, timestamp, id")
+        # The index exists once again
+        mock_log.reset_mock()
+        call_command('create_message_indexes')
+        self.assertTrue(all(
+            call[0][0].startswith("Skipped")
+            for call in mock_log.call_args_list))
+
+    @mock.patch('chat.management.commands.create_message_indexes.Command.log')
+    def test_existing_indexes_kept(self, mock_log):
+        call_command('create_message_indexes')
+
+        self.assertEquals(2, mock_log.call_count)
+        for call in mock_log.call_args_list:
+            self.assertTrue(call[0][0].startswith(
+                "Skipped the index on chat_room, "))
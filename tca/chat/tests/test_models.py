@@ -6,7 +6,11 @@ from django.test import TestCase
 from django.test.utils import override_settings
 
 from django.utils import timezone
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
 
+from chat.models import Device
 from chat.models import Member
 from chat.models import Message
 from chat.models import SystemMessage
@@ -14,6 +18,7 @@ from chat.models import ChatRoom
 from chat.models import PublicKey
 from chat.models import PublicKeyConfirmation
 
+from .factories import DeviceFactory
 from .factories import MemberFactory
 from .factories import MessageFactory
 from .factories import ChatRoomFactory
@@ -169,6 +174,19 @@ class MessageSignatureValidationTestCase(TestCase):
         message = Message.objects.get(pk=message.pk)
         self.assertFalse(message.valid)
 
+    @mock.patch('chat.models.crypto.key_cache')
+    def test_public_key_save_invalidates_cache(self, mock_cache):
+        """
+        Tests that saving a public key removes its parsed representation
+        from the key cache.
+        """
+        self.public_key.active = False
+
+        self.public_key.save()
+
+        mock_cache.invalidate.assert_called_once_with(
+            self.public_key.key_text)
+
 
 class MemberTestCase(TestCase):
     def setUp(self):
@@ -244,6 +262,290 @@ class PublicKeyConfirmationTestCase(TestCase):
         self.assertTrue(self.confirmation.is_expired())
 
 
+class ChatRoomVersionTestCase(TestCase):
+    """
+    Tests that the version of a :class:`chat.models.ChatRoom` changes
+    whenever its messages change.
+    """
+    def setUp(self):
+        MemberFactory.create()
+        self.chat_room = ChatRoomFactory.create()
+
+    def get_version(self):
+        return ChatRoom.objects.get(pk=self.chat_room.pk).version
+
+    def test_new_message(self):
+        """
+        Tests that posting a message increments the version.
+        """
+        version = self.get_version()
+
+        MessageFactory.create(chat_room=self.chat_room)
+
+        self.assertEquals(version + 1, self.get_version())
+
+    def test_message_changed(self):
+        """
+        Tests that changing and deleting a message increments the version.
+        """
+        message = MessageFactory.create(chat_room=self.chat_room)
+        version = self.get_version()
+
+        message.valid = True
+        message.save()
+        message.delete()
+
+        self.assertEquals(version + 2, self.get_version())
+
+    def test_other_chat_room_unchanged(self):
+        """
+        Tests that messages posted to a different chat room do not change
+        the version.
+        """
+        version = self.get_version()
+
+        MessageFactory.create(chat_room=ChatRoomFactory.create())
+
+        self.assertEquals(version, self.get_version())
+
+
+class ChatRoomRegistrationIdsTestCase(TestCase):
+    """
+    Tests for the cached registration IDs of the members of a
+    :class:`chat.models.ChatRoom`.
+    """
+    def setUp(self):
+        cache.clear()
+        self.members = MemberFactory.create_batch(3)
+        for member in self.members[:2]:
+            DeviceFactory.create(member=member, registration_id=member.lrz_id)
+        self.chat_room = ChatRoomFactory.create()
+        self.chat_room.members.add(*self.members)
+
+    def get_registration_ids(self):
+        return ChatRoom.objects.get_registration_ids(self.chat_room.pk)
+
+    def test_registration_ids(self):
+        """
+        Tests that the registration IDs of the members which have any are
+        returned.
+        """
+        self.assertEquals({
+            member.pk: [member.lrz_id]
+            for member in self.members[:2]
+        }, self.get_registration_ids())
+
+    def test_single_query(self):
+        """
+        Tests that the registration IDs of all members are obtained by
+        a single query.
+        """
+        with self.assertNumQueries(1):
+            self.get_registration_ids()
+
+    def test_cached(self):
+        """
+        Tests that the registration IDs are obtained from the database only
+        once.
+        """
+        self.get_registration_ids()
+
+        with self.assertNumQueries(0):
+            self.get_registration_ids()
+
+    def test_member_invalidated(self):
+        """
+        Tests that invalidating the registration IDs of a member invalidates
+        the cached registration IDs of the member's chat rooms.
+        """
+        self.get_registration_ids()
+        member = self.members[2]
+        DeviceFactory.create(member=member, registration_id='new-id')
+
+        member.invalidate_registration_ids()
+
+        self.assertEquals(['new-id'], self.get_registration_ids()[member.pk])
+
+    def test_invalidate(self):
+        """
+        Tests that the registration IDs are refreshed after they are
+        invalidated.
+        """
+        self.get_registration_ids()
+        self.chat_room.members.remove(self.members[0])
+
+        ChatRoom.objects.invalidate_registration_ids(self.chat_room.pk)
+
+        self.assertNotIn(self.members[0].pk, self.get_registration_ids())
+
+    def test_stale_mapping_not_used(self):
+        """
+        Tests that a mapping read before it was invalidated is not used
+        even if it is cached after the invalidation.
+        """
+        key = ChatRoom.objects._get_registration_ids_cache_key(
+            self.chat_room.pk)
+        ChatRoom.objects.invalidate_registration_ids(self.chat_room.pk)
+        cache.set(key, {}, 3600)
+
+        self.assertEquals(2, len(self.get_registration_ids()))
+
+    def test_generation_evicted(self):
+        """
+        Tests that mappings of earlier generations are not used after the
+        generation is evicted from the cache.
+        """
+        key = ChatRoom.objects._get_registration_ids_cache_key(
+            self.chat_room.pk)
+        cache.set(key, {}, 3600)
+        cache.delete(ChatRoom.objects._get_registration_ids_generation_key(
+            self.chat_room.pk))
+
+        self.assertEquals(2, len(self.get_registration_ids()))
+
+
+class ChatRoomMembershipTestCase(TestCase):
+    """
+    Tests for the bulk membership methods of the
+    :class:`chat.models.ChatRoomManager`.
+    """
+    def setUp(self):
+        cache.clear()
+        self.chat_room = ChatRoomFactory.create()
+        self.members = MemberFactory.create_batch(3)
+
+    def test_add_members(self):
+        self.chat_room.members.add(self.members[0])
+
+        added = ChatRoom.objects.add_members(
+            self.chat_room, self.members + self.members[1:2])
+
+        self.assertEquals(self.members[1:], added)
+        self.assertEquals(
+            set(self.members), set(self.chat_room.members.all()))
+
+    def test_add_members_invalidates_registration_ids(self):
+        ChatRoom.objects.get_registration_ids(self.chat_room.pk)
+        DeviceFactory.create(member=self.members[0], registration_id='id')
+
+        ChatRoom.objects.add_members(self.chat_room, self.members[:1])
+
+        self.assertEquals(
+            {self.members[0].pk: ['id']},
+            ChatRoom.objects.get_registration_ids(self.chat_room.pk))
+
+    def test_remove_members(self):
+        self.chat_room.members.add(*self.members[:2])
+
+        removed = ChatRoom.objects.remove_members(
+            self.chat_room, self.members[1:])
+
+        self.assertEquals(self.members[1:2], removed)
+        self.assertEquals(
+            [self.members[0]], list(self.chat_room.members.all()))
+
+
+class MemberChatRoomsTestCase(TestCase):
+    """
+    Tests for the :meth:`chat.models.ChatRoomManager.for_member` method.
+    """
+    def setUp(self):
+        self.member = MemberFactory.create()
+        self.chat_rooms = ChatRoomFactory.create_batch(2)
+        for chat_room in self.chat_rooms:
+            chat_room.members.add(self.member)
+        self.messages = MessageFactory.create_batch(
+            3, chat_room=self.chat_rooms[0], member=MemberFactory.create())
+
+    def test_single_query(self):
+        """
+        Tests that the chat rooms are obtained along with their newest
+        message and unread count by a single query.
+        """
+        with self.assertNumQueries(1):
+            chat_rooms = list(ChatRoom.objects.for_member(
+                self.member.pk, since_id=self.messages[0].pk))
+
+        self.assertEquals(self.chat_rooms, chat_rooms)
+        self.assertEquals(
+            self.messages[-1].pk, chat_rooms[0].latest_message_id)
+        self.assertEquals(2, chat_rooms[0].unread_count)
+        self.assertIsNone(chat_rooms[1].latest_message_id)
+        self.assertEquals(0, chat_rooms[1].unread_count)
+
+    def test_count(self):
+        """
+        Tests that the chat rooms can be counted, as done when paginating
+        them.
+        """
+        chat_rooms = ChatRoom.objects.for_member(self.member.pk)
+
+        self.assertEquals(2, chat_rooms.count())
+
+
+class DeviceManagerTestCase(TestCase):
+    """
+    Tests for registering and unregistering devices by the
+    :class:`chat.models.DeviceManager`.
+    """
+    def setUp(self):
+        cache.clear()
+        self.member = MemberFactory.create()
+        DeviceFactory.create(member=self.member, registration_id='id1')
+        self.chat_room = ChatRoomFactory.create()
+        self.chat_room.members.add(self.member)
+
+    def test_register(self):
+        count = Device.objects.register(self.member, ['id2', 'id3', 'id2'])
+
+        self.assertEquals(2, count)
+        self.assertEquals(['id1', 'id2', 'id3'], self.member.registration_ids)
+
+    def test_register_existing(self):
+        """
+        Tests that registering a registration ID which the member already
+        has does not change anything.
+        """
+        ChatRoom.objects.get_registration_ids(self.chat_room.pk)
+
+        count = Device.objects.register(self.member, ['id1'])
+
+        self.assertEquals(0, count)
+        self.assertEquals(['id1'], self.member.registration_ids)
+        # The cached registration IDs are still valid
+        with self.assertNumQueries(0):
+            ChatRoom.objects.get_registration_ids(self.chat_room.pk)
+
+    def test_register_invalidates_cache(self):
+        ChatRoom.objects.get_registration_ids(self.chat_room.pk)
+
+        Device.objects.register(self.member, ['id2'])
+
+        self.assertEquals(
+            ['id1', 'id2'],
+            ChatRoom.objects.get_registration_ids(
+                self.chat_room.pk)[self.member.pk])
+
+    def test_unregister(self):
+        DeviceFactory.create(member=self.member, registration_id='id2')
+
+        count = Device.objects.unregister(self.member, ['id1', 'unknown'])
+
+        self.assertEquals(1, count)
+        self.assertEquals(['id2'], self.member.registration_ids)
+
+    def test_unregister_other_member(self):
+        """
+        Tests that only the given member's devices are unregistered.
+        """
+        other = MemberFactory.create()
+
+        count = Device.objects.unregister(other, ['id1'])
+
+        self.assertEquals(0, count)
+        self.assertEquals(['id1'], self.member.registration_ids)
+
+
 class SystemMessageTestCase(TestCase):
     """
     Tests for the :class:`chat.models.SystemMessage` model.
@@ -348,6 +650,77 @@ class SystemMessageTestCase(TestCase):
         self.assertEquals(SystemMessage.get_bot_user(), msg.member)
 
 
+    def test_bot_id_cached(self):
+        """
+        Tests that the bot user is looked up only once.
+        """
+        self.set_up_system_message()
+
+        with self.assertNumQueries(0):
+            msg = self.set_up_system_message()
+
+        self.assertEquals(SystemMessage.get_bot_user(), msg.member)
+        self.assertEquals("bot", msg.member.lrz_id)
+
+    def test_bot_not_looked_up_when_loaded(self):
+        """
+        Tests that no query is made to find the bot user when system
+        messages are loaded from the database.
+        """
+        self.set_up_system_message(auto_save=True)
+        SystemMessage.clear_bot_cache()
+
+        with self.assertNumQueries(1):
+            msg = SystemMessage.objects.get()
+
+        self.assertEquals(SystemMessage.get_bot_user().pk, msg.member_id)
+
+    def test_bot_deleted(self):
+        """
+        Tests that the cached bot user is discarded when it is deleted.
+        """
+        SystemMessage.get_bot_id()
+
+        SystemMessage.get_bot_user().delete()
+
+        msg = self.set_up_system_message(auto_save=True)
+        self.assertEquals(SystemMessage.get_bot_user(), msg.member)
+
+    def delete_bot_row(self):
+        """
+        Helper method deleting the bot user's row the way another process
+        would, without this process being notified of it.
+        """
+        connection.cursor().execute(
+            "DELETE FROM chat_member WHERE id = %s",
+            [SystemMessage.get_bot_id()])
+
+    def test_missing_bot_looked_up(self):
+        """
+        Tests that the bot user is looked up again when saving a message
+        after the cached one was deleted.
+        """
+        self.delete_bot_row()
+
+        msg = self.set_up_system_message(auto_save=False)
+        msg.save()
+
+        self.assertTrue(Member.objects.filter(
+            pk=msg.member_id, lrz_id='bot').exists())
+        self.assertEquals(msg.member_id, SystemMessage._bot_id)
+
+    def test_flush(self):
+        """
+        Tests that the cached bot user is discarded when the database is
+        flushed.
+        """
+        SystemMessage.get_bot_id()
+
+        call_command('flush', interactive=False, verbosity=0)
+
+        self.assertIsNone(SystemMessage._bot_id)
+
+
 class SystemMessageManagerTestCase(TestCase):
     """
     Tests for the :class:`chat.models.SystemMessageManager` manager.
@@ -417,3 +790,54 @@ class SystemMessageManagerTestCase(TestCase):
         self.assertEquals(self.get_member_left_text(), message.text)
         # In the correct chat room?
         self.assertEquals(self.chat_room, message.chat_room)
+
+    def test_bulk_create_members_joined(self):
+        members = MemberFactory.create_batch(2)
+
+        with mock.patch('chat.models.get_broker') as mock_broker:
+            messages = SystemMessage.objects.bulk_create_members_joined(
+                members, self.chat_room)
+
+        self.assertEquals(2, len(messages))
+        self.assertEquals(
+            [self.get_member_joined_text(member) for member in members],
+            list(self.chat_room.messages.order_by('pk').values_list(
+                'text', flat=True)))
+        newest = self.chat_room.messages.order_by('-pk')[0]
+        self.assertEquals(SystemMessage.get_bot_id(), newest.member_id)
+        # System messages are not signed, yet valid
+        self.assertFalse(self.chat_room.messages.filter(valid=False).exists())
+        mock_broker.return_value.publish.assert_called_once_with(
+            mock.ANY, {'id': newest.pk})
+
+    def test_bulk_create_members_left_summarized(self):
+        members = MemberFactory.create_batch(3)
+
+        SystemMessage.objects.bulk_create_members_left(
+            members, self.chat_room, summarize=True)
+
+        self.assertEquals(
+            ["3 members have left the chat room."],
+            list(self.chat_room.messages.values_list('text', flat=True)))
+
+    def test_bulk_create_missing_bot_looked_up(self):
+        """
+        Tests that the bot user is looked up again when bulk creating
+        messages after the cached one was deleted by another process.
+        """
+        connection.cursor().execute(
+            "DELETE FROM chat_member WHERE id = %s",
+            [SystemMessage.get_bot_id()])
+
+        messages = SystemMessage.objects.bulk_create_members_joined(
+            [self.member], self.chat_room)
+
+        self.assertTrue(Member.objects.filter(
+            pk=messages[0].member_id, lrz_id='bot').exists())
+
+    def test_bulk_create_no_members(self):
+        with self.assertNumQueries(0):
+            messages = SystemMessage.objects.bulk_create_members_joined(
+                [], self.chat_room)
+
+        self.assertEquals([], messages)
@@ -4,12 +4,29 @@ Tests for the :mod:`chat.notifiers` module classes.
 
 from django.test import TestCase
 from django.test.utils import override_settings
+from django.core.cache import cache
 
+from gcm.gcm import GCMAuthenticationException
+
+from rest_framework.renderers import JSONRenderer
+
+import json
 import mock
 
 from chat.notifiers import GcmNotifier
+from chat.notifiers import gcm_retries
+from chat.notifiers import gcm_dropped_registration_ids
+from chat.notifiers import StreamingNotifier
+from chat.notifiers import get_notifier
+from chat.notifiers import get_notifiers
+from chat.notifiers import reset_notifiers
+from chat.notifiers import message_to_data
+from chat.serializers import ListMessageSerializer
+from chat.broker import get_chat_room_stream_channel
 from chat.hooks import validate_message_signature
+from chat.gcm_client import GCMUnavailableException
 
+from .factories import DeviceFactory
 from .factories import MemberFactory
 from .factories import MessageFactory
 from .factories import ChatRoomFactory
@@ -27,10 +44,10 @@ class GcmNotifierTestCase(TestCase):
         Helper method which helps set up a member with a dummy registration
         ID.
         """
-        member.registration_ids = [member.lrz_id]
-        member.save()
+        DeviceFactory.create(member=member, registration_id=member.lrz_id)
 
     def setUp(self):
+        cache.clear()
         self.members = MemberFactory.create_batch(5)
         # Give each member a unique dummy registration ID
         for member in self.members:
@@ -72,25 +89,33 @@ class GcmNotifierTestCase(TestCase):
         dictionary correctly represents the given ``message``
         """
         fields = (
-            'timestamp',
+            'type',
             'url',
             'text',
             'member',
-            'valid',
-            'signature',
             'chat_room',
             'id',
         )
         self.assertEquals(len(fields), len(data.items()))
 
-        self.assertTrue(data['url'].endswith(message.get_absolute_url()))
-        self.assertTrue(data['member']['url'].endswith(
-            message.member.get_absolute_url()))
-        self.assertEquals(data['member']['lrz_id'], message.member.lrz_id)
+        self.assertEquals('message', data['type'])
+        self.assertEquals(data['url'], message.get_absolute_url())
+        self.assertEquals(data['member'], unicode(message.member))
         self.assertEquals(data['text'], message.text)
-        self.assertEquals(data['valid'], message.valid)
-        self.assertEquals(data['signature'], message.signature)
-        self.assertEquals(data['chat_room']['id'], message.chat_room.pk)
+        self.assertEquals(data['chat_room'], message.chat_room.pk)
+        self.assertEquals(data['id'], message.pk)
+
+    def assert_options_correct(self, kwargs, message):
+        """
+        Helper assertion method checking whether the given ``kwargs`` of
+        a GCM request contain the correct options for the given
+        ``message``
+        """
+        self.assertEquals(
+            'chat-room-{id}'.format(id=message.chat_room.pk),
+            kwargs['collapse_key'])
+        self.assertIn('time_to_live', kwargs)
+        self.assertIn('delay_while_idle', kwargs)
 
     def test_notification_duplicate_registration_id(self, gcm_mock):
         """
@@ -101,12 +126,11 @@ class GcmNotifierTestCase(TestCase):
         # Join a part of the members to the chat room
         # - the sender has got to be a part of it
         self.target_chat_room.members.add(self.sender)
-        # Add one receiver to the chat room
-        self.target_chat_room.members.add(self.members[0])
-        # Make the receiver have a duplicate registration ID
-        self.members[0].registration_ids.append(
-            self.members[0].registration_ids[0])
-        self.members[0].save()
+        # Add two receivers sharing a device to the chat room
+        self.target_chat_room.members.add(self.members[0], self.members[1])
+        DeviceFactory.create(
+            member=self.members[1],
+            registration_id=self.members[0].lrz_id)
         # Set up a message in the chat room
         message = MessageFactory.create(
             chat_room=self.target_chat_room,
@@ -120,13 +144,14 @@ class GcmNotifierTestCase(TestCase):
         args, kwargs = gcm_mock_instance.json_request.call_args
         # No positional arguments
         self.assertEquals(0, len(args))
-        # Exactly 2 kwargs
-        self.assertEqual(2, len(kwargs.items()))
+        # The registration IDs, data and the options of the request
+        self.assertEqual(5, len(kwargs.items()))
         self.assertIn('registration_ids', kwargs)
         self.assertIn('data', kwargs)
+        self.assert_options_correct(kwargs, message)
         # Correct values for them?
         # - registration IDs
-        expected_ids = list(set(self.members[0].registration_ids))
+        expected_ids = [self.members[0].lrz_id, self.members[1].lrz_id]
         self.assertItemsEqual(expected_ids, kwargs['registration_ids'])
         # - data
         self.assert_data_correct(kwargs['data'], message)
@@ -156,10 +181,11 @@ class GcmNotifierTestCase(TestCase):
         args, kwargs = gcm_mock_instance.json_request.call_args
         # No positional arguments
         self.assertEquals(0, len(args))
-        # Exactly 2 kwargs
-        self.assertEqual(2, len(kwargs.items()))
+        # The registration IDs, data and the options of the request
+        self.assertEqual(5, len(kwargs.items()))
         self.assertIn('registration_ids', kwargs)
         self.assertIn('data', kwargs)
+        self.assert_options_correct(kwargs, message)
         # Correct values for them?
         # - registration IDs
         expected_ids = self.get_registration_ids(self.members[:3])
@@ -167,6 +193,99 @@ class GcmNotifierTestCase(TestCase):
         # - data
         self.assert_data_correct(kwargs['data'], message)
 
+    def test_notification_coalesced(self, gcm_mock):
+        """
+        Tests that a coalesced notification carries the newest message and
+        the number of messages.
+        """
+        self.set_up_notifier()
+        self.target_chat_room.members.add(self.sender, self.members[0])
+        message = MessageFactory.create(
+            chat_room=self.target_chat_room,
+            member=self.sender)
+        gcm_mock().json_request.return_value = {}
+
+        self.notifier.notify_coalesced(message, 5)
+
+        _, kwargs = gcm_mock().json_request.call_args
+        self.assertEquals(
+            self.members[0].registration_ids, kwargs['registration_ids'])
+        self.assertEquals(5, kwargs['data'].pop('new_message_count'))
+        self.assert_data_correct(kwargs['data'], message)
+
+    def test_coalesced_notification_to_sender(self, gcm_mock):
+        """
+        Tests that the sender of the newest message gets a coalesced
+        notification when other members posted some of the messages.
+        """
+        self.set_up_notifier()
+        self.target_chat_room.members.add(self.sender, self.members[0])
+        message = MessageFactory.create(
+            chat_room=self.target_chat_room,
+            member=self.sender)
+        gcm_mock().json_request.return_value = {}
+
+        self.notifier.notify_coalesced(message, 2, notify_sender=True)
+
+        _, kwargs = gcm_mock().json_request.call_args
+        self.assertItemsEqual(
+            self.get_registration_ids([self.sender, self.members[0]]),
+            kwargs['registration_ids'])
+
+    def test_text_preview(self, gcm_mock):
+        """
+        Tests that only a preview of a long text is sent.
+        """
+        self.set_up_notifier()
+        message = MessageFactory.create(
+            chat_room=self.target_chat_room,
+            member=self.sender,
+            text='a' * 1000)
+
+        with self.settings(TCA_GCM_PREVIEW_LENGTH=10):
+            data = self.notifier._message_to_data(message)
+
+        self.assertEquals(10, len(data['text']))
+        self.assertTrue(data['text'].startswith('a' * 5))
+
+    def test_payload_too_large(self, gcm_mock):
+        """
+        Tests that the clients are only told to fetch a message whose
+        notification would be too large.
+        """
+        self.set_up_notifier()
+        message = MessageFactory.create(
+            chat_room=self.target_chat_room,
+            member=self.sender,
+            text='a' * 5000)
+
+        with self.settings(TCA_GCM_PREVIEW_LENGTH=5000):
+            data = self.notifier._message_to_data(message)
+
+        self.assertEquals({
+            'type': 'fetch',
+            'id': message.pk,
+            'chat_room': self.target_chat_room.pk,
+        }, data)
+
+    def test_registration_ids_cached(self, gcm_mock):
+        """
+        Tests that the registration IDs of the chat room's members are not
+        obtained from the database for every message.
+        """
+        self.set_up_notifier()
+        self.target_chat_room.members.add(self.sender, *self.members)
+        messages = MessageFactory.create_batch(
+            2, chat_room=self.target_chat_room, member=self.sender)
+        self.notifier._get_registration_ids(messages[0])
+
+        with self.assertNumQueries(0):
+            registration_ids = self.notifier._get_registration_ids(
+                messages[1])
+
+        self.assertItemsEqual(
+            self.get_registration_ids(self.members), registration_ids)
+
     def test_no_notification_empty_chat_room(self, gcm_mock):
         """
         Tests that there is no notification sent when there is only a
@@ -187,6 +306,198 @@ class GcmNotifierTestCase(TestCase):
         # No calls to the GCM service
         self.assertFalse(gcm_mock_instance.json_request.called)
 
+    def test_registration_ids_chunked(self, gcm_mock):
+        """
+        Tests that the registration IDs are split into chunks which GCM
+        accepts in a single request.
+        """
+        self.set_up_notifier()
+        registration_ids = [str(index) for index in range(2500)]
+        gcm_mock_instance = gcm_mock()
+        # Set up the mocked method before it is used by multiple threads
+        gcm_mock_instance.json_request.return_value = {}
+
+        results = self.notifier._send_request(registration_ids, {})
+
+        calls = gcm_mock_instance.json_request.call_args_list
+        self.assertEquals(3, len(calls))
+        self.assertItemsEqual(
+            registration_ids,
+            [reg_id
+             for _, kwargs in calls
+             for reg_id in kwargs['registration_ids']])
+        self.assertTrue(all(
+            len(kwargs['registration_ids']) <= 1000
+            for _, kwargs in calls))
+        # A result for each chunk
+        self.assertEquals(
+            registration_ids,
+            [reg_id for chunk, _, _ in results for reg_id in chunk])
+        self.assertTrue(all(
+            response is gcm_mock_instance.json_request.return_value
+            for _, response, _ in results))
+
+    @mock.patch('chat.notifiers.logger')
+    def test_failed_chunk(self, mock_logger, gcm_mock):
+        """
+        Tests that a chunk failing to be sent does not prevent the other
+        chunks from being sent.
+        """
+        self.set_up_notifier()
+        registration_ids = [str(index) for index in range(1500)]
+        gcm_mock_instance = gcm_mock()
+
+        def json_request(registration_ids, data):
+            if '0' in registration_ids:
+                raise Exception
+            return {}
+        gcm_mock_instance.json_request.side_effect = json_request
+
+        results = self.notifier._send_request(registration_ids, {})
+
+        self.assertEquals(2, gcm_mock_instance.json_request.call_count)
+        self.assertEquals(
+            [None, {}], [response for _, response, _ in results])
+        # The failure is not swallowed silently
+        self.assertEquals(1, mock_logger.exception.call_count)
+
+    @mock.patch('chat.tasks.send_gcm_notification')
+    @mock.patch('chat.tasks.update_registration_ids')
+    def test_registration_ids_updated(
+            self, mock_update, mock_send_notification, gcm_mock):
+        """
+        Tests that the canonical and no longer valid registration IDs
+        reported by GCM are handed to the task updating the members.
+        """
+        self.set_up_notifier()
+        self.target_chat_room.members.add(self.sender, *self.members[:3])
+        message = MessageFactory.create(
+            chat_room=self.target_chat_room,
+            member=self.sender)
+        gcm_mock().json_request.return_value = {
+            'canonical': {self.members[0].lrz_id: 'canonical'},
+            'errors': {
+                'NotRegistered': [self.members[1].lrz_id],
+                'Unavailable': [self.members[2].lrz_id],
+            },
+        }
+
+        self.notifier.notify(message)
+
+        self.assertEquals(1, mock_update.delay.call_count)
+        changes = mock_update.delay.call_args[0][0]
+        self.assertItemsEqual([
+            (self.members[0].pk, {self.members[0].lrz_id: 'canonical'}, []),
+            (self.members[1].pk, {}, [self.members[1].lrz_id]),
+        ], changes)
+
+    @mock.patch('chat.tasks.update_registration_ids')
+    def test_registration_ids_not_updated(self, mock_update, gcm_mock):
+        """
+        Tests that no update is scheduled when GCM does not report any
+        changed registration IDs.
+        """
+        self.set_up_notifier()
+        self.target_chat_room.members.add(self.sender, *self.members[:3])
+        message = MessageFactory.create(
+            chat_room=self.target_chat_room,
+            member=self.sender)
+        gcm_mock().json_request.return_value = {}
+
+        self.notifier.notify(message)
+
+        self.assertFalse(mock_update.delay.called)
+
+    def send_failing(self, gcm_mock, error, attempt=1):
+        """
+        Helper method sending a notification to some registration IDs,
+        where the request to GCM raises the given error.
+
+        :returns: The mocked task retrying the notification
+        """
+        self.set_up_notifier()
+        gcm_mock().json_request.side_effect = error
+        with mock.patch('chat.tasks.send_gcm_notification') as mock_task:
+            self.notifier.send(
+                self.target_chat_room.pk, ['id1', 'id2'], {}, attempt)
+
+        return mock_task
+
+    @mock.patch('chat.notifiers.logger')
+    def test_retry_unavailable(self, mock_logger, gcm_mock):
+        """
+        Tests that a notification is retried after GCM was unavailable, no
+        sooner than GCM requested.
+        """
+        mock_task = self.send_failing(
+            gcm_mock, GCMUnavailableException('error', retry_after=120))
+
+        self.assertEquals(1, mock_task.apply_async.call_count)
+        _, kwargs = mock_task.apply_async.call_args
+        self.assertEquals(
+            (self.target_chat_room.pk, ['id1', 'id2'], {}, 2),
+            kwargs['args'])
+        self.assertGreaterEqual(kwargs['countdown'], 120)
+        self.assertEquals(1, gcm_retries.get())
+
+    def test_retry_unavailable_registration_ids(self, gcm_mock):
+        """
+        Tests that only the registration IDs for which GCM was unavailable
+        are retried.
+        """
+        self.set_up_notifier()
+        gcm_mock().json_request.return_value = {
+            'errors': {'Unavailable': ['id2']},
+        }
+
+        with mock.patch('chat.tasks.send_gcm_notification') as mock_task:
+            self.notifier.send(
+                self.target_chat_room.pk, ['id1', 'id2'], {})
+
+        _, kwargs = mock_task.apply_async.call_args
+        self.assertEquals(['id2'], kwargs['args'][1])
+
+    @mock.patch('chat.notifiers.logger')
+    def test_no_retry_permanent_error(self, mock_logger, gcm_mock):
+        """
+        Tests that a notification is not retried when the error is not
+        a temporary one.
+        """
+        mock_task = self.send_failing(
+            gcm_mock, GCMAuthenticationException())
+
+        self.assertFalse(mock_task.apply_async.called)
+
+    @override_settings(TCA_GCM_MAX_ATTEMPTS=3)
+    @mock.patch('chat.notifiers.logger')
+    def test_max_attempts(self, mock_logger, gcm_mock):
+        """
+        Tests that a notification is no longer retried once the maximum
+        number of attempts is reached.
+        """
+        mock_task = self.send_failing(
+            gcm_mock, GCMUnavailableException('error'), attempt=3)
+
+        self.assertFalse(mock_task.apply_async.called)
+        self.assertEquals(2, gcm_dropped_registration_ids.get())
+
+    @override_settings(TCA_GCM_RETRY_BASE_DELAY=2, TCA_GCM_RETRY_MAX_DELAY=10)
+    def test_retry_delay(self, gcm_mock):
+        """
+        Tests that the delay between attempts grows exponentially up to
+        the maximum delay.
+        """
+        self.set_up_notifier()
+
+        with mock.patch('chat.notifiers.random.uniform') as mock_uniform:
+            for attempt in range(1, 5):
+                self.notifier._get_retry_delay(attempt)
+
+        self.assertEquals(
+            [mock.call(0, 2), mock.call(0, 4), mock.call(0, 8),
+             mock.call(0, 10)],
+            mock_uniform.call_args_list)
+
     @override_settings(TCA_ENABLE_GCM_NOTIFICATIONS=False)
     def test_gcm_notifier_disabled(self, gcm_mock):
         """
@@ -215,6 +526,151 @@ class GcmNotifierTestCase(TestCase):
         gcm_mock.assert_called_once_with('override-settings-dummy-api-key')
 
 
+class MessageToDataTestCase(TestCase):
+    """
+    Tests for the :func:`chat.notifiers.message_to_data` function.
+    """
+    def setUp(self):
+        cache.clear()
+        MemberFactory.create_batch(2)
+        ChatRoomFactory.create()
+        self.message = MessageFactory.create()
+
+    def test_same_as_rendered(self):
+        """
+        Tests that the data is the same as the JSON representation of the
+        message.
+        """
+        rendered = json.loads(JSONRenderer().render(
+            ListMessageSerializer(self.message).data))
+
+        self.assertEquals(rendered, message_to_data(self.message))
+
+    def test_cached(self):
+        """
+        Tests that the message is serialized only once.
+        """
+        data = message_to_data(self.message)
+
+        serializer_patch = mock.patch('chat.notifiers.ListMessageSerializer')
+        with self.assertNumQueries(0), serializer_patch as mock_serializer:
+            self.assertEquals(data, message_to_data(self.message))
+
+        self.assertFalse(mock_serializer.called)
+
+    def test_validity_changed(self):
+        """
+        Tests that the cached data is not used once the validity of the
+        message changes.
+        """
+        message_to_data(self.message)
+
+        self.message.valid = not self.message.valid
+        self.message.save()
+
+        self.assertEquals(
+            self.message.valid, message_to_data(self.message)['valid'])
+
+
+@mock.patch('chat.notifiers.get_broker')
+class StreamingNotifierTestCase(TestCase):
+    """
+    Tests for the :class:`chat.notifiers.StreamingNotifier` class.
+    """
+    def setUp(self):
+        cache.clear()
+        MemberFactory.create_batch(2)
+        self.chat_room = ChatRoomFactory.create()
+        self.message = MessageFactory.create(chat_room=self.chat_room)
+        self.notifier = StreamingNotifier.get_instance()
+
+    def test_message_published(self, mock_get_broker):
+        """
+        Tests that the serialized message is published to the chat room's
+        stream channel.
+        """
+        self.notifier.notify(self.message)
+
+        broker = mock_get_broker()
+        self.assertEquals(1, broker.publish.call_count)
+        channel, event = broker.publish.call_args[0]
+        self.assertEquals(
+            get_chat_room_stream_channel(self.chat_room.pk), channel)
+        self.assertEquals('message', event['type'])
+        self.assertEquals(self.message.pk, event['message']['id'])
+        self.assertEquals(self.message.text, event['message']['text'])
+
+    def test_message_too_large(self, mock_get_broker):
+        """
+        Tests that only the ID of the message is published when the broker
+        refuses the complete message.
+        """
+        broker = mock_get_broker()
+        broker.publish.side_effect = [ValueError, None]
+
+        self.notifier.notify(self.message)
+
+        self.assertEquals(2, broker.publish.call_count)
+        broker.publish.assert_called_with(
+            get_chat_room_stream_channel(self.chat_room.pk), {
+                'type': 'fetch',
+                'id': self.message.pk,
+            })
+
+    @override_settings(TCA_ENABLE_STREAMING_NOTIFICATIONS=False)
+    def test_disabled(self, mock_get_broker):
+        self.assertFalse(StreamingNotifier.is_enabled())
+
+    @override_settings(TCA_ENABLE_STREAMING_NOTIFICATIONS=True)
+    def test_enabled(self, mock_get_broker):
+        self.assertTrue(StreamingNotifier.is_enabled())
+
+
+@override_settings(
+    TCA_ENABLE_STREAMING_NOTIFICATIONS=True,
+    TCA_ENABLE_GCM_NOTIFICATIONS=False,
+    TCA_GCM_API_KEY='dummy-api-key')
+class GetNotifierTestCase(TestCase):
+    """
+    Tests for the :func:`chat.notifiers.get_notifier` function.
+    """
+    def setUp(self):
+        reset_notifiers()
+
+    def tearDown(self):
+        reset_notifiers()
+
+    def test_instance_reused(self):
+        notifier = get_notifier(StreamingNotifier)
+
+        self.assertIs(notifier, get_notifier(StreamingNotifier))
+        self.assertIn(notifier, get_notifiers())
+
+    @mock.patch('chat.notifiers.os.getpid')
+    def test_new_instance_after_fork(self, mock_getpid):
+        mock_getpid.return_value = 1
+        notifier = get_notifier(StreamingNotifier)
+
+        mock_getpid.return_value = 2
+
+        self.assertIsNot(notifier, get_notifier(StreamingNotifier))
+
+    @mock.patch('chat.notifiers.GCM')
+    def test_reset_closes_instances(self, mock_gcm):
+        notifier = get_notifier(GcmNotifier)
+
+        reset_notifiers()
+
+        mock_gcm.return_value.close.assert_called_once_with()
+        self.assertIsNot(notifier, get_notifier(GcmNotifier))
+
+    def test_reset_on_setting_change(self):
+        notifier = get_notifier(StreamingNotifier)
+
+        with override_settings(TCA_GCM_TIMEOUT=1):
+            self.assertIsNot(notifier, get_notifier(StreamingNotifier))
+
+
 @mock.patch('chat.hooks.send_message_notifications')
 class ValidateMessageHookTestCase(TestCase):
     """
@@ -255,3 +711,17 @@ class ValidateMessageHookTestCase(TestCase):
         validate_message_signature(self.message)
 
         self.assertFalse(mock_send_notifications.delay.called)
+
+    @override_settings(TCA_ASYNC_SIGNATURE_VALIDATION=True)
+    @mock.patch('chat.hooks.validate_message')
+    def test_async_validation(
+            self, mock_validate_message, mock_send_notifications):
+        """
+        Tests that when asynchronous validation is enabled, the validation
+        is deferred to a task instead of being performed by the hook.
+        """
+        validate_message_signature(self.message)
+
+        mock_validate_message.delay.assert_called_once_with(self.mock_pk)
+        self.assertFalse(self.message.validate_signature.called)
+        self.assertFalse(mock_send_notifications.delay.called)
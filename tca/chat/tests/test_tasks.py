@@ -6,44 +6,92 @@ from django.test import TestCase
 from django.test.utils import override_settings
 
 from django.core import mail
+from django.core.cache import cache
+from django.db import DatabaseError
 
+from .factories import DeviceFactory
 from .factories import MemberFactory
 from .factories import MessageFactory
 from .factories import ChatRoomFactory
 from .factories import PublicKeyFactory
 
+from chat.models import Device
+from chat.models import Member
+from chat.models import Message
+from chat.models import ChatRoom
 from chat.models import PublicKeyConfirmation
+from chat.models import SystemMessage
 
 from chat.tasks import send_message_notifications
 from chat.tasks import send_confirmation_email
+from chat.tasks import validate_message
+from chat.tasks import validate_backlog
+from chat.tasks import validate_pending_signatures
+from chat.tasks import update_registration_ids
+from chat.tasks import send_gcm_notification
+from chat.tasks import send_coalesced_notifications
+from chat.tasks import _get_coalescing_keys
+from chat.tasks import COALESCING_GAP_RETRIES
+from chat.tasks import run_notifier
+from chat.tasks import warm_caches
+from chat.tasks import notifier_failures
+from chat.tasks import notifier_timeouts
 
 from chat.hooks import confirm_new_key
+from chat.notifiers import GcmNotifier
+from chat.notifiers import StreamingNotifier
+
+from celery.exceptions import SoftTimeLimitExceeded
 
 import mock
+import multiprocessing
+import json
+import os
+
+
+def mock_notifiers(mock_get_notifiers, mock_get_notifier, notifiers):
+    """
+    Helper function making the given mock notifiers the ones which are
+    enabled. Each of them needs to be specced by a different notifier
+    class.
+    """
+    mock_get_notifiers.return_value = notifiers
+    mock_get_notifier.side_effect = lambda notifier_class: next(
+        notifier
+        for notifier in notifiers
+        if notifier.__class__ is notifier_class
+    )
 
 
+@override_settings(CELERY_ALWAYS_EAGER=True)
+@mock.patch('chat.tasks.get_notifier')
 @mock.patch('chat.tasks.get_notifiers')
 class SendMessageNotificationsTaskTestCase(TestCase):
     """
     Tests for the :func:`chat.tasks.send_message_notifications` task.
     """
     def setUp(self):
+        cache.clear()
         MemberFactory.create_batch(5)
         ChatRoomFactory.create_batch(5)
         self.message = MessageFactory.create()
         self.mock_notifiers = [
-            mock.MagicMock(),
-            mock.MagicMock(),
+            mock.MagicMock(spec=GcmNotifier),
+            mock.MagicMock(spec=StreamingNotifier),
         ]
+        for notifier in self.mock_notifiers:
+            notifier.get_timeout.return_value = 30
 
-    def set_up_mock_notifiers(self, mock_get_notifiers):
-        mock_get_notifiers.return_value = self.mock_notifiers
+    def set_up_mock_notifiers(self, mock_get_notifiers, mock_get_notifier):
+        mock_notifiers(
+            mock_get_notifiers, mock_get_notifier, self.mock_notifiers)
 
-    def test_send_notifications_existing_message(self, mock_get_notifiers):
+    def test_send_notifications_existing_message(
+            self, mock_get_notifiers, mock_get_notifier):
         """
         Tests that all notifiers are correctly notified when the task runs.
         """
-        self.set_up_mock_notifiers(mock_get_notifiers)
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
 
         send_message_notifications(self.message.pk)
 
@@ -52,12 +100,12 @@ class SendMessageNotificationsTaskTestCase(TestCase):
         for mock_notifier in self.mock_notifiers:
             mock_notifier.notify.assert_called_once_with(self.message)
 
-    def test_invalid_message_pk(self, mock_get_notifiers):
+    def test_invalid_message_pk(self, mock_get_notifiers, mock_get_notifier):
         """
         Tests that when the task receives a message id which does not
         exist, no notifiers are notified of anything.
         """
-        self.set_up_mock_notifiers(mock_get_notifiers)
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
 
         # Initiate the task with a non existent message PK
         send_message_notifications(self.message.pk + 5)
@@ -66,6 +114,492 @@ class SendMessageNotificationsTaskTestCase(TestCase):
         for mock_notifier in self.mock_notifiers:
             self.assertFalse(mock_notifier.notify.called)
 
+    @mock.patch('chat.tasks.run_notifier')
+    @mock.patch('chat.tasks.group')
+    def test_notifiers_run_concurrently(
+            self, mock_group, mock_run_notifier, mock_get_notifiers,
+            mock_get_notifier):
+        """
+        Tests that each notifier is run by a separate subtask of a group,
+        limited to the notifier's timeout.
+        """
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
+        self.mock_notifiers[1].get_timeout.return_value = 5
+
+        send_message_notifications(self.message.pk)
+
+        self.assertEquals([
+            mock.call(
+                args=('GcmNotifier', self.message.pk, None, False),
+                soft_time_limit=30,
+                time_limit=35),
+            mock.call(
+                args=('StreamingNotifier', self.message.pk, None, False),
+                soft_time_limit=5,
+                time_limit=10),
+        ], mock_run_notifier.subtask.call_args_list)
+        mock_group.return_value.apply_async.assert_called_once_with()
+
+    def test_failure_isolated(self, mock_get_notifiers, mock_get_notifier):
+        """
+        Tests that a notifier which fails does not prevent the other
+        notifiers from being notified.
+        """
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
+        self.mock_notifiers[0].notify.side_effect = Exception()
+
+        send_message_notifications(self.message.pk)
+
+        self.mock_notifiers[1].notify.assert_called_once_with(self.message)
+        self.assertEquals(1, notifier_failures.get())
+
+
+@mock.patch('chat.tasks.get_notifier')
+class RunNotifierTaskTestCase(TestCase):
+    """
+    Tests for the :func:`chat.tasks.run_notifier` task.
+    """
+    def setUp(self):
+        cache.clear()
+        MemberFactory.create_batch(2)
+        self.message = MessageFactory.create(
+            chat_room=ChatRoomFactory.create())
+
+    def test_notification_timed(self, mock_get_notifier):
+        run_notifier('StreamingNotifier', self.message.pk)
+
+        mock_get_notifier.assert_called_once_with(StreamingNotifier)
+        mock_get_notifier().notify.assert_called_once_with(self.message)
+        count, _ = StreamingNotifier.timer.get()
+        self.assertEquals(1, count)
+
+    def test_coalesced_notification(self, mock_get_notifier):
+        run_notifier('StreamingNotifier', self.message.pk, 3)
+
+        mock_get_notifier().notify_coalesced.assert_called_once_with(
+            self.message, 3, False)
+
+    def test_timeout(self, mock_get_notifier):
+        mock_get_notifier().notify.side_effect = SoftTimeLimitExceeded()
+
+        run_notifier('StreamingNotifier', self.message.pk)
+
+        self.assertEquals(1, notifier_timeouts.get())
+        count, _ = StreamingNotifier.timer.get()
+        self.assertEquals(1, count)
+
+    def test_unknown_notifier(self, mock_get_notifier):
+        run_notifier('UnknownNotifier', self.message.pk)
+
+        self.assertFalse(mock_get_notifier.called)
+
+
+@override_settings(
+    TCA_NOTIFICATION_COALESCE_MS=500,
+    CELERY_ALWAYS_EAGER=True)
+@mock.patch('chat.tasks.send_coalesced_notifications')
+@mock.patch('chat.tasks.get_notifier')
+@mock.patch('chat.tasks.get_notifiers')
+class CoalescedNotificationsTestCase(TestCase):
+    """
+    Tests that the notifications of messages posted in quick succession to
+    a chat room are merged for the notifiers which coalesce them.
+    """
+    def setUp(self):
+        cache.clear()
+        self.sender, self.other_member = MemberFactory.create_batch(2)
+        self.chat_room = ChatRoomFactory.create()
+        self.messages = MessageFactory.create_batch(
+            3, chat_room=self.chat_room, member=self.sender)
+        self.coalescing_notifier = mock.MagicMock(
+            spec=GcmNotifier, coalesce=True)
+        self.notifier = mock.MagicMock(spec=StreamingNotifier, coalesce=False)
+        for notifier in (self.coalescing_notifier, self.notifier):
+            notifier.get_timeout.return_value = 30
+
+    def set_up_mock_notifiers(self, mock_get_notifiers, mock_get_notifier):
+        mock_notifiers(mock_get_notifiers, mock_get_notifier, [
+            self.coalescing_notifier,
+            self.notifier,
+        ])
+
+    def test_notifications_coalesced(
+            self, mock_get_notifiers, mock_get_notifier, mock_task):
+        """
+        Tests that a single notification of the newest message is sent to
+        the coalescing notifiers once the window closes.
+        """
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
+
+        for message in self.messages:
+            send_message_notifications(message.pk)
+
+        # Other notifiers are notified of each message right away
+        self.assertEquals(3, self.notifier.notify.call_count)
+        self.assertFalse(self.coalescing_notifier.notify.called)
+        # A single window is opened
+        mock_task.apply_async.assert_called_once_with(
+            (self.chat_room.pk,), countdown=0.5)
+
+        send_coalesced_notifications(self.chat_room.pk)
+
+        newest = max(self.messages, key=lambda message: message.pk)
+        self.coalescing_notifier.notify_coalesced.assert_called_once_with(
+            newest, 3, False)
+        self.assertFalse(self.notifier.notify_coalesced.called)
+
+    def test_new_window(
+            self, mock_get_notifiers, mock_get_notifier, mock_task):
+        """
+        Tests that a message posted after a window closes opens a new one
+        and is counted in it alone.
+        """
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
+        send_message_notifications(self.messages[0].pk)
+        send_coalesced_notifications(self.chat_room.pk)
+
+        send_message_notifications(self.messages[1].pk)
+        send_coalesced_notifications(self.chat_room.pk)
+
+        self.assertEquals(2, mock_task.apply_async.call_count)
+        self.coalescing_notifier.notify_coalesced.assert_called_with(
+            self.messages[1], 1, False)
+
+    def test_multiple_senders(
+            self, mock_get_notifiers, mock_get_notifier, mock_task):
+        """
+        Tests that the sender of the newest message is notified as well when
+        other members posted messages within the window.
+        """
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
+        message = MessageFactory.create(
+            chat_room=self.chat_room, member=self.other_member)
+        send_message_notifications(message.pk)
+        send_message_notifications(self.messages[0].pk)
+
+        send_coalesced_notifications(self.chat_room.pk)
+
+        self.coalescing_notifier.notify_coalesced.assert_called_once_with(
+            self.messages[0] if self.messages[0].pk > message.pk else message,
+            2, True)
+
+    def test_newest_message_kept(
+            self, mock_get_notifiers, mock_get_notifier, mock_task):
+        """
+        Tests that the newest message is notified even if an older one is
+        added to the window after it.
+        """
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
+        send_message_notifications(self.messages[2].pk)
+        send_message_notifications(self.messages[0].pk)
+
+        send_coalesced_notifications(self.chat_room.pk)
+
+        self.coalescing_notifier.notify_coalesced.assert_called_once_with(
+            self.messages[2], 2, False)
+
+    def test_numbering_started_over(
+            self, mock_get_notifiers, mock_get_notifier, mock_task):
+        """
+        Tests that messages are still notified after the numbering of the
+        messages was evicted from the cache.
+        """
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
+        for message in self.messages:
+            send_message_notifications(message.pk)
+        send_coalesced_notifications(self.chat_room.pk)
+        cache.delete(_get_coalescing_keys(self.chat_room.pk)[1])
+
+        send_message_notifications(self.messages[0].pk)
+        send_coalesced_notifications(self.chat_room.pk)
+
+        self.coalescing_notifier.notify_coalesced.assert_called_with(
+            self.messages[0], 1, False)
+
+    def test_message_numbered_during_send(
+            self, mock_get_notifiers, mock_get_notifier, mock_task):
+        """
+        Tests that a message which is numbered, but not stored yet when the
+        window's notification is sent, is notified once it is stored.
+        """
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
+        send_message_notifications(self.messages[0].pk)
+        incr = cache.incr
+
+        def incr_and_send(*args, **kwargs):
+            number = incr(*args, **kwargs)
+            send_coalesced_notifications(self.chat_room.pk)
+            return number
+
+        with mock.patch.object(cache, 'incr', side_effect=incr_and_send):
+            send_message_notifications(self.messages[1].pk)
+
+        self.coalescing_notifier.notify_coalesced.assert_called_once_with(
+            self.messages[0], 1, False)
+        # The gap is waited for
+        mock_task.apply_async.assert_any_call(
+            (self.chat_room.pk, 1), countdown=0.5)
+
+        send_coalesced_notifications(self.chat_room.pk, 1)
+
+        self.coalescing_notifier.notify_coalesced.assert_called_with(
+            self.messages[1], 1, False)
+        self.assertEquals(
+            2, self.coalescing_notifier.notify_coalesced.call_count)
+
+    def test_missing_message_skipped(
+            self, mock_get_notifiers, mock_get_notifier, mock_task):
+        """
+        Tests that a numbered message which is never stored stops holding
+        back the messages after it once the task runs out of retries.
+        """
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
+        cache.add(_get_coalescing_keys(self.chat_room.pk)[1], 1, None)
+        send_message_notifications(self.messages[0].pk)
+
+        send_coalesced_notifications(self.chat_room.pk)
+        self.assertFalse(self.coalescing_notifier.notify_coalesced.called)
+
+        send_coalesced_notifications(
+            self.chat_room.pk, COALESCING_GAP_RETRIES)
+        self.coalescing_notifier.notify_coalesced.assert_called_once_with(
+            self.messages[0], 1, False)
+
+    @override_settings(TCA_NOTIFICATION_COALESCE_MS=0)
+    def test_coalescing_disabled(
+            self, mock_get_notifiers, mock_get_notifier, mock_task):
+        self.set_up_mock_notifiers(mock_get_notifiers, mock_get_notifier)
+
+        send_message_notifications(self.messages[0].pk)
+
+        self.coalescing_notifier.notify.assert_called_once_with(
+            self.messages[0])
+        self.assertFalse(mock_task.apply_async.called)
+
+
+@mock.patch('chat.tasks.send_message_notifications')
+class ValidateMessageTaskTestCase(TestCase):
+    """
+    Tests for the :func:`chat.tasks.validate_message` task.
+    """
+    def setUp(self):
+        MemberFactory.create_batch(5)
+        ChatRoomFactory.create_batch(5)
+        self.message = MessageFactory.create()
+
+    @mock.patch('chat.models.Message.valid_signature', new=True)
+    def test_valid_signature(self, mock_send_notifications):
+        """
+        Tests that a message with a valid signature is marked valid and
+        notifications are sent for it.
+        """
+        validate_message(self.message.pk)
+
+        self.assertTrue(Message.objects.get(pk=self.message.pk).valid)
+        mock_send_notifications.delay.assert_called_once_with(
+            self.message.pk)
+
+    @mock.patch('chat.models.Message.valid_signature', new=False)
+    def test_invalid_signature(self, mock_send_notifications):
+        """
+        Tests that a message with an invalid signature stays invalid and
+        no notifications are sent for it.
+        """
+        validate_message(self.message.pk)
+
+        self.assertFalse(Message.objects.get(pk=self.message.pk).valid)
+        self.assertFalse(mock_send_notifications.delay.called)
+
+    def test_invalid_message_pk(self, mock_send_notifications):
+        """
+        Tests that the task does nothing when the message does not exist.
+        """
+        validate_message(self.message.pk + 5)
+
+        self.assertFalse(mock_send_notifications.delay.called)
+
+
+@mock.patch('chat.tasks.send_message_notifications')
+class ValidatePendingSignaturesTaskTestCase(TestCase):
+    """
+    Tests for the :func:`chat.tasks.validate_pending_signatures` task.
+    """
+    def setUp(self):
+        fixture_dir = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+        with open(os.path.join(fixture_dir, 'message_fixtures.json')) as f:
+            self.message_fixtures = json.load(f)
+        with open(os.path.join(fixture_dir, 'pubkey.pub'), 'rb') as f:
+            key_text = f.read().decode('utf-8')
+
+        self.members = MemberFactory.create_batch(2)
+        ChatRoomFactory.create_batch(2)
+        # Only the first member has got a key matching the fixtures
+        PublicKeyFactory.create(
+            member=self.members[0], key_text=key_text, active=True)
+        PublicKeyFactory.create(member=self.members[1], active=True)
+
+    def create_from_fixture(self, fixture_name, member):
+        fixture = self.message_fixtures[fixture_name]
+        return MessageFactory.create(
+            text=fixture['text'],
+            signature=fixture['signature'],
+            member=member)
+
+    def test_pending_messages_validated(self, mock_send_notifications):
+        """
+        Tests that all messages with a valid signature are marked valid,
+        regardless of the chunk they are found in.
+        """
+        valid_messages = [
+            self.create_from_fixture(fixture_name, self.members[0])
+            for fixture_name in self.message_fixtures
+        ]
+        invalid_message = self.create_from_fixture(
+            'simple-message', self.members[1])
+
+        count = validate_pending_signatures(chunk_size=2)
+
+        self.assertEquals(len(valid_messages), count)
+        for message in valid_messages:
+            self.assertTrue(Message.objects.get(pk=message.pk).valid)
+        self.assertFalse(Message.objects.get(pk=invalid_message.pk).valid)
+        # Notifications sent only for the newly valid messages
+        self.assertItemsEqual(
+            [mock.call(message.pk) for message in valid_messages],
+            mock_send_notifications.delay.call_args_list)
+
+    def test_process_pool(self, mock_send_notifications):
+        """
+        Tests that the signatures are correctly validated when spread
+        across multiple processes.
+        """
+        valid_message = self.create_from_fixture(
+            'unicode-korean', self.members[0])
+        invalid_message = self.create_from_fixture(
+            'unicode-korean', self.members[1])
+
+        pool = multiprocessing.Pool(2)
+        try:
+            count = validate_backlog(pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEquals(1, count)
+        self.assertTrue(Message.objects.get(pk=valid_message.pk).valid)
+        self.assertFalse(Message.objects.get(pk=invalid_message.pk).valid)
+
+    def test_no_pending_messages(self, mock_send_notifications):
+        """
+        Tests that already valid messages are not touched.
+        """
+        MessageFactory.create_batch(3, valid=True)
+
+        count = validate_pending_signatures()
+
+        self.assertEquals(0, count)
+        self.assertFalse(mock_send_notifications.delay.called)
+
+
+class UpdateRegistrationIdsTaskTestCase(TestCase):
+    """
+    Tests for the :func:`chat.tasks.update_registration_ids` task.
+    """
+    def setUp(self):
+        cache.clear()
+        self.members = MemberFactory.create_batch(2)
+        for member in self.members:
+            for suffix in ('-1', '-2'):
+                DeviceFactory.create(
+                    member=member, registration_id=member.lrz_id + suffix)
+        self.chat_room = ChatRoomFactory.create()
+        self.chat_room.members.add(*self.members)
+
+    def get_registration_ids(self, member):
+        return Member.objects.get(pk=member.pk).registration_ids
+
+    def test_canonical_ids(self):
+        """
+        Tests that registration IDs are replaced by their canonical IDs.
+        """
+        member = self.members[0]
+
+        update_registration_ids([
+            (member.pk, {member.lrz_id + '-1': 'canonical'}, []),
+        ])
+
+        self.assertItemsEqual(
+            ['canonical', member.lrz_id + '-2'],
+            self.get_registration_ids(member))
+        # The other member is unchanged
+        self.assertEquals(
+            self.members[1].registration_ids,
+            self.get_registration_ids(self.members[1]))
+
+    def test_duplicate_canonical_id(self):
+        """
+        Tests that a canonical ID which the member already has is not
+        duplicated.
+        """
+        member = self.members[0]
+
+        update_registration_ids([
+            (member.pk, {member.lrz_id + '-2': member.lrz_id + '-1'}, []),
+        ])
+
+        self.assertEquals(
+            [member.lrz_id + '-1'], self.get_registration_ids(member))
+
+    def test_removed_ids(self):
+        """
+        Tests that the registration IDs which are no longer registered are
+        removed, with a single query per member.
+        """
+        changes = [
+            (member.pk, {}, [member.lrz_id + '-2'])
+            for member in self.members
+        ]
+
+        # Locking the members, selecting their chat rooms, creating and
+        # releasing the savepoint, and a delete for each member
+        with self.assertNumQueries(4 + len(self.members)):
+            update_registration_ids(changes)
+
+        for member in self.members:
+            self.assertEquals(
+                [member.lrz_id + '-1'], self.get_registration_ids(member))
+
+    def test_removed_canonical_id(self):
+        """
+        Tests that a canonical ID is not added when the registration ID it
+        was reported for has been removed in the mean time.
+        """
+        member = self.members[0]
+        Device.objects.filter(registration_id=member.lrz_id + '-1').delete()
+
+        update_registration_ids([
+            (member.pk, {member.lrz_id + '-1': 'canonical'}, []),
+        ])
+
+        self.assertEquals(
+            [member.lrz_id + '-2'], self.get_registration_ids(member))
+
+    def test_cache_invalidated(self):
+        """
+        Tests that the cached registration IDs of the members' chat rooms
+        are invalidated.
+        """
+        member = self.members[0]
+        ChatRoom.objects.get_registration_ids(self.chat_room.pk)
+
+        update_registration_ids([(member.pk, {}, [member.lrz_id + '-1'])])
+
+        self.assertEquals(
+            [member.lrz_id + '-2'],
+            ChatRoom.objects.get_registration_ids(
+                self.chat_room.pk)[member.pk])
+
 
 class EmailConfirmationTaskTestCase(TestCase):
     """
@@ -144,3 +678,39 @@ class EmailConfirmationTaskTestCase(TestCase):
         confirm_new_key(public_key)
 
         self.assertFalse(mock_send_confirmation.delay.called)
+
+
+@mock.patch('chat.tasks.get_notifier')
+class SendGcmNotificationTaskTestCase(TestCase):
+    """
+    Tests for the :func:`chat.tasks.send_gcm_notification` task.
+    """
+    def test_notification_sent(self, mock_get_notifier):
+        send_gcm_notification(1, ['id1'], {'text': 'Hello'}, 2)
+
+        mock_get_notifier.assert_called_once_with(GcmNotifier)
+        notifier = mock_get_notifier()
+        notifier.send.assert_called_once_with(1, ['id1'], {'text': 'Hello'}, 2)
+
+
+class WarmCachesTestCase(TestCase):
+    """
+    Tests for the :func:`chat.tasks.warm_caches` function.
+    """
+    @mock.patch('chat.tasks.connection')
+    def test_bot_id_cached(self, mock_connection):
+        warm_caches()
+
+        with self.assertNumQueries(0):
+            bot_id = SystemMessage.get_bot_id()
+        self.assertEquals(SystemMessage.get_bot_user().pk, bot_id)
+        mock_connection.close.assert_called_once_with()
+
+    @mock.patch('chat.tasks.connection')
+    @mock.patch('chat.models.SystemMessage.get_bot_user')
+    def test_database_error(self, mock_get_bot_user, mock_connection):
+        mock_get_bot_user.side_effect = DatabaseError()
+
+        warm_caches()
+
+        self.assertIsNone(SystemMessage._bot_id)
@@ -2,6 +2,7 @@ from django.test import TestCase
 from django.test.utils import override_settings
 
 from django.core.urlresolvers import reverse
+from django.conf import settings
 
 from django.utils import timezone
 
@@ -13,13 +14,16 @@ import datetime
 
 from chat.views import MemberBasedSignatureValidationMixin
 from chat.views import ChatMessageViewSet
+from chat.broker import get_chat_room_stream_channel
 
 from chat.models import Member
 from chat.models import Message
 from chat.models import ChatRoom
 from chat.models import PublicKey
 from chat.models import PublicKeyConfirmation
+from chat.models import SystemMessage
 
+from .factories import DeviceFactory
 from .factories import MemberFactory
 from .factories import MessageFactory
 from .factories import ChatRoomFactory
@@ -557,23 +561,51 @@ class MessageListPaginationTestCase(ViewTestCaseMixin, TestCase):
             2 * ChatMessageViewSet.default_page_size,
             chat_room=self.chat_room)
 
-    def get(self, page=None, page_size=None):
+    def get(self, cursor=None, page_size=None):
         parameters = {}
-        if page is not None:
-            parameters['page'] = page
+        if cursor is not None:
+            parameters['cursor'] = cursor
         if page_size is not None:
             parameters['page_size'] = page_size
 
         return super(MessageListPaginationTestCase, self).get(
             parameters=parameters, chat_room=self.chat_room.pk)
 
+    def get_link(self, response, rel):
+        """
+        Helper method returning the URL of the link with the given ``rel``
+        found in the ``Link`` header of the response, or ``None`` if there
+        is no such link.
+        """
+        if 'Link' not in response:
+            return None
+        for link in response['Link'].split(', '):
+            url, link_rel = link.split('; ')
+            if link_rel == 'rel="{rel}"'.format(rel=rel):
+                return url.strip('<>')
+
+    def follow_link(self, response, rel):
+        """
+        Helper method which follows the link with the given ``rel`` found in
+        the ``Link`` header of the response.
+        """
+        return self.client.get(self.get_link(response, rel))
+
+    def ordered_messages(self):
+        """
+        Returns the messages of the chat room in the order in which they
+        are paginated.
+        """
+        return list(self.chat_room.messages.order_by('-timestamp', '-pk'))
+
     def assert_expected_messages(self, response_content, messages):
         """
         Helper assertion method which checks that the given messages
         are found in the response content.
         """
-        for response_message, message in zip(response_content, messages):
-            self.assertEquals(response_message['id'], message.pk)
+        self.assertEquals(
+            [message.pk for message in messages],
+            [response_message['id'] for response_message in response_content])
 
     def test_list_default_pagination(self):
         """
@@ -590,9 +622,9 @@ class MessageListPaginationTestCase(ViewTestCaseMixin, TestCase):
             len(response_content))
         self.assert_expected_messages(
             response_content,
-            self.chat_room.messages.all()[:expected_size])
+            self.ordered_messages()[:expected_size])
         # Pagination links are found in the Link header?
-        self.assertIn('page=2', response['Link'])
+        self.assertIn('cursor=', response['Link'])
         self.assertIn('rel="next"', response['Link'])
         # No previous link on the first page
         self.assertNotIn('rel="prev"', response['Link'])
@@ -612,9 +644,9 @@ class MessageListPaginationTestCase(ViewTestCaseMixin, TestCase):
             len(response_content))
         self.assert_expected_messages(
             response_content,
-            self.chat_room.messages.all()[:expected_size])
+            self.ordered_messages()[:expected_size])
         # Pagination links are found in the Link header?
-        self.assertIn('page=2', response['Link'])
+        self.assertIn('cursor=', response['Link'])
         self.assertIn('rel="next"', response['Link'])
 
     def test_page_size_equal_to_total(self):
@@ -632,18 +664,18 @@ class MessageListPaginationTestCase(ViewTestCaseMixin, TestCase):
             len(response_content))
         self.assert_expected_messages(
             response_content,
-            self.chat_room.messages.all()[:expected_size])
+            self.ordered_messages()[:expected_size])
         # No pagination links this time
         self.assertNotIn('Link', response)
 
     def test_access_second_page(self):
         """
-        Tests that it is possible to directly access the second page of
-        the message list.
+        Tests that it is possible to access the second page of the message
+        list by following the next link.
         """
         expected_size = ChatMessageViewSet.default_page_size
 
-        response = self.get(page=2)
+        response = self.follow_link(self.get(), 'next')
 
         response_content = json.loads(response.content)
         self.assertEquals(
@@ -651,33 +683,536 @@ class MessageListPaginationTestCase(ViewTestCaseMixin, TestCase):
             len(response_content))
         self.assert_expected_messages(
             response_content,
-            self.chat_room.messages.all()[expected_size:])
+            self.ordered_messages()[expected_size:])
         # Next page links are not found -- no next page!
-        self.assertNotIn('page=2', response['Link'])
         self.assertNotIn('rel="next"', response['Link'])
         # Pagination links are found in the Link header?
-        self.assertIn('page=1', response['Link'])
         self.assertIn('rel="prev"', response['Link'])
 
-    def test_empty_page(self):
+    def test_access_previous_page(self):
         """
-        Tests that requesting a page out of bounds simply returns an empty
-        page.
+        Tests that following the previous link of the second page returns
+        the first page again.
         """
-        expected_size = 0
+        expected_size = ChatMessageViewSet.default_page_size
+        second_page = self.follow_link(self.get(), 'next')
 
-        response = self.get(page=5)
+        response = self.follow_link(second_page, 'prev')
 
         response_content = json.loads(response.content)
+        self.assert_expected_messages(
+            response_content,
+            self.ordered_messages()[:expected_size])
+        # There is no page before the first one
+        self.assertIn('rel="next"', response['Link'])
+        self.assertNotIn('rel="prev"', response['Link'])
+
+    def test_walk_all_pages(self):
+        """
+        Tests that walking through all pages returns each message exactly
+        once, even when multiple messages share the same timestamp.
+        """
+        Message.objects.filter(pk__in=[
+            message.pk for message in self.messages[:5]
+        ]).update(timestamp=self.messages[0].timestamp)
+        page_size = 3
+
+        seen = []
+        response = self.get(page_size=page_size)
+        while True:
+            seen.extend(
+                message['id'] for message in json.loads(response.content))
+            if self.get_link(response, 'next') is None:
+                break
+            response = self.follow_link(response, 'next')
+
         self.assertEquals(
-            expected_size,
-            len(response_content))
+            [message.pk for message in self.ordered_messages()],
+            seen)
+
+    def test_invalid_cursor(self):
+        """
+        Tests that an invalid cursor results in the first page being
+        returned.
+        """
+        expected_size = ChatMessageViewSet.default_page_size
+
+        response = self.get(cursor='invalid-cursor')
+
+        response_content = json.loads(response.content)
         self.assert_expected_messages(
             response_content,
-            self.chat_room.messages.all()[expected_size:])
+            self.ordered_messages()[:expected_size])
+
+    def test_empty_page(self):
+        """
+        Tests that listing the messages of a chat room with no messages
+        simply returns an empty page.
+        """
+        self.chat_room.messages.all().delete()
+
+        response = self.get()
+
+        response_content = json.loads(response.content)
+        self.assertEquals(0, len(response_content))
         # The Link header is not even included
         self.assertNotIn('Link', response)
 
+    def test_constant_query_count(self):
+        """
+        Tests that the number of queries needed to list a page of messages
+        does not depend on the size of the page.
+        """
+        # Make sure the messages are posted by different members
+        for message, member in zip(self.messages, MemberFactory.create_batch(
+                len(self.messages))):
+            message.member = member
+            message.save()
+
+        with self.assertNumQueries(2):
+            response = self.get(page_size=2)
+        self.assertEquals(2, len(json.loads(response.content)))
+
+        with self.assertNumQueries(2):
+            response = self.get(page_size=len(self.messages))
+        self.assertEquals(
+            len(self.messages), len(json.loads(response.content)))
+
+
+class MessageDeltaSyncTestCase(ViewTestCaseMixin, TestCase):
+    """
+    Tests for listing only the messages newer than the ones a client
+    already has.
+    """
+    view_name = 'message-list'
+
+    def setUp(self):
+        MemberFactory.create_batch(2)
+        self.chat_room = ChatRoomFactory.create()
+        self.messages = MessageFactory.create_batch(
+            5, chat_room=self.chat_room)
+        self.messages.sort(key=lambda message: message.pk)
+        # Messages of a different chat room
+        MessageFactory.create_batch(3, chat_room=ChatRoomFactory.create())
+
+    def get_url(self, parameters):
+        return self.build_url(
+            self.get_view_url(chat_room=self.chat_room.pk),
+            parameters)
+
+    def test_since_id(self):
+        """
+        Tests that only the messages newer than the given one are returned,
+        in the order in which they were posted.
+        """
+        since = self.messages[1]
+
+        response = self.get({
+            'since_id': since.pk,
+        }, chat_room=self.chat_room.pk)
+
+        self.assertEquals(200, response.status_code)
+        response_content = json.loads(response.content)
+        self.assertEquals(
+            [message.pk for message in self.messages[2:]],
+            [message['id'] for message in response_content])
+        self.assertIn('ETag', response)
+
+    def test_since_timestamp(self):
+        """
+        Tests that only the messages posted after the given point in time
+        are returned.
+        """
+        since = timezone.now() - datetime.timedelta(minutes=5)
+        Message.objects.filter(pk__in=[
+            message.pk for message in self.messages[:3]
+        ]).update(timestamp=since - datetime.timedelta(minutes=5))
+
+        response = self.get({
+            'since_timestamp': since.isoformat(),
+        }, chat_room=self.chat_room.pk)
+
+        response_content = json.loads(response.content)
+        self.assertItemsEqual(
+            [message.pk for message in self.messages[3:]],
+            [message['id'] for message in response_content])
+
+    def test_nothing_new(self):
+        """
+        Tests that when there are no new messages, an empty response is
+        returned.
+        """
+        response = self.get({
+            'since_id': self.messages[-1].pk,
+        }, chat_room=self.chat_room.pk)
+
+        self.assertEquals(204, response.status_code)
+        self.assertEquals('', response.content)
+
+    def test_not_modified(self):
+        """
+        Tests that a client which already has the newest message gets a
+        ``304 Not Modified`` response.
+        """
+        url = self.get_url({'since_id': self.messages[1].pk})
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEquals(304, response.status_code)
+        # A new message changes the ETag
+        MessageFactory.create(chat_room=self.chat_room)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(4, len(json.loads(response.content)))
+
+    def test_head(self):
+        """
+        Tests that a HEAD request indicates whether there are new messages
+        without including them.
+        """
+        response = self.client.head(
+            self.get_url({'since_id': self.messages[1].pk}))
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('', response.content)
+        self.assertIn('ETag', response)
+
+        response = self.client.head(
+            self.get_url({'since_id': self.messages[-1].pk}))
+
+        self.assertEquals(204, response.status_code)
+
+    def test_invalid_since_id(self):
+        """
+        Tests that an invalid value of the parameter is ignored.
+        """
+        response = self.get({
+            'since_id': 'asdf',
+        }, chat_room=self.chat_room.pk)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(
+            len(self.messages), len(json.loads(response.content)))
+
+    def test_retrieve_ignores_since(self):
+        """
+        Tests that the parameters do not affect retrieving a single message.
+        """
+        message = self.messages[0]
+        url = self.build_url(
+            reverse('message-detail', kwargs={
+                'chat_room': self.chat_room.pk,
+                'pk': message.pk,
+            }),
+            {'since_id': message.pk})
+
+        response = self.client.get(url)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(message.text, json.loads(response.content)['text'])
+
+
+class ConditionalGetTestCase(ViewTestCaseMixin, TestCase):
+    """
+    Tests for answering conditional requests for chat rooms and their
+    message lists.
+    """
+    def setUp(self):
+        MemberFactory.create_batch(2)
+        self.chat_room = ChatRoomFactory.create()
+        MessageFactory.create_batch(3, chat_room=self.chat_room)
+
+    def get_urls(self):
+        return (
+            reverse('chatroom-detail', kwargs={'pk': self.chat_room.pk}),
+            reverse('message-list', kwargs={'chat_room': self.chat_room.pk}),
+        )
+
+    def set_last_modified(self, last_modified):
+        ChatRoom.objects.filter(pk=self.chat_room.pk).update(
+            last_modified=last_modified)
+
+    def test_validators_included(self):
+        """
+        Tests that the responses include the ETag and Last-Modified headers.
+        """
+        self.set_last_modified(
+            timezone.now() - datetime.timedelta(seconds=5))
+        for url in self.get_urls():
+            response = self.client.get(url)
+
+            self.assertEquals(200, response.status_code)
+            self.assertIn('ETag', response)
+            self.assertIn('Last-Modified', response)
+
+    def test_if_none_match(self):
+        """
+        Tests that a request with a matching ``If-None-Match`` header is
+        answered by a ``304 Not Modified`` response.
+        """
+        for url in self.get_urls():
+            etag = self.client.get(url)['ETag']
+
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+            self.assertEquals(304, response.status_code)
+            self.assertEquals('', response.content)
+            self.assertEquals(etag, response['ETag'])
+
+    def test_if_modified_since(self):
+        """
+        Tests that a request with an ``If-Modified-Since`` header not older
+        than the last modification is answered by ``304 Not Modified``.
+        """
+        self.set_last_modified(
+            timezone.now() - datetime.timedelta(seconds=5))
+        for url in self.get_urls():
+            last_modified = self.client.get(url)['Last-Modified']
+
+            response = self.client.get(
+                url, HTTP_IF_MODIFIED_SINCE=last_modified)
+
+            self.assertEquals(304, response.status_code)
+
+    def test_modified_within_current_second(self):
+        """
+        Tests that the Last-Modified header is left out while the resource
+        was modified within the current second, since another modification
+        within the same second would not change the date.
+        """
+        second = timezone.now().replace(microsecond=0)
+        self.set_last_modified(second + datetime.timedelta(milliseconds=200))
+        for url in self.get_urls():
+            with mock.patch('chat.views.timezone.now',
+                            return_value=second + datetime.timedelta(
+                                milliseconds=500)):
+                response = self.client.get(url)
+
+            self.assertEquals(200, response.status_code)
+            self.assertIn('ETag', response)
+            self.assertNotIn('Last-Modified', response)
+
+    def test_modified_later_within_same_second(self):
+        """
+        Tests that a client relying on ``If-Modified-Since`` finds out
+        about a modification made later within the second of its previous
+        request when polling in the following second.
+        """
+        second = timezone.now().replace(microsecond=0)
+
+        def at(milliseconds):
+            return mock.patch(
+                'chat.views.timezone.now',
+                return_value=second + datetime.timedelta(
+                    milliseconds=milliseconds))
+
+        for url in self.get_urls():
+            self.set_last_modified(second)
+            with at(200):
+                response = self.client.get(url)
+            self.assertNotIn('Last-Modified', response)
+
+            # A message is posted later within the same second
+            self.set_last_modified(second + datetime.timedelta(
+                milliseconds=800))
+            with at(1500):
+                response = self.client.get(url)
+            self.assertEquals(200, response.status_code)
+            last_modified = response['Last-Modified']
+
+            with at(2500):
+                response = self.client.get(
+                    url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEquals(304, response.status_code)
+
+    def test_new_message_modifies(self):
+        """
+        Tests that posting a new message changes the validators of both the
+        chat room and its message list.
+        """
+        etags = [self.client.get(url)['ETag'] for url in self.get_urls()]
+
+        MessageFactory.create(chat_room=self.chat_room)
+
+        for url, etag in zip(self.get_urls(), etags):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(200, response.status_code)
+
+    def test_not_modified_without_serializing(self):
+        """
+        Tests that a conditional request for the message list whose answer
+        is ``304 Not Modified`` needs only a single query.
+        """
+        url = self.get_urls()[1]
+        etag = self.client.get(url)['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEquals(304, response.status_code)
+
+
+class MessageWaitTestCase(ViewTestCaseMixin, TestCase):
+    """
+    Tests for the long-polling endpoint waiting for new messages.
+    """
+    view_name = 'message-wait'
+
+    def setUp(self):
+        MemberFactory.create_batch(2)
+        self.chat_room = ChatRoomFactory.create()
+        self.messages = MessageFactory.create_batch(
+            3, chat_room=self.chat_room)
+        self.messages.sort(key=lambda message: message.pk)
+
+    def test_new_messages_exist(self):
+        """
+        Tests that the request returns right away when there already are
+        messages newer than the given one.
+        """
+        response = self.get({
+            'since_id': self.messages[0].pk,
+            'timeout': 0,
+        }, chat_room=self.chat_room.pk)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(
+            [message.pk for message in self.messages[1:]],
+            [message['id'] for message in json.loads(response.content)])
+
+    def test_timeout(self):
+        """
+        Tests that an empty response is returned when no new message is
+        posted in time.
+        """
+        response = self.get({
+            'timeout': 0,
+        }, chat_room=self.chat_room.pk)
+
+        self.assertEquals(204, response.status_code)
+
+    @mock.patch('chat.views.get_broker')
+    def test_woken_up(self, mock_get_broker):
+        """
+        Tests that a waiting request returns the message whose posting
+        woke it up.
+        """
+        new_messages = []
+
+        def post_message(timeout=None):
+            new_messages.append(
+                MessageFactory.create(chat_room=self.chat_room))
+            return {'id': new_messages[0].pk}
+        subscription = mock_get_broker().subscribe().__enter__()
+        subscription.get.side_effect = post_message
+
+        response = self.get({
+            'since_id': self.messages[-1].pk,
+            'timeout': 10,
+        }, chat_room=self.chat_room.pk)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(
+            [message.pk for message in new_messages],
+            [message['id'] for message in json.loads(response.content)])
+        self.assertEquals(1, subscription.get.call_count)
+
+    def test_non_existent_chat_room(self):
+        response = self.get({
+            'timeout': 0,
+        }, chat_room=self.chat_room.pk + 1)
+
+        self.assertEquals(404, response.status_code)
+
+
+@override_settings(TCA_STREAM_MAX_DURATION=10, TCA_STREAM_HEARTBEAT=5)
+class MessageStreamTestCase(ViewTestCaseMixin, TestCase):
+    """
+    Tests for the endpoint streaming new messages as Server-Sent Events.
+    """
+    view_name = 'message-stream'
+
+    def setUp(self):
+        self.chat_room = ChatRoomFactory.create()
+
+    def get_subscription(self, mock_get_broker, events):
+        """
+        Makes the mocked broker return a subscription producing the given
+        events.
+        """
+        subscription = mock_get_broker().subscribe()
+        subscription.overflowed = False
+        subscription.get.side_effect = events
+        return subscription
+
+    @mock.patch('chat.views.get_broker')
+    def test_messages_streamed(self, mock_get_broker):
+        """
+        Tests that the events published to the chat room's stream channel
+        are sent to the client.
+        """
+        message = {'id': 5, 'text': 'Hello'}
+        subscription = self.get_subscription(mock_get_broker, [
+            {'type': 'message', 'message': message},
+            None,
+            {'type': 'fetch', 'id': 6},
+        ])
+
+        response = self.get(chat_room=self.chat_room.pk)
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('text/event-stream', response['Content-Type'])
+        mock_get_broker().subscribe.assert_called_with(
+            get_chat_room_stream_channel(self.chat_room.pk),
+            max_size=settings.TCA_STREAM_QUEUE_SIZE)
+
+        content = iter(response.streaming_content)
+        self.assertEquals(
+            'id: 5\nevent: message\ndata: {data}\n\n'.format(
+                data=json.dumps(message)),
+            next(content))
+        self.assertEquals(': keep-alive\n\n', next(content))
+        self.assertEquals(
+            'id: 6\nevent: fetch\ndata: {"id": 6}\n\n', next(content))
+        # The subscription is cancelled once the response is closed
+        response.close()
+        self.assertTrue(subscription.close.called)
+
+    @mock.patch('chat.views.get_broker')
+    def test_overflow(self, mock_get_broker):
+        """
+        Tests that a client which does not keep up with the messages is told
+        to resync and the stream is closed.
+        """
+        subscription = self.get_subscription(mock_get_broker, [None])
+        subscription.overflowed = True
+
+        response = self.get(chat_room=self.chat_room.pk)
+
+        self.assertEquals(
+            ['event: resync\ndata: {}\n\n'],
+            list(response.streaming_content))
+        self.assertTrue(subscription.close.called)
+
+    @mock.patch('chat.views.get_broker')
+    def test_closed_without_iterating(self, mock_get_broker):
+        """
+        Tests that the subscription is cancelled when the response is closed
+        before any event is sent.
+        """
+        subscription = self.get_subscription(mock_get_broker, [])
+
+        response = self.get(chat_room=self.chat_room.pk)
+        response.close()
+
+        subscription.close.assert_called_once_with()
+        self.assertFalse(subscription.get.called)
+
+    def test_non_existent_chat_room(self):
+        response = self.get(chat_room=self.chat_room.pk + 1)
+
+        self.assertEquals(404, response.status_code)
+
 
 class PublicKeyListTestCase(ViewTestCaseMixin, TestCase):
     """
@@ -743,6 +1278,104 @@ class PublicKeyListTestCase(ViewTestCaseMixin, TestCase):
         self.assertEquals(2, len(response_content))
 
 
+class MemberChatRoomListTestCase(ViewTestCaseMixin, TestCase):
+    """
+    Tests for the REST endpoint listing the chat rooms of a member.
+    """
+    view_name = 'member-chatroom-list'
+
+    def setUp(self):
+        self.member = MemberFactory.create()
+        self.other_member = MemberFactory.create()
+        self.chat_rooms = ChatRoomFactory.create_batch(3)
+        for chat_room in self.chat_rooms[:2]:
+            chat_room.members.add(self.member, self.other_member)
+        self.chat_rooms[2].members.add(self.other_member)
+
+    def get_chat_room_id(self, chat_room):
+        """
+        Returns the ID of the chat room with the given representation.
+        """
+        return int(chat_room['url'].rstrip('/').rsplit('/', 1)[-1])
+
+    def get_chat_rooms(self, parameters=None):
+        response = self.get(parameters, member=self.member.pk)
+        self.assertEquals(200, response.status_code)
+        return json.loads(response.content)
+
+    def test_list_chat_rooms(self):
+        """
+        Tests that only the chat rooms of the member are listed.
+        """
+        chat_rooms = self.get_chat_rooms()
+
+        self.assertEquals(
+            [chat_room.pk for chat_room in self.chat_rooms[:2]],
+            [self.get_chat_room_id(chat_room) for chat_room in chat_rooms])
+
+    def test_latest_message_and_unread_count(self):
+        """
+        Tests that each chat room includes the ID of its newest message and
+        the number of messages of other members after the given one.
+        """
+        chat_room = self.chat_rooms[0]
+        first = MessageFactory.create(
+            chat_room=chat_room, member=self.other_member)
+        MessageFactory.create(chat_room=chat_room, member=self.other_member)
+        latest = MessageFactory.create(
+            chat_room=chat_room, member=self.member)
+
+        chat_rooms = self.get_chat_rooms({'since_id': first.pk})
+
+        self.assertEquals(latest.pk, chat_rooms[0]['latest_message_id'])
+        # The member's own message is not unread
+        self.assertEquals(1, chat_rooms[0]['unread_count'])
+        # No messages in the other chat room
+        self.assertIsNone(chat_rooms[1]['latest_message_id'])
+        self.assertEquals(0, chat_rooms[1]['unread_count'])
+
+    def test_all_messages_unread(self):
+        """
+        Tests that all messages of other members are unread when no message
+        ID is given.
+        """
+        MessageFactory.create_batch(
+            2, chat_room=self.chat_rooms[1], member=self.other_member)
+
+        chat_rooms = self.get_chat_rooms({'since_id': 'invalid'})
+
+        self.assertEquals(2, chat_rooms[1]['unread_count'])
+
+    def test_members_not_listed(self):
+        """
+        Tests that the chat rooms are listed without their members, using
+        the same number of queries regardless of the number of chat rooms.
+        """
+        for chat_room in ChatRoomFactory.create_batch(5):
+            chat_room.members.add(
+                self.member, *MemberFactory.create_batch(3))
+
+        with self.assertNumQueries(2):
+            chat_rooms = self.get_chat_rooms()
+
+        self.assertEquals(7, len(chat_rooms))
+        for chat_room in chat_rooms:
+            self.assertNotIn('members', chat_room)
+
+    def test_paginated(self):
+        response = self.get({'page_size': 1}, member=self.member.pk)
+
+        self.assertEquals(1, len(json.loads(response.content)))
+        self.assertIn('rel="next"', response['Link'])
+
+    def test_member_links_chat_rooms(self):
+        response = self.client.get(
+            reverse('member-detail', kwargs={'pk': self.member.pk}))
+
+        self.assertTrue(json.loads(response.content)['chat_rooms'].endswith(
+            self.get_view_url(member=self.member.pk)))
+
+
 class AddRegistrationIdTestCase(ViewTestCaseMixin, TestCase):
     """
     Tests for adding a new registration ID to a :class:`chat.models.Member`
@@ -793,8 +1426,9 @@ class AddRegistrationIdTestCase(ViewTestCaseMixin, TestCase):
         """
         mock_validate.return_value = True
         initial_ids = ["asdf", "bdsa"]
-        self.member.registration_ids = initial_ids
-        self.member.save()
+        for registration_id in initial_ids:
+            DeviceFactory.create(
+                member=self.member, registration_id=registration_id)
         self.reload_member()
         # Sanity check
         self.assertListEqual(initial_ids, self.member.registration_ids)
@@ -811,6 +1445,23 @@ class AddRegistrationIdTestCase(ViewTestCaseMixin, TestCase):
             initial_ids + [new_id],
             self.member.registration_ids)
 
+    @mock.patch('chat.views.RegistrationIdAPIView.validate_signature')
+    def test_add_registration_id_twice(self, mock_validate):
+        """
+        Tests that adding a registration ID which the member already has
+        does not duplicate it.
+        """
+        mock_validate.return_value = True
+        DeviceFactory.create(member=self.member, registration_id='asdf')
+
+        response = self.post_json({
+            'registration_id': 'asdf',
+            'signature': 'asdf',
+        }, member_id=self.member.pk)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(['asdf'], self.member.registration_ids)
+
     def test_add_registration_id_invalid_json(self):
         """
         Tests the response to an invalid JSON payload.
@@ -875,8 +1526,9 @@ class RemoveRegistrationIdTestCase(ViewTestCaseMixin, TestCase):
         self.member = MemberFactory.create()
 
         self.initial_ids = ["asdf", "fdsa"]
-        self.member.registration_ids = self.initial_ids
-        self.member.save()
+        for registration_id in self.initial_ids:
+            DeviceFactory.create(
+                member=self.member, registration_id=registration_id)
         self.reload_member()
 
     def reload_member(self):
@@ -989,6 +1641,82 @@ class RemoveRegistrationIdTestCase(ViewTestCaseMixin, TestCase):
         self.assertListEqual(expected_list, self.member.registration_ids)
 
 
+class UpdateRegistrationIdsTestCase(ViewTestCaseMixin, TestCase):
+    """
+    Tests for adding and removing multiple registration IDs of
+    a :class:`chat.models.Member` at once.
+    """
+
+    view_name = 'update-registration-ids'
+
+    def setUp(self):
+        self.member = MemberFactory.create()
+        for registration_id in ('id1', 'id2'):
+            DeviceFactory.create(
+                member=self.member, registration_id=registration_id)
+
+    @mock.patch('chat.views.RegistrationIdAPIView.validate_signature')
+    def test_update_registration_ids(self, mock_validate):
+        mock_validate.return_value = True
+
+        response = self.post_json({
+            'add': ['id2', 'id3', 'id4'],
+            'remove': ['id1', 'id4', 'unknown'],
+            'signature': 'asdf',
+        }, member_id=self.member.pk)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(['id2', 'id3'], self.member.registration_ids)
+        mock_validate.assert_called_once_with()
+
+    @mock.patch('chat.views.RegistrationIdAPIView.validate_signature')
+    def test_only_add(self, mock_validate):
+        mock_validate.return_value = True
+
+        response = self.post_json({
+            'add': ['id3'],
+            'signature': 'asdf',
+        }, member_id=self.member.pk)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(['id1', 'id2', 'id3'], self.member.registration_ids)
+
+    @mock.patch('chat.views.RegistrationIdAPIView.validate_signature')
+    def test_invalid_signature(self, mock_validate):
+        mock_validate.return_value = False
+
+        response = self.post_json({
+            'remove': ['id1'],
+            'signature': 'asdf',
+        }, member_id=self.member.pk)
+
+        self.assertEquals(403, response.status_code)
+        self.assertEquals(['id1', 'id2'], self.member.registration_ids)
+
+    def test_no_registration_ids_in_request(self):
+        response = self.post_json({
+            'signature': 'asdf',
+        }, member_id=self.member.pk)
+
+        self.assertEquals(422, response.status_code)
+
+    def test_invalid_registration_ids(self):
+        response = self.post_json({
+            'add': 'id3',
+            'signature': 'asdf',
+        }, member_id=self.member.pk)
+
+        self.assertEquals(422, response.status_code)
+
+    def test_too_many_registration_ids(self):
+        response = self.post_json({
+            'add': [str(index) for index in range(101)],
+            'signature': 'asdf',
+        }, member_id=self.member.pk)
+
+        self.assertEquals(422, response.status_code)
+
+
 class PublicKeyConfirmationViewTestCase(ViewTestCaseMixin, TestCase):
     """
     Tests for the view which is used to confirm the validity of a
@@ -1626,3 +2354,158 @@ class LeaveChatRoomTestCase(ViewTestCaseMixin, TestCase):
         # Correct response generated?
         # Invalid request response status code
         self.assertEquals(400, response.status_code)
+
+
+@mock.patch('chat.views.crypto.verify_many')
+class BulkJoinChatRoomTestCase(ViewTestCaseMixin, TestCase):
+    """
+    Tests the endpoint for multiple users joining a chat room at once.
+    """
+    view_name = "chatroom-add-members"
+
+    def setUp(self):
+        self.members = MemberFactory.create_batch(3)
+        for member in self.members:
+            PublicKeyFactory.create(member=member, active=True)
+        # Inactive keys are not used for the verification
+        PublicKeyFactory.create(member=self.members[0])
+        self.chat_room = ChatRoomFactory()
+
+    def get_payload(self, members, **kwargs):
+        payload = {
+            'members': [
+                {'lrz_id': member.lrz_id, 'signature': 'signature'}
+                for member in members
+            ],
+        }
+        payload.update(kwargs)
+        return payload
+
+    def test_members_join(self, mock_verify):
+        mock_verify.return_value = [True, False, True]
+
+        response = self.post_json(
+            self.get_payload(self.members), pk=self.chat_room.pk)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals({
+            'status': 'success',
+            'members': {
+                self.members[0].lrz_id: 'success',
+                self.members[1].lrz_id: 'invalid signature',
+                self.members[2].lrz_id: 'success',
+            },
+        }, json.loads(response.content))
+        self.assertEquals(
+            set([self.members[0], self.members[2]]),
+            set(self.chat_room.members.all()))
+        # A message for each member which joined
+        self.assertEquals(2, self.chat_room.messages.count())
+        # All signatures verified at once, against the members' keys
+        items = list(mock_verify.call_args[0][0])
+        self.assertEquals([
+            (member.lrz_id, 'signature', [
+                member.public_keys.get(active=True).key_text])
+            for member in self.members
+        ], items)
+
+    def test_summarized(self, mock_verify):
+        mock_verify.return_value = [True, True, True]
+
+        self.post_json(
+            self.get_payload(self.members, summarize=True),
+            pk=self.chat_room.pk)
+
+        self.assertEquals(3, self.chat_room.members.count())
+        self.assertEquals(
+            ["3 members have joined the chat room."],
+            list(self.chat_room.messages.values_list('text', flat=True)))
+
+    def test_non_existent_lrz_id(self, mock_verify):
+        mock_verify.return_value = [True]
+
+        response = self.post_json({
+            'members': [
+                {'lrz_id': self.members[0].lrz_id, 'signature': 's'},
+                {'lrz_id': 'unknown', 'signature': 's'},
+            ],
+        }, pk=self.chat_room.pk)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(
+            'not found',
+            json.loads(response.content)['members']['unknown'])
+        self.assertEquals(
+            [self.members[0]], list(self.chat_room.members.all()))
+
+    def test_existing_member(self, mock_verify):
+        """
+        Tests that no message is created for members which were already in
+        the chat room.
+        """
+        mock_verify.return_value = [True]
+        self.chat_room.members.add(self.members[0])
+
+        response = self.post_json(
+            self.get_payload(self.members[:1]), pk=self.chat_room.pk)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(0, self.chat_room.messages.count())
+
+    def test_invalid_request(self, mock_verify):
+        invalid_payloads = (
+            {},
+            {'members': []},
+            {'members': 'member'},
+            {'members': [{'lrz_id': self.members[0].lrz_id}]},
+        )
+        for payload in invalid_payloads:
+            response = self.post_json(payload, pk=self.chat_room.pk)
+
+            self.assertEquals(400, response.status_code)
+        self.assertFalse(mock_verify.called)
+        self.assertEquals(0, self.chat_room.members.count())
+
+    def test_too_many_members(self, mock_verify):
+        with mock.patch(
+                'chat.views.ChatRoomViewSet.max_bulk_members', 2):
+            response = self.post_json(
+                self.get_payload(self.members), pk=self.chat_room.pk)
+
+        self.assertEquals(400, response.status_code)
+        self.assertFalse(mock_verify.called)
+
+    def test_verified_in_process(self, mock_verify):
+        mock_verify.return_value = [True, True, True]
+
+        self.post_json(self.get_payload(self.members), pk=self.chat_room.pk)
+
+        self.assertNotIn('processes', mock_verify.call_args[1])
+
+
+@mock.patch('chat.views.crypto.verify_many')
+class BulkLeaveChatRoomTestCase(ViewTestCaseMixin, TestCase):
+    """
+    Tests the endpoint for multiple users leaving a chat room at once.
+    """
+    view_name = "chatroom-remove-members"
+
+    def setUp(self):
+        self.members = MemberFactory.create_batch(3)
+        self.chat_room = ChatRoomFactory()
+        self.chat_room.members.add(*self.members)
+
+    def test_members_leave(self, mock_verify):
+        mock_verify.return_value = [True, True]
+
+        response = self.post_json({
+            'members': [
+                {'lrz_id': member.lrz_id, 'signature': 'signature'}
+                for member in self.members[:2]
+            ],
+        }, pk=self.chat_room.pk)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(
+            [self.members[2]], list(self.chat_room.members.all()))
+        self.assertEquals(2, self.chat_room.messages.count())
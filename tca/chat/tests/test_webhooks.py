@@ -0,0 +1,199 @@
+"""
+Tests for the :mod:`chat.webhooks` module and the webhook notifier.
+"""
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.cache import cache
+from django.db import DatabaseError
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+
+from chat.models import WebhookEvent
+from chat.notifiers import WebhookNotifier
+from chat.webhooks import WebhookQueue
+from chat.webhooks import webhook_spilled_events
+
+from .factories import ChatRoomFactory
+from .factories import MemberFactory
+from .factories import MessageFactory
+
+import gzip
+import io
+import json
+import mock
+import threading
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        self.server.requests.append(json.loads(body))
+
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class WebhookServer(HTTPServer):
+    """
+    A local stand-in for a webhook endpoint which records the events
+    posted to it.
+    """
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), WebhookRequestHandler)
+        self.requests = []
+        self.status = 200
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}/events'.format(*self.server_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+@override_settings(
+    TCA_WEBHOOK_BATCH_MS=60000,
+    TCA_WEBHOOK_BATCH_SIZE=2,
+    TCA_WEBHOOK_QUEUE_SIZE=3)
+class WebhookQueueTestCase(TestCase):
+    """
+    Tests for the :class:`chat.webhooks.WebhookQueue` class.
+    """
+    def setUp(self):
+        cache.clear()
+        self.server = WebhookServer()
+        self.server.start()
+        self.queue = WebhookQueue(self.server.url)
+
+    def tearDown(self):
+        self.queue.close()
+        self.server.stop()
+
+    def test_events_batched(self):
+        """
+        Tests that the queued events are posted in batches.
+        """
+        for i in range(3):
+            self.queue.put({'id': i})
+        self.assertEquals([], self.server.requests)
+
+        self.queue.flush()
+
+        self.assertEquals([
+            {'events': [{'id': 0}, {'id': 1}]},
+            {'events': [{'id': 2}]},
+        ], self.server.requests)
+
+    def test_overflow_spilled(self):
+        """
+        Tests that events which do not fit into the queue are stored in the
+        database and posted by the next flush.
+        """
+        for i in range(4):
+            self.queue.put({'id': i})
+
+        self.assertEquals(1, WebhookEvent.objects.count())
+        self.assertEquals(1, webhook_spilled_events.get())
+
+        self.queue.flush()
+
+        events = [
+            event['id']
+            for request in self.server.requests
+            for event in request['events']
+        ]
+        self.assertEquals([0, 1, 2, 3], events)
+        self.assertEquals(0, WebhookEvent.objects.count())
+
+    def test_failed_events_spilled(self):
+        self.server.status = 503
+        self.queue.put({'id': 0})
+
+        self.queue.flush()
+
+        self.assertEquals(1, len(self.server.requests))
+        event = WebhookEvent.objects.get()
+        self.assertEquals(self.server.url, event.endpoint)
+        self.assertEquals({'id': 0}, event.data)
+
+    def test_spilled_events_kept_while_failing(self):
+        WebhookEvent.objects.create(endpoint=self.server.url, data={'id': 0})
+        self.server.status = 500
+
+        self.queue.flush()
+
+        self.assertEquals(1, WebhookEvent.objects.count())
+
+    def test_spilled_events_locked(self):
+        """
+        Tests that stored events locked by another process are neither
+        posted nor deleted.
+        """
+        WebhookEvent.objects.create(endpoint=self.server.url, data={'id': 0})
+
+        with mock.patch(
+                'chat.webhooks.WebhookEvent.objects.select_for_update',
+                side_effect=DatabaseError) as mock_select:
+            self.queue.flush()
+
+        mock_select.assert_called_once_with(nowait=True)
+        self.assertEquals([], self.server.requests)
+        self.assertEquals(1, WebhookEvent.objects.count())
+
+    @mock.patch('chat.webhooks.threading.Timer')
+    def test_flush_scheduled(self, mock_timer):
+        """
+        Tests that the first event put into an empty queue schedules the
+        queue to be flushed once the batching window closes.
+        """
+        self.queue.put({'id': 0})
+        self.queue.put({'id': 1})
+
+        mock_timer.assert_called_once_with(60, mock.ANY)
+        mock_timer.return_value.start.assert_called_once_with()
+
+
+@override_settings(TCA_WEBHOOK_ENDPOINTS=['http://a/', 'http://b/'])
+@mock.patch('chat.notifiers.WebhookQueue')
+class WebhookNotifierTestCase(TestCase):
+    """
+    Tests for the :class:`chat.notifiers.WebhookNotifier` class.
+    """
+    def setUp(self):
+        cache.clear()
+        MemberFactory.create_batch(2)
+        self.message = MessageFactory.create(
+            chat_room=ChatRoomFactory.create())
+
+    def test_enabled(self, mock_queue):
+        self.assertTrue(WebhookNotifier.is_enabled())
+        with override_settings(TCA_WEBHOOK_ENDPOINTS=[]):
+            self.assertFalse(WebhookNotifier.is_enabled())
+
+    def test_message_queued(self, mock_queue):
+        notifier = WebhookNotifier.get_instance()
+
+        notifier.notify(self.message)
+
+        self.assertEquals(
+            [mock.call('http://a/'), mock.call('http://b/')],
+            mock_queue.call_args_list)
+        self.assertEquals(2, mock_queue.return_value.put.call_count)
+        event = mock_queue.return_value.put.call_args[0][0]
+        self.assertEquals('message', event['type'])
+        self.assertEquals(self.message.pk, event['message']['id'])
@@ -20,6 +20,10 @@ simple_router.register(
 simple_router.register(
     r'members/(?P<member>[^/]+)/pubkeys',
     views.PublicKeyViewSet)
+simple_router.register(
+    r'members/(?P<member>[^/]+)/chat_rooms',
+    views.MemberChatRoomViewSet,
+    base_name='member-chatroom')
 
 #: URLs dealing with handling Android device GCM registration IDs
 registration_id_urls = (
@@ -29,9 +33,20 @@ registration_id_urls = (
     url(r'^members/(?P<member_id>[^/]+)/registration_ids/remove_id$',
         views.RemoveRegistrationIdView.as_view(),
         name='remove-registration-id'),
+    url(r'^members/(?P<member_id>[^/]+)/registration_ids/update_ids$',
+        views.UpdateRegistrationIdsView.as_view(),
+        name='update-registration-ids'),
 )
 
 urlpatterns = patterns('',
+    # Long-polling and streaming of new messages. Need to come before the
+    # generated routes so that they are not taken for message detail URLs.
+    url(r'^chat_rooms/(?P<chat_room>[^/]+)/messages/wait/$',
+        views.MessageWaitView.as_view(),
+        name='message-wait'),
+    url(r'^chat_rooms/(?P<chat_room>[^/]+)/messages/stream/$',
+        views.MessageStreamView.as_view(),
+        name='message-stream'),
     url(r'^', include(router.urls)),
     url(r'^', include(simple_router.urls)),
 
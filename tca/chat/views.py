@@ -1,13 +1,22 @@
 from django.shortcuts import render
 from django.shortcuts import get_object_or_404
 from django.utils.functional import cached_property
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+from django.utils.http import http_date
+from django.utils.http import parse_http_date_safe
+from django.utils.http import parse_etags
+from django.utils.http import quote_etag
 from django.db.models import fields as django_fields
+from django.db import connection
+from django.conf import settings
 from django.core.paginator import (
     Paginator,
     EmptyPage,
 )
 
 from django.http import Http404
+from django.http import StreamingHttpResponse
 
 from rest_framework import viewsets
 from rest_framework import status
@@ -22,6 +31,10 @@ from rest_framework.renderers import (
 from rest_framework.templatetags.rest_framework import replace_query_param
 
 from chat import crypto
+from chat.pagination import CursorPaginator
+from chat.broker import get_broker
+from chat.broker import get_chat_room_channel
+from chat.broker import get_chat_room_stream_channel
 
 from chat.models import Member
 from chat.models import Message
@@ -29,14 +42,23 @@ from chat.models import SystemMessage
 from chat.models import ChatRoom
 from chat.models import PublicKey
 from chat.models import PublicKeyConfirmation
+from chat.models import Device
 from chat.serializers import MemberSerializer
 from chat.serializers import ChatRoomSerializer
+from chat.serializers import MemberChatRoomSerializer
 from chat.serializers import MessageSerializer
 from chat.serializers import ListMessageSerializer
 from chat.serializers import PublicKeySerializer
 
 from chat import hooks
 
+from collections import OrderedDict
+from collections import defaultdict
+
+import calendar
+import json
+import time
+
 
 class FilteredModelViewSetMixin(object):
     """
@@ -251,6 +273,44 @@ class PaginatedListModelMixin(object):
         return response
 
 
+class CursorPaginatedListModelMixin(PaginatedListModelMixin):
+    """
+    A subclass of the :class:`PaginatedListModelMixin` which pages through
+    the objects using a :class:`chat.pagination.CursorPaginator` instead
+    of page numbers.
+
+    The page identifiers are opaque cursors which are passed in the query
+    string parameter named :attr:`paging_parameter`.
+
+    Classes mixing it in can provide the :attr:`cursor_ordering` property
+    to define the (unique) ordering of the objects.
+    """
+    paginator_class = CursorPaginator
+    paging_parameter = 'cursor'
+    cursor_ordering = ('-pk',)
+
+    def get_cursor_ordering(self):
+        """
+        Returns the ordering of the paginated objects.
+
+        By default returns the :attr:`cursor_ordering` property.
+        """
+        return self.cursor_ordering
+
+    def get_paginator_instance(self, object_list):
+        return self.paginator_class(
+            object_list,
+            self.get_page_size(),
+            ordering=self.get_cursor_ordering())
+
+    def get_page_identifier(self):
+        """
+        Returns the cursor given in the query string or ``None`` when the
+        first page should be returned.
+        """
+        return self.request.QUERY_PARAMS.get(self.paging_parameter, None)
+
+
 class SignatureValidationAPIViewMixin(object):
     """
     A mixin providing signature validation functionality.
@@ -333,6 +393,86 @@ class MemberBasedSignatureValidationMixin(SignatureValidationAPIViewMixin):
         ]
 
 
+class ConditionalGetMixin(object):
+    """
+    A mixin providing support for answering conditional GET requests
+    based on the ``ETag`` and ``Last-Modified`` validators.
+
+    Views mixing it in are expected to obtain the validators of the
+    requested resource cheaply (i.e. without building its representation)
+    and to check them using :meth:`get_not_modified_response` before
+    doing any expensive work.
+    """
+    def get_validator_headers(self, etag, last_modified=None):
+        """
+        Returns a dict of HTTP headers containing the given validators.
+
+        Dates in HTTP headers have a resolution of a second, so the
+        ``Last-Modified`` header is left out while the last modification
+        falls in the current second: a later modification within the same
+        second would not change the date, and a client sending it back in
+        ``If-Modified-Since`` would never learn about it.
+        """
+        headers = {
+            'ETag': quote_etag(etag),
+        }
+        if last_modified is not None:
+            modified = calendar.timegm(last_modified.utctimetuple())
+            now = calendar.timegm(timezone.now().utctimetuple())
+            if modified < now:
+                headers['Last-Modified'] = http_date(modified)
+
+        return headers
+
+    def is_not_modified(self, etag, last_modified=None):
+        """
+        Checks whether the client's copy of the resource is up to date
+        according to the conditional request headers.
+
+        When the request contains an ``If-None-Match`` header, the
+        ``If-Modified-Since`` header is ignored, since the ETag changes with
+        each modification.
+        """
+        if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            etags = parse_etags(if_none_match)
+            return etag in etags or '*' in etags
+
+        if_modified_since = self.request.META.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is None or last_modified is None:
+            return False
+
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return (
+            if_modified_since is not None and
+            calendar.timegm(last_modified.utctimetuple()) <= if_modified_since
+        )
+
+    def get_not_modified_response(self, etag, last_modified=None):
+        """
+        Returns a ``304 Not Modified`` response if the client's copy of the
+        resource is up to date, otherwise ``None``.
+        """
+        if self.request.method not in ('GET', 'HEAD'):
+            return None
+        if not self.is_not_modified(etag, last_modified):
+            return None
+
+        return Response(
+            status=status.HTTP_304_NOT_MODIFIED,
+            headers=self.get_validator_headers(etag, last_modified))
+
+    def add_validators(self, response, etag, last_modified=None):
+        """
+        Adds the given validators to the response.
+        """
+        for header, value in self.get_validator_headers(
+                etag, last_modified).items():
+            response[header] = value
+
+        return response
+
+
 class MultiSerializerViewSetMixin(object):
     """
     Mixin for the DRF ViewSet providing the ability to choose a different
@@ -372,6 +512,39 @@ class MemberViewSet(FilteredModelViewSetMixin, viewsets.ModelViewSet):
     filter_fields = ('lrz_id',)
 
 
+class MemberChatRoomViewSet(PaginatedListModelMixin,
+                            viewsets.GenericViewSet):
+    """
+    A read-only ViewSet listing the chat rooms a member belongs to.
+
+    Along with each chat room the ID of its newest message and the number
+    of messages posted by other members since the message given by the
+    ``since_id`` query string parameter are returned.
+    """
+    model = ChatRoom
+    serializer_class = MemberChatRoomSerializer
+    member_id_field = 'member'
+    since_id_parameter = 'since_id'
+
+    def get_since_id(self):
+        """
+        Returns the message ID given in the query string, or ``None`` if it
+        is not given or is invalid.
+        """
+        try:
+            return int(self.request.QUERY_PARAMS[self.since_id_parameter])
+        except (KeyError, ValueError):
+            return None
+
+    def get_queryset(self):
+        """
+        Override the query set to get only the chat rooms of the given
+        Member.
+        """
+        return self.model.objects.for_member(
+            self.kwargs[self.member_id_field], self.get_since_id())
+
+
 class PublicKeyViewSet(mixins.CreateModelMixin,
                        mixins.ListModelMixin,
                        mixins.RetrieveModelMixin,
@@ -442,9 +615,16 @@ class RegistrationIdAPIView(MemberBasedSignatureValidationMixin, APIView):
         """
         return self.request.DATA['registration_id']
 
+    def is_request_valid(self):
+        """
+        Checks whether the request body contains everything needed to
+        process the request.
+        """
+        return 'registration_id' in self.request.DATA
+
     def post(self, request, member_id, format=None):
         # Validate the request
-        if 'registration_id' not in self.request.DATA:
+        if not self.is_request_valid():
             return Response("", status=self.HTTP_422_UNPROCESSABLE_ENTITY)
 
         if not self.validate_signature():
@@ -461,27 +641,69 @@ class RegistrationIdAPIView(MemberBasedSignatureValidationMixin, APIView):
 
 class AddRegistrationIdView(RegistrationIdAPIView):
     def process(self):
-        self.member.registration_ids.append(self.get_registration_id())
-
-        self.member.save()
+        Device.objects.register(self.member, [self.get_registration_id()])
 
 
 class RemoveRegistrationIdView(RegistrationIdAPIView):
     def process(self):
-        try:
-            self.member.registration_ids.remove(self.get_registration_id())
-        except ValueError:
-            # No such registration ID
-            # No need to do anything special, just swallow the exception
-            pass
-        else:
-            # If there was something removed, update the member
-            self.member.save()
+        # Removing a registration ID which does not exist is not an error
+        Device.objects.unregister(self.member, [self.get_registration_id()])
+
+
+class UpdateRegistrationIdsView(RegistrationIdAPIView):
+    """
+    Adds and removes multiple registration IDs of a member in a single
+    request.
+
+    The request body contains lists of the registration IDs which should
+    be added and removed, in its ``add`` and ``remove`` fields. The IDs are
+    added before the others are removed.
+    """
+    #: The maximum number of registration IDs changed by a single request
+    max_registration_ids = 100
+
+    def get_registration_id_list(self, name):
+        return self.request.DATA.get(name) or []
+
+    def is_request_valid(self):
+        data = self.request.DATA
+        if 'add' not in data and 'remove' not in data:
+            return False
+
+        count = 0
+        for name in ('add', 'remove'):
+            registration_ids = self.get_registration_id_list(name)
+            if not isinstance(registration_ids, list):
+                return False
+            if not all(isinstance(registration_id, basestring)
+                       for registration_id in registration_ids):
+                return False
+            count += len(registration_ids)
+
+        return count <= self.max_registration_ids
+
+    def process(self):
+        added_ids = self.get_registration_id_list('add')
+        if added_ids:
+            Device.objects.register(self.member, added_ids)
+        removed_ids = self.get_registration_id_list('remove')
+        if removed_ids:
+            Device.objects.unregister(self.member, removed_ids)
+
+
+def get_chat_room_etag(chat_room_id, version):
+    """
+    Returns the entity tag representing the given version of a chat room.
+    """
+    return '{chat_room_id}-{version}'.format(
+        chat_room_id=chat_room_id,
+        version=version)
 
 
 class ChatRoomViewSet(
         FilteredModelViewSetMixin,
         MemberBasedSignatureValidationMixin,
+        ConditionalGetMixin,
         viewsets.ModelViewSet):
     """
     ViewSet defining operations for the :class:`chat.models.ChatRoom`
@@ -492,6 +714,32 @@ class ChatRoomViewSet(
     serializer_class = ChatRoomSerializer
     filter_fields = ('name',)
 
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Retrieves a single chat room, answering conditional requests based
+        on the version of the chat room.
+        """
+        self.object = self.get_object()
+        etag = get_chat_room_etag(self.object.pk, self.object.version)
+        last_modified = self.object.last_modified
+
+        not_modified = self.get_not_modified_response(etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        serializer = self.get_serializer(self.object)
+        return self.add_validators(
+            Response(serializer.data), etag, last_modified)
+
+    def post_save(self, chat_room, *args, **kwargs):
+        """
+        Implement the hook method to mark the chat room as modified once
+        it (and its members) are saved and to drop the stale registration
+        IDs of its members.
+        """
+        ChatRoom.objects.mark_modified(chat_room.pk)
+        ChatRoom.objects.invalidate_registration_ids(chat_room.pk)
+
     @action()
     def add_member(self, request, pk=None):
         chat_room = self.get_object()
@@ -505,6 +753,7 @@ class ChatRoomViewSet(
 
         if self.validate_signature():
             chat_room.members.add(self.member)
+            ChatRoom.objects.invalidate_registration_ids(chat_room.pk)
             # Member joined notification...
             SystemMessage.objects.create_member_joined(self.member, chat_room)
             return_status = 'success'
@@ -531,6 +780,7 @@ class ChatRoomViewSet(
 
         if self.validate_signature():
             chat_room.members.remove(self.member)
+            ChatRoom.objects.invalidate_registration_ids(chat_room.pk)
             # Member left notification...
             SystemMessage.objects.create_member_left(self.member, chat_room)
             return_status = 'success'
@@ -544,18 +794,160 @@ class ChatRoomViewSet(
             'status': return_status,
         }, status=status_code)
 
+    #: The maximum number of members added or removed by a single request
+    max_bulk_members = 1000
+
+    def get_member_signatures(self, request):
+        """
+        Returns a list of the ``(lrz_id, signature)`` pairs given in the
+        ``members`` field of the request body, or ``None`` if the field
+        is not valid.
+        """
+        entries = request.DATA.get('members')
+        if not isinstance(entries, list) or not entries:
+            return None
+        if len(entries) > self.max_bulk_members:
+            return None
+
+        pairs = []
+        for entry in entries:
+            if not isinstance(entry, dict):
+                return None
+            if not all(field in entry for field in ('lrz_id', 'signature')):
+                return None
+            pairs.append((entry['lrz_id'], entry['signature']))
+
+        return pairs
+
+    def verify_members(self, pairs):
+        """
+        Verifies the signatures of the given ``(lrz_id, signature)`` pairs.
+
+        The verification is performed in the current process, since
+        starting worker processes for each request would cost more than it
+        saves.
+
+        :returns: A tuple of a list of the members whose signatures are
+            valid and a dict mapping each of the given LRZ IDs to the status
+            of its verification.
+        """
+        members = {
+            member.lrz_id: member
+            for member in Member.objects.filter(
+                lrz_id__in=[lrz_id for lrz_id, _ in pairs])
+        }
+        public_keys = defaultdict(list)
+        for member_id, key_text in PublicKey.objects.filter(
+                member__in=members.values(),
+                active=True).values_list('member', 'key_text'):
+            public_keys[member_id].append(key_text)
+
+        found = [
+            (lrz_id, signature)
+            for lrz_id, signature in pairs
+            if lrz_id in members
+        ]
+        results = crypto.verify_many((
+            (lrz_id, signature, public_keys[members[lrz_id].pk])
+            for lrz_id, signature in found
+        ))
+
+        statuses = {
+            lrz_id: 'not found'
+            for lrz_id, _ in pairs
+        }
+        verified = OrderedDict()
+        for (lrz_id, _), valid in zip(found, results):
+            if valid:
+                verified[lrz_id] = members[lrz_id]
+                statuses[lrz_id] = 'success'
+            elif lrz_id not in verified:
+                statuses[lrz_id] = 'invalid signature'
+
+        return list(verified.values()), statuses
+
+    def change_members(self, request, change, create_messages):
+        """
+        Handles a request changing multiple members of a chat room at once.
+
+        :param change: The method of the :class:`chat.models.ChatRoomManager`
+            applying the change to the verified members
+        :param create_messages: The method of the
+            :class:`chat.models.SystemMessageManager` creating the system
+            messages announcing the change
+        """
+        chat_room = self.get_object()
+        pairs = self.get_member_signatures(request)
+        if pairs is None:
+            # Invalid request
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        verified, statuses = self.verify_members(pairs)
+        changed = change(chat_room, verified)
+        create_messages(
+            changed, chat_room,
+            summarize=bool(request.DATA.get('summarize', False)))
+
+        return Response({
+            'status': 'success',
+            'members': statuses,
+        })
+
+    @action()
+    def add_members(self, request, pk=None):
+        """
+        Adds multiple members to the chat room by a single request.
+
+        The request body contains a ``members`` list of objects with the
+        ``lrz_id`` and ``signature`` fields, the same as those expected
+        by :meth:`add_member`. When the ``summarize`` field is set, a single
+        system message announces the number of members which joined.
+
+        Members are added only if their signature is valid. The response
+        tells the result of each member's verification.
+        """
+        return self.change_members(
+            request,
+            ChatRoom.objects.add_members,
+            SystemMessage.objects.bulk_create_members_joined)
+
+    @action()
+    def remove_members(self, request, pk=None):
+        """
+        Removes multiple members from the chat room by a single request.
+
+        The request body is the same as the one of :meth:`add_members`.
+        """
+        return self.change_members(
+            request,
+            ChatRoom.objects.remove_members,
+            SystemMessage.objects.bulk_create_members_left)
+
 
 class ChatMessageViewSet(
         MultiSerializerViewSetMixin,
         FilteredModelViewSetMixin,
         mixins.CreateModelMixin,
         mixins.RetrieveModelMixin,
-        PaginatedListModelMixin,
+        CursorPaginatedListModelMixin,
+        ConditionalGetMixin,
         viewsets.GenericViewSet):
 
     model = Message
     chat_room_id_field = 'chat_room'
 
+    #: Page through the history of a chat room based on the messages'
+    #: timestamps, using the primary key to break ties.
+    cursor_ordering = ('-timestamp', '-pk')
+    #: The ordering used when only messages newer than a given one are
+    #: requested.
+    delta_cursor_ordering = ('timestamp', 'pk')
+
+    #: The query string parameters which can be used to request only the
+    #: messages posted after the given message or point in time.
+    since_id_parameter = 'since_id'
+    since_timestamp_parameter = 'since_timestamp'
+
     filter_fields = ('valid',)
 
     #: The default serializer to be used for the ViewSet
@@ -578,7 +970,102 @@ class ChatMessageViewSet(
         to the given ChatRoom.
         """
         qs = super(ChatMessageViewSet, self).get_queryset()
-        return qs.filter(chat_room=self.kwargs[self.chat_room_id_field])
+        qs = qs.filter(chat_room=self.kwargs[self.chat_room_id_field])
+        # Only listing the messages can be restricted to the new ones. The
+        # route is checked rather than the action, which is not set for
+        # HEAD requests.
+        if self.action_map.get('get') == 'list':
+            qs = qs.filter(**self.get_since_filter())
+        # The serialized representation of messages includes both the
+        # member and the chat room so fetch them along with the messages
+        return qs.select_related('member', 'chat_room')
+
+    def get_since_filter(self):
+        """
+        Returns a dict of queryset filter arguments which select only the
+        messages newer than the ones given in the query string.
+
+        If neither of the parameters is given (or their values are
+        invalid), an empty dict is returned.
+        """
+        since_filter = {}
+        query_params = self.request.QUERY_PARAMS
+
+        if self.since_id_parameter in query_params:
+            try:
+                since_filter['pk__gt'] = int(
+                    query_params[self.since_id_parameter])
+            except ValueError:
+                pass
+
+        if self.since_timestamp_parameter in query_params:
+            try:
+                since_timestamp = parse_datetime(
+                    query_params[self.since_timestamp_parameter])
+            except ValueError:
+                since_timestamp = None
+            if since_timestamp is not None:
+                if timezone.is_naive(since_timestamp):
+                    since_timestamp = timezone.make_aware(
+                        since_timestamp, timezone.utc)
+                since_filter['timestamp__gt'] = since_timestamp
+
+        return since_filter
+
+    def is_delta_request(self):
+        """
+        Returns whether the request asks only for new messages.
+        """
+        return bool(self.get_since_filter())
+
+    def get_cursor_ordering(self):
+        """
+        New messages are returned in the order in which they were posted,
+        all other requests page through the history from the newest message.
+        """
+        if self.is_delta_request():
+            return self.delta_cursor_ordering
+        return self.cursor_ordering
+
+    def list(self, request, *args, **kwargs):
+        """
+        Lists the messages of the chat room.
+
+        The validators of the response are based on the version of the
+        chat room, which changes whenever any of its messages change. This
+        way conditional requests are answered without touching any
+        messages.
+
+        Requests for only the new messages of the chat room (polls) are
+        answered without serializing any messages when there are no new
+        ones.
+        """
+        chat_room = ChatRoom.objects.filter(
+            pk=self.kwargs[self.chat_room_id_field]).values_list(
+                'pk', 'version', 'last_modified')
+        if not chat_room:
+            return super(ChatMessageViewSet, self).list(
+                request, *args, **kwargs)
+
+        chat_room_id, version, last_modified = chat_room[0]
+        etag = get_chat_room_etag(chat_room_id, version)
+        not_modified = self.get_not_modified_response(etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        if self.is_delta_request():
+            if not self.filter_queryset(self.get_queryset()).exists():
+                # Nothing new
+                return self.add_validators(
+                    Response(status=status.HTTP_204_NO_CONTENT),
+                    etag, last_modified)
+            if request.method == 'HEAD':
+                # There are new messages, but their content is not needed
+                return self.add_validators(Response(), etag, last_modified)
+
+        response = super(ChatMessageViewSet, self).list(
+            request, *args, **kwargs)
+        return self.add_validators(response, etag, last_modified)
 
     def pre_save(self, message):
         """
@@ -592,11 +1079,213 @@ class ChatMessageViewSet(
         Implement the hook method to trigger the validation of the message's
         signature.
         """
-        # For now the signature is validated completely synchronously to
-        # the request.
+        # Whether the signature is validated synchronously to the request
+        # is decided by the hook based on the project's settings.
         hooks.validate_message_signature(message)
 
 
+class MessageWaitView(APIView):
+    """
+    A long-polling endpoint which waits for new messages to be posted to
+    a chat room.
+
+    The request is answered as soon as there are messages newer than the
+    one given by the ``since_id`` query string parameter (by default the
+    newest message at the time of the request). If no new message is posted
+    within the number of seconds given by the ``timeout`` parameter
+    (capped by the ``TCA_LONG_POLL_TIMEOUT`` setting), an empty
+    ``204 No Content`` response is returned.
+
+    The request is woken up by the broker returned by
+    :func:`chat.broker.get_broker`, not by polling the database. While it
+    waits, no database connection is held.
+    """
+    since_id_parameter = 'since_id'
+    timeout_parameter = 'timeout'
+    max_messages = 100
+
+    def get_timeout(self):
+        """
+        Returns the number of seconds the request should wait for new
+        messages.
+        """
+        timeout = settings.TCA_LONG_POLL_TIMEOUT
+        if self.timeout_parameter in self.request.QUERY_PARAMS:
+            try:
+                timeout = min(
+                    timeout,
+                    float(self.request.QUERY_PARAMS[self.timeout_parameter]))
+            except ValueError:
+                pass
+
+        return max(timeout, 0)
+
+    def get_since_id(self, chat_room):
+        """
+        Returns the ID of the newest message the client already has.
+        """
+        if self.since_id_parameter in self.request.QUERY_PARAMS:
+            try:
+                return int(self.request.QUERY_PARAMS[self.since_id_parameter])
+            except ValueError:
+                pass
+
+        newest_id = chat_room.messages.order_by('-pk').values_list(
+            'pk', flat=True)[:1]
+        return newest_id[0] if newest_id else 0
+
+    def get_new_messages(self, chat_room, since_id):
+        """
+        Returns a list of messages of the given chat room newer than the
+        message with the given ID, in the order in which they were posted.
+        """
+        return list(
+            chat_room.messages
+                     .filter(pk__gt=since_id)
+                     .select_related('member', 'chat_room')
+                     .order_by('timestamp', 'pk')
+                     [:self.max_messages])
+
+    def get(self, request, chat_room, format=None):
+        chat_room = get_object_or_404(ChatRoom, pk=chat_room)
+        since_id = self.get_since_id(chat_room)
+        deadline = time.time() + self.get_timeout()
+
+        # Subscribe before checking for new messages so that no message
+        # posted in the mean time can be missed.
+        channel = get_chat_room_channel(chat_room.pk)
+        with get_broker().subscribe(channel) as subscription:
+            messages = self.get_new_messages(chat_room, since_id)
+            while not messages:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                # Release the database connection while waiting, unless
+                # the request is wrapped in a transaction
+                if not connection.in_atomic_block:
+                    connection.close()
+                if subscription.get(timeout=remaining) is None:
+                    break
+                messages = self.get_new_messages(chat_room, since_id)
+
+        if not messages:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        serializer = ListMessageSerializer(
+            messages, many=True, context={'request': request})
+        return Response(serializer.data)
+
+
+class EventStream(object):
+    """
+    The content of a streaming response: an iterable of the events produced
+    by the given generator, which cancels the given subscription once the
+    response is closed.
+
+    The subscription is cancelled even if the response is closed without
+    ever being iterated, for instance because the client went away, in
+    which case closing the generator alone would not run its cleanup.
+    """
+    def __init__(self, events, subscription):
+        self.events = events
+        self.subscription = subscription
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        try:
+            self.events.close()
+        finally:
+            self.subscription.close()
+
+
+class MessageStreamView(APIView):
+    """
+    A streaming endpoint which pushes the messages posted to a chat room to
+    the client as `Server-Sent Events`_, as long as the connection is open.
+
+    Each message is sent as a ``message`` event containing the same
+    representation as is found when listing messages. Messages which are
+    too large to be published by the broker are announced by a ``fetch``
+    event carrying only the message's ID.
+
+    The number of events waiting to be sent to a single connection is
+    bounded by the ``TCA_STREAM_QUEUE_SIZE`` setting. When a client falls
+    further behind, a ``resync`` event is sent and the connection is
+    closed. The client should then fetch the missed messages (e.g. by
+    using the ``since_id`` parameter of the message list) and reconnect.
+
+    Messages are only published for streaming when the
+    ``TCA_ENABLE_STREAMING_NOTIFICATIONS`` setting is enabled (see
+    :class:`chat.notifiers.StreamingNotifier`). The endpoint requires
+    a server capable of keeping many connections open (e.g. gunicorn
+    with the gevent worker class).
+
+    .. _Server-Sent Events: http://www.w3.org/TR/eventsource/
+    """
+    def format_event(self, event, data, event_id=None):
+        """
+        Returns the given event in the Server-Sent Events format.
+        """
+        lines = []
+        if event_id is not None:
+            lines.append('id: {id}'.format(id=event_id))
+        lines.append('event: {event}'.format(event=event))
+        lines.append('data: {data}'.format(data=json.dumps(data)))
+
+        return '\n'.join(lines) + '\n\n'
+
+    def stream(self, subscription):
+        """
+        A generator yielding the events to be sent to the client.
+
+        The subscription is cancelled once the events end. The
+        :class:`EventStream` wrapping the generator cancels it when the
+        response is closed early.
+        """
+        deadline = time.time() + settings.TCA_STREAM_MAX_DURATION
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                event = subscription.get(
+                    timeout=min(remaining, settings.TCA_STREAM_HEARTBEAT))
+                if subscription.overflowed:
+                    yield self.format_event('resync', {})
+                    break
+                if event is None:
+                    # A comment keeping the connection from timing out
+                    yield ': keep-alive\n\n'
+                elif event['type'] == 'message':
+                    yield self.format_event(
+                        'message', event['message'], event['message']['id'])
+                else:
+                    yield self.format_event(
+                        'fetch', {'id': event['id']}, event['id'])
+        finally:
+            subscription.close()
+
+    def get(self, request, chat_room, format=None):
+        chat_room = get_object_or_404(ChatRoom, pk=chat_room)
+        subscription = get_broker().subscribe(
+            get_chat_room_stream_channel(chat_room.pk),
+            max_size=settings.TCA_STREAM_QUEUE_SIZE)
+        # The database is not needed for the remainder of the request
+        if not connection.in_atomic_block:
+            connection.close()
+
+        response = StreamingHttpResponse(
+            EventStream(self.stream(subscription), subscription),
+            content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Prevent proxies (nginx) from buffering the events
+        response['X-Accel-Buffering'] = 'no'
+
+        return response
+
+
 class PublicKeyConfirmationView(APIView):
     """
     View providing the option for confirming a public key by knowing
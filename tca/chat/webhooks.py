@@ -0,0 +1,208 @@
+"""
+Module contains the delivery of events to the HTTP endpoints (webhooks)
+given by the ``TCA_WEBHOOK_ENDPOINTS`` setting.
+
+Events are not posted one by one. Instead, each endpoint has
+a :class:`WebhookQueue` which collects the events for
+``TCA_WEBHOOK_BATCH_MS`` milliseconds and then posts them in a single
+gzipped JSON request of the form ``{"events": [...]}``.
+
+Events which do not fit into the in-memory queue, or could not be posted,
+are stored in the database as :class:`chat.models.WebhookEvent` instances
+and posted once the endpoint catches up. The order in which the events are
+delivered is therefore not guaranteed.
+
+The queues live in the memory of each process. Their events are posted
+when the process shuts down cleanly, but are lost when the process is
+killed, for instance by the hard time limit of a Celery task (see
+``TCA_NOTIFIER_TIMEOUT``). The ``TCA_WEBHOOK_BATCH_MS`` setting bounds the
+number of events which can be lost that way.
+"""
+from __future__ import absolute_import
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import connection
+from django.db import transaction
+
+from chat.gcm_client import ConnectionPool
+from chat.metrics import Counter
+from chat.models import WebhookEvent
+
+import gzip
+import httplib
+import io
+import json
+import logging
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+webhook_requests = Counter(
+    'webhooks.requests', "Requests posted to webhook endpoints")
+webhook_failed_requests = Counter(
+    'webhooks.failed_requests', "Requests to webhook endpoints which failed")
+webhook_events = Counter(
+    'webhooks.events', "Events posted to webhook endpoints")
+webhook_spilled_events = Counter(
+    'webhooks.spilled_events', "Events stored in the database")
+
+
+def gzip_compress(data):
+    """
+    Returns the given string compressed in the gzip format.
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+
+    return buf.getvalue()
+
+
+class WebhookQueue(object):
+    """
+    Collects the events destined for a single webhook endpoint and posts
+    them in batches.
+
+    The first event put into an empty queue schedules the queue to be
+    flushed in a background thread after ``TCA_WEBHOOK_BATCH_MS``
+    milliseconds. At most ``TCA_WEBHOOK_QUEUE_SIZE`` events are kept in
+    memory; any further events are stored in the database.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.batch_window = settings.TCA_WEBHOOK_BATCH_MS / 1000.
+        self.batch_size = settings.TCA_WEBHOOK_BATCH_SIZE
+        self.max_size = settings.TCA_WEBHOOK_QUEUE_SIZE
+        self._events = []
+        self._timer = None
+        self._lock = threading.Lock()
+        self._pool = ConnectionPool(
+            url, max_size=1, timeout=settings.TCA_WEBHOOK_TIMEOUT)
+
+    def put(self, event):
+        """
+        Adds the given event to the queue.
+
+        :param event: A JSON serializable object representing the event
+        """
+        with self._lock:
+            full = len(self._events) >= self.max_size
+            if not full:
+                self._events.append(event)
+                if self._timer is None:
+                    self._timer = threading.Timer(
+                        self.batch_window, self._flush_in_background)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if full:
+            self.spill([event])
+
+    def spill(self, events):
+        """
+        Stores the given events in the database, so that they are posted by
+        a later flush.
+        """
+        WebhookEvent.objects.bulk_create([
+            WebhookEvent(endpoint=self.url, data=event)
+            for event in events
+        ])
+        webhook_spilled_events.increment(len(events))
+
+    def flush(self):
+        """
+        Posts all events found in the queue, followed by the events of the
+        endpoint stored in the database.
+
+        Events of batches which could not be posted are stored in the
+        database. Stored events are only posted while the endpoint accepts
+        them, and at most ``TCA_WEBHOOK_QUEUE_SIZE`` of them at once.
+        """
+        with self._lock:
+            events, self._events = self._events, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        failed = False
+        for i in range(0, len(events), self.batch_size):
+            batch = events[i:i + self.batch_size]
+            if failed or not self.post(batch):
+                failed = True
+                self.spill(batch)
+
+        if not failed:
+            self._post_spilled()
+
+    def _post_spilled(self):
+        """
+        Posts the events of the endpoint stored in the database.
+
+        Each batch is locked while it is posted, so that the queues of other
+        processes flushing at the same time skip the stored events instead
+        of posting them again.
+        """
+        for _ in range(0, self.max_size, self.batch_size):
+            try:
+                with transaction.atomic():
+                    batch = list(
+                        WebhookEvent.objects
+                        .select_for_update(nowait=True)
+                        .filter(endpoint=self.url)
+                        .order_by('pk')[:self.batch_size])
+                    if not batch:
+                        return
+                    if not self.post([event.data for event in batch]):
+                        return
+                    WebhookEvent.objects.filter(
+                        pk__in=[event.pk for event in batch]).delete()
+            except DatabaseError:
+                # Another process is posting the stored events
+                return
+
+    def post(self, events):
+        """
+        Posts the given events to the endpoint in a single request.
+
+        :returns: Whether the endpoint accepted the events
+        """
+        body = gzip_compress(json.dumps({'events': events}))
+        headers = {
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
+        }
+        webhook_requests.increment()
+        try:
+            status, _, _ = self._pool.request('POST', body, headers)
+        except (socket.error, httplib.HTTPException):
+            logger.warning("Posting to webhook %s failed", self.url)
+            webhook_failed_requests.increment()
+            return False
+
+        if not 200 <= status < 300:
+            logger.warning(
+                "Webhook %s responded with status %d", self.url, status)
+            webhook_failed_requests.increment()
+            return False
+
+        webhook_events.increment(len(events))
+        return True
+
+    def close(self):
+        """
+        Posts the remaining events and closes the connection to the
+        endpoint.
+        """
+        self.flush()
+        self._pool.close()
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Flushing webhook %s failed", self.url)
+        finally:
+            # The thread's own database connection is no longer needed
+            connection.close()
@@ -53,6 +53,9 @@ ROOT_URLCONF = 'tca.urls'
 
 WSGI_APPLICATION = 'tca.wsgi.application'
 
+#: Runs each test without the state cached by the process in earlier tests
+TEST_RUNNER = 'chat.tests.runner.TestRunner'
+
 
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
@@ -106,3 +109,114 @@ TCA_MESSAGE_EXPIRATION_DAYS = 7
 #: The domain name of the TCA deployment.  Must be overridden in the
 #: production settings!
 TCA_DOMAIN_NAME = 'localhost:8888'
+
+#: The maximum number of parsed public keys which are kept in the
+#: process-local cache used when verifying signatures
+TCA_PUBLIC_KEY_CACHE_SIZE = 1024
+
+#: Whether the signatures of newly posted messages are validated by a
+#: Celery task instead of synchronously to the request which creates them
+TCA_ASYNC_SIGNATURE_VALIDATION = False
+
+#: The number of messages whose signatures are validated at once when
+#: working through a backlog of messages which are not yet valid
+TCA_SIGNATURE_VALIDATION_CHUNK_SIZE = 500
+
+#: The number of processes used by the validate_pending_signatures
+#: management command to validate a backlog of signatures
+TCA_SIGNATURE_VALIDATION_PROCESSES = 1
+
+#: The broker used to notify requests waiting for new messages.  Use
+#: ``chat.broker.PostgresBroker`` when running multiple processes on top
+#: of PostgreSQL.
+TCA_MESSAGE_BROKER = 'chat.broker.LocalBroker'
+
+#: The maximum number of seconds a request waits for new messages
+TCA_LONG_POLL_TIMEOUT = 30
+
+#: Whether new messages are pushed to clients connected to the streaming
+#: endpoint of a chat room
+TCA_ENABLE_STREAMING_NOTIFICATIONS = False
+
+#: The maximum number of messages waiting to be sent to a single streaming
+#: connection. A client which falls further behind is told to resync.
+TCA_STREAM_QUEUE_SIZE = 50
+
+#: The number of seconds after which an idle streaming connection is sent
+#: a keep-alive comment
+TCA_STREAM_HEARTBEAT = 15
+
+#: The maximum number of seconds a streaming connection is kept open
+#: before clients need to reconnect
+TCA_STREAM_MAX_DURATION = 300
+
+#: The number of seconds for which the registration IDs of a chat room's
+#: members are cached. The cache is invalidated whenever they change, so
+#: this only bounds the staleness after changes made behind the app's back.
+TCA_REGISTRATION_IDS_CACHE_TIMEOUT = 60 * 60
+
+#: The maximum number of concurrent requests made to GCM when notifying
+#: the members of a chat room with more registration IDs than fit into
+#: a single request
+TCA_GCM_MAX_CONCURRENT_REQUESTS = 4
+
+#: The URL to which GCM requests are sent. It can be pointed to a local
+#: stand-in server (see the ``run_fake_gcm_server`` management command).
+TCA_GCM_URL = 'https://android.googleapis.com/gcm/send'
+
+#: The number of seconds after which a request to GCM times out
+TCA_GCM_TIMEOUT = 10
+
+#: The maximum number of attempts made to send a GCM notification to a
+#: registration ID when GCM fails temporarily
+TCA_GCM_MAX_ATTEMPTS = 5
+
+#: The base and the maximum number of seconds between attempts to send a
+#: GCM notification. The delay grows exponentially with each attempt.
+TCA_GCM_RETRY_BASE_DELAY = 1
+TCA_GCM_RETRY_MAX_DELAY = 300
+
+#: The number of milliseconds during which the push notifications of new
+#: messages in a chat room are merged into a single notification carrying
+#: the newest message and the number of messages. ``0`` disables it.
+TCA_NOTIFICATION_COALESCE_MS = 0
+
+#: The number of seconds after which sending a notification by a single
+#: notifier is interrupted, unless the notifier sets its own timeout
+TCA_NOTIFIER_TIMEOUT = 30
+
+#: The URLs of the HTTP endpoints to which new messages are posted.  No
+#: messages are posted when the list is empty.
+TCA_WEBHOOK_ENDPOINTS = []
+
+#: The number of milliseconds for which new messages are collected before
+#: they are posted to a webhook endpoint in a single request
+TCA_WEBHOOK_BATCH_MS = 1000
+
+#: The maximum number of messages posted to a webhook endpoint at once
+TCA_WEBHOOK_BATCH_SIZE = 100
+
+#: The maximum number of messages kept in memory for a webhook endpoint by
+#: each process.  Any further messages are stored in the database until
+#: the endpoint catches up.
+TCA_WEBHOOK_QUEUE_SIZE = 1000
+
+#: The number of seconds after which a request to a webhook endpoint times
+#: out
+TCA_WEBHOOK_TIMEOUT = 10
+
+#: The maximum number of characters of a message's text included in its
+#: GCM notification
+TCA_GCM_PREVIEW_LENGTH = 100
+
+#: The number of seconds for which GCM keeps a notification for a device
+#: which is offline
+TCA_GCM_TIME_TO_LIVE = 24 * 60 * 60
+
+#: Whether GCM should wait until a device becomes active before delivering
+#: a notification to it
+TCA_GCM_DELAY_WHILE_IDLE = True
+
+#: The number of seconds for which the serialized representation of a
+#: message is cached for the notifiers
+TCA_MESSAGE_DATA_CACHE_TIMEOUT = 60
@@ -49,6 +49,33 @@ TCA_ENABLE_GCM_NOTIFICATIONS = True
 #: Domain name
 # TCA_DOMAIN_NAME = ''
 
+#: Validate the signatures of new messages in Celery instead of in the
+#: request which creates them
+# TCA_ASYNC_SIGNATURE_VALIDATION = True
+
+#: Notify waiting requests of new messages across all processes
+# TCA_MESSAGE_BROKER = 'chat.broker.PostgresBroker'
+
+#: Push new messages to clients connected to the streaming endpoint
+# TCA_ENABLE_STREAMING_NOTIFICATIONS = True
+
+#: The cache needs to be shared by the web server and the Celery workers,
+#: since cached registration IDs are invalidated by the former and used by
+#: the latter
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#         'LOCATION': '127.0.0.1:11211',
+#     }
+# }
+
+#: Merge the push notifications of messages posted to a chat room within
+#: two seconds
+# TCA_NOTIFICATION_COALESCE_MS = 2000
+
+#: Post new messages to the campus integration bus
+# TCA_WEBHOOK_ENDPOINTS = ['https://bus.example.com/tca/messages']
+
 #: Make sure to provide an API key for GCM
 # TCA_GCM_API_KEY = ""
 
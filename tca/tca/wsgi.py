@@ -12,3 +12,6 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tca.settings")
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+from chat.tasks import warm_caches
+warm_caches()